@@ -0,0 +1,371 @@
+from collections import defaultdict
+import hashlib
+import json
+import os
+
+import h5py
+import numpy as np
+
+
+def window_layout(timesteps, windows_per_chunk=1, compression='lzf', compression_opts=None):
+    """
+    Returns:
+        layout (dict): layout with chunks aligned to training windows of
+            `timesteps + 1` timesteps, so any random window touches at most
+            two chunks of each dataset, for `write_song` and `repack`
+    """
+    return {
+        'chunk_timesteps': windows_per_chunk * (timesteps + 1),
+        'compression': compression,
+        'compression_opts': compression_opts,
+        'shuffle': False,
+    }
+
+
+# HDF5 storage layout of the notes of a song. They are stored in CSR form, as
+# the int8 piano roll integers of all timesteps in `pitches` and the int32
+# offset of each timestep's notes in `indptr`, so a window of timesteps is two
+# slice reads. A layout chunks both datasets in `chunk_timesteps` timesteps,
+# `pitches` assuming the song's average polyphony, and compresses the chunks.
+# Training reads random windows from a corpus that doesn't fit in the page
+# cache, so the default comes from `utils/datastore_benchmark.py --synthetic
+# 2000 --cold`, which reads every window from disk (39MB stored contiguously,
+# median windows per second of 3 runs of 1000 reads):
+#
+#     layout       256 timesteps   64 timesteps   size
+#     contiguous        796            1006        39MB
+#     chunked           978            1176        49MB
+#     lzf               959            1315        47MB
+#     gzip-1            591             880        29MB
+#
+# lzf chunks one training window long read 20% more windows per second than
+# contiguous storage at 256 timesteps and 30% more at 64, for a fifth more
+# disk. Uncompressed chunks are as fast at 256 timesteps but larger, and gzip
+# costs more to decompress than it saves in reads. The default is aligned to
+# the default `timesteps` hyperparameter of `TunatorLSTM`. Choose another
+# layout with `tunator.py ingest --layout`, or convert a datastore with
+# `repack`.
+DEFAULT_LAYOUT = window_layout(256)
+
+
+def named_layouts(timesteps):
+    """
+    Returns:
+        layouts (dict): names and layouts for training windows of `timesteps`,
+            from contiguous storage to chunks of several windows compressed
+            with lzf or gzip, as compared by `utils/datastore_benchmark.py`
+    """
+    return {
+        'contiguous': None,
+        'chunked': window_layout(timesteps, compression=None),
+        'lzf': window_layout(timesteps),
+        'lzf x4': window_layout(timesteps, windows_per_chunk=4),
+        'lzf x16': window_layout(timesteps, windows_per_chunk=16),
+        'gzip-1': window_layout(timesteps, compression='gzip', compression_opts=1),
+        'gzip-1 x4': window_layout(timesteps, windows_per_chunk=4, compression='gzip',
+                                   compression_opts=1),
+    }
+
+
+def write_song(hdf5_path, song, notes, spacing, attrs=None, positions=None, layout=DEFAULT_LAYOUT):
+    """
+    Writes a song to the HDF5 datastore at `hdf5_path` as a sequence of piano
+    roll integer arrays, one per timestep. The notes of timestep `i` are
+    `songs/<song>/pitches[indptr[i]:indptr[i + 1]]`, read them with
+    `read_steps`, and the song group has a `spacing` attribute.
+    Args:
+        hdf5_path (str): path of the datastore. Created if missing.
+        song (str): song name
+        notes (list[iterable[int]]): piano roll integers for each timestep
+        spacing (float): time between timesteps in quarter notes
+        attrs (dict): additional attributes for the song group
+        positions (np.ndarray): grid position of each timestep, in multiples
+            of `spacing`, stored as `songs/<song>/positions`
+        layout (dict): chunking and compression of the notes, see
+            `window_layout`. The datasets are stored contiguously if None,
+            see `DEFAULT_LAYOUT`.
+    """
+    steps = [np.asarray(list(note_ints), dtype='i1') for note_ints in notes]
+    indptr = np.zeros(len(steps) + 1, dtype='i4')
+    np.cumsum([len(step) for step in steps], out=indptr[1:])
+    pitches = np.concatenate(steps) if steps else np.zeros(0, dtype='i1')
+    with h5py.File(hdf5_path, 'a') as f:
+        grp = f.create_group(f'songs/{song}')
+        _write_notes(grp, indptr, pitches, spacing, layout)
+        if positions is not None:
+            grp.create_dataset(name='positions', data=np.asarray(positions, dtype='i4'))
+        for k, v in (attrs or dict()).items():
+            grp.attrs[k] = v
+
+
+def song_length(grp):
+    """
+    Returns:
+        length (int): number of timesteps of the song group `grp`
+    """
+    if 'indptr' in grp:
+        return len(grp['indptr']) - 1
+    # datastores written before the CSR layout, see `repack`
+    return len(grp['notes'])
+
+
+def song_spacing(grp):
+    """
+    Returns:
+        spacing (float): time between timesteps of the song group `grp` in
+            quarter notes
+    """
+    if 'spacing' in grp.attrs:
+        return float(grp.attrs['spacing'])
+    return float(grp['notes'].attrs['spacing'])
+
+
+def read_steps(grp, start=0, stop=None):
+    """
+    Reads timesteps `start` to `stop` of the song group `grp`, touching only
+    the chunks of `indptr` and `pitches` that hold them.
+
+    Returns:
+        steps (list[np.ndarray]): int8 piano roll integers of each timestep,
+            as views of one array
+    """
+    if 'indptr' not in grp:
+        return list(grp['notes'][start:stop, 0])
+    indptr = grp['indptr'][start:None if stop is None else stop + 1]
+    if len(indptr) < 2:
+        return list()
+    pitches = grp['pitches'][indptr[0]:indptr[-1]]
+    return np.split(pitches, indptr[1:-1] - indptr[0])
+
+
+def repack(src_path, dst_path, layout=DEFAULT_LAYOUT):
+    """
+    Copies every song of the datastore at `src_path` to a new datastore at
+    `dst_path`, rewriting the notes with `layout`. Songs stored with the
+    former `notes` dataset of variable-length rows are converted to the CSR
+    layout. Other datasets and all attributes are copied as they are.
+    """
+    with h5py.File(src_path, 'r') as src, h5py.File(dst_path, 'w') as dst:
+        for k, v in src.attrs.items():
+            dst.attrs[k] = v
+        for song, src_grp in src['songs'].items():
+            grp = dst.create_group(f'songs/{song}')
+            for k, v in src_grp.attrs.items():
+                grp.attrs[k] = v
+            if 'indptr' in src_grp:
+                indptr, pitches = src_grp['indptr'][:], src_grp['pitches'][:]
+            else:
+                steps = src_grp['notes'][:, 0]
+                indptr = np.zeros(len(steps) + 1, dtype='i4')
+                np.cumsum([len(step) for step in steps], out=indptr[1:])
+                pitches = np.concatenate(steps).astype('i1') if len(steps) else np.zeros(0, dtype='i1')
+            _write_notes(grp, indptr, pitches, song_spacing(src_grp), layout)
+            for name, dset in src_grp.items():
+                if name not in ('notes', 'indptr', 'pitches'):
+                    src_grp.copy(dset, grp, name=name)
+
+
+def _write_notes(grp, indptr, pitches, spacing, layout):
+    pitches_kwargs, indptr_kwargs = dict(), dict()
+    if layout is not None:
+        chunk_timesteps = layout['chunk_timesteps']
+        kwargs = {
+            'compression': layout['compression'],
+            'compression_opts': layout['compression_opts'],
+            'shuffle': layout['shuffle'],
+        }
+        indptr_kwargs = dict(kwargs, chunks=(min(chunk_timesteps, len(indptr)),))
+        if len(pitches):
+            notes_per_step = len(pitches) / max(len(indptr) - 1, 1)
+            chunk_notes = max(int(np.ceil(chunk_timesteps * notes_per_step)), 1)
+            pitches_kwargs = dict(kwargs, chunks=(min(chunk_notes, len(pitches)),))
+    grp.create_dataset(name='indptr', data=indptr.astype('i4'), **indptr_kwargs)
+    grp.create_dataset(name='pitches', data=pitches.astype('i1'), **pitches_kwargs)
+    grp.attrs['spacing'] = spacing
+
+
+class Datastore:
+    """
+    Song datastore made of one or more HDF5 shards.
+
+    A plain `.hdf5` path is a datastore with a single shard. A `.json` path is
+    the manifest of a sharded datastore, listing shard files relative to the
+    manifest's directory. Every shard has the same schema and its own
+    `songs` index, and each song lives in the shard picked by a hash of its
+    name, so ingest writers can each own a shard and write to it concurrently.
+
+    A datastore can be restricted to a subset of its shards with `subset`, e.g.
+    so that each data-parallel worker reads only its own shards. Songs of the
+    other shards are then left out by `songs` and `owns`, but can still be
+    looked up with `query`.
+
+    Args:
+        path (str): HDF5 file or `.json` manifest
+        shards (list[int]): shard indices this instance uses, all if None
+    """
+    def __init__(self, path, shards=None):
+        self.path = path
+        if path.endswith('.json'):
+            if not os.path.isfile(path):
+                raise FileNotFoundError(f'no sharded datastore manifest at {path}, create it with '
+                                        f'`Datastore.create` or `tunator.py ingest --shards N`')
+            with open(path) as f:
+                manifest = json.load(f)
+            root = os.path.dirname(path)
+            self.shard_paths = [os.path.join(root, shard) for shard in manifest['shards']]
+        else:
+            self.shard_paths = [path]
+        self.n_shards = len(self.shard_paths)
+        self.shards = list(range(self.n_shards)) if shards is None else sorted(shards)
+
+    @classmethod
+    def create(cls, manifest_path, n_shards):
+        """
+        Writes the manifest of a new sharded datastore. The shard files are
+        created when songs are first written to them.
+        """
+        name = os.path.splitext(os.path.basename(manifest_path))[0]
+        manifest = {
+            'n_shards': n_shards,
+            'shards': [f'{name}-{i:05d}-of-{n_shards:05d}.hdf5' for i in range(n_shards)],
+        }
+        root = os.path.dirname(manifest_path)
+        if root:
+            os.makedirs(root, exist_ok=True)
+        tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, manifest_path)
+        return cls(manifest_path)
+
+    def __repr__(self):
+        return f'Datastore({self.path!r}, shards={self.shards})'
+
+    def shard_of(self, song):
+        """
+        Returns:
+            shard (int): index of the shard `song` is stored in
+        """
+        if self.n_shards == 1:
+            return 0
+        digest = hashlib.sha1(song.encode('utf-8')).hexdigest()
+        return int(digest[:8], 16) % self.n_shards
+
+    def path_of(self, song):
+        return self.shard_paths[self.shard_of(song)]
+
+    def owns(self, song):
+        return self.shard_of(song) in self.shards
+
+    def subset(self, worker, n_workers):
+        """
+        Returns:
+            datastore (Datastore): datastore restricted to every `n_workers`th
+                of this datastore's shards, starting from `worker`
+        """
+        shards = self.shards[worker::n_workers]
+        if not shards:
+            raise ValueError(f'worker {worker} of {n_workers} has no shard of {self.n_shards}')
+        return Datastore(self.path, shards)
+
+    def by_shard(self, songs):
+        """
+        Returns:
+            shard_songs (dict): shard paths and the `songs` stored in them
+        """
+        shard_songs = defaultdict(list)
+        for song in songs:
+            shard_songs[self.path_of(song)].append(song)
+        return dict(shard_songs)
+
+    def songs(self, grp_path='songs'):
+        """
+        Returns:
+            songs (dict): names of the songs in this datastore's shards and
+                their groups' attributes
+        """
+        songs = dict()
+        for shard in self.shards:
+            path = self.shard_paths[shard]
+            if not os.path.isfile(path):
+                continue
+            with h5py.File(path, 'r') as f:
+                if grp_path in f:
+                    songs.update({name: dict(grp.attrs) for name, grp in f[grp_path].items()})
+        return songs
+
+    def query(self, query, grp_path='songs'):
+        """
+        Checks the shard of each key in `query` for the key within the group
+        specified by `grp_path`, non-recursively. Missing shards are treated
+        as empty.
+
+        Returns:
+            found (set): query items that were found in the group
+            not_found (set): query items that were not found in the group
+        """
+        found = set()
+        for path, songs in self.by_shard(set(query)).items():
+            if not os.path.isfile(path):
+                continue
+            with h5py.File(path, 'r') as f:
+                if grp_path in f:
+                    grp = f[grp_path]
+                    found.update(song for song in songs if song in grp)
+        return found, set(query) - found
+
+    def write_song(self, song, notes, spacing, attrs=None, positions=None, layout=DEFAULT_LAYOUT):
+        """
+        Writes `song` to its shard, see `write_song` for the arguments.
+        """
+        path = self.path_of(song)
+        root = os.path.dirname(path)
+        if root:
+            os.makedirs(root, exist_ok=True)
+        write_song(path, song, notes, spacing, attrs=attrs, positions=positions, layout=layout)
+
+
+def as_datastore(datastore, n_shards=None):
+    """
+    Args:
+        datastore (str or Datastore): datastore or its path
+        n_shards (int): number of shards of the sharded datastore at a `.json`
+            path, whose manifest is created if it doesn't exist yet
+
+    Returns:
+        datastore (Datastore): `datastore` itself, or a `Datastore` for it if
+            it is a path
+    """
+    if isinstance(datastore, Datastore):
+        return datastore
+    if n_shards is not None:
+        if not datastore.endswith('.json'):
+            raise ValueError(f'a sharded datastore needs a .json manifest path, got {datastore}')
+        if not os.path.isfile(datastore):
+            return Datastore.create(datastore, n_shards)
+        existing = Datastore(datastore)
+        if existing.n_shards != n_shards:
+            raise ValueError(f'{datastore} has {existing.n_shards} shards, not {n_shards}')
+        return existing
+    return Datastore(datastore)
+
+
+def shard(src_path, manifest_path, n_shards):
+    """
+    Splits the single-file datastore at `src_path` into a new sharded
+    datastore with `n_shards` shards, keeping every dataset's layout. The
+    manifest must not exist yet.
+
+    Returns:
+        datastore (Datastore): the sharded datastore
+    """
+    if os.path.exists(manifest_path):
+        raise FileExistsError(f'{manifest_path} already exists')
+    datastore = Datastore.create(manifest_path, n_shards)
+    with h5py.File(src_path, 'r') as src:
+        for path, songs in datastore.by_shard(list(src['songs'])).items():
+            with h5py.File(path, 'a') as dst:
+                grp = dst.require_group('songs')
+                for song in songs:
+                    src.copy(src[f'songs/{song}'], grp, name=song)
+    return datastore
@@ -0,0 +1,197 @@
+"""
+Finds near-duplicate songs in a datastore, e.g. arrangements and re-exports
+of the same piece, with MinHash signatures and locality-sensitive hashing.
+
+    python dedup.py data/songs.hdf5 --threshold 0.6
+"""
+import argparse
+import os
+
+import h5py
+import numpy as np
+
+from datastore import as_datastore, read_steps
+
+# shingles and hash permutations are computed modulo the Mersenne prime 2**31 - 1
+# so products of two residues fit in 64 bits
+PRIME = (1 << 31) - 1
+N_PITCHES = 128
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('hdf5_path', help='datastore, or the .json manifest of a sharded datastore')
+    parser.add_argument('--threshold', type=float, default=.6,
+                        help='estimated Jaccard similarity above which songs are duplicates')
+    parser.add_argument('--ngram', type=int, default=4)
+    parser.add_argument('--permutations', type=int, default=128)
+    args = parser.parse_args()
+
+    datastore = as_datastore(args.hdf5_path)
+    songs = sorted(datastore.songs())
+    clusters = near_duplicate_clusters(datastore, songs, threshold=args.threshold,
+                                       ngram=args.ngram, n_perm=args.permutations)
+    members = dict()
+    for song, cluster in clusters.items():
+        members.setdefault(cluster, list()).append(song)
+    duplicates = [cluster for cluster in members.values() if len(cluster) > 1]
+    print(f'{len(songs)} songs in {len(members)} clusters, '
+          f'{sum(len(cluster) - 1 for cluster in duplicates)} near-duplicates')
+    for cluster in sorted(duplicates, key=len, reverse=True):
+        print(', '.join(sorted(cluster)))
+
+
+def shingles(notes, ngram=4):
+    """
+    Hashes the n-grams of the melody of a song: the highest pitch of every
+    non-empty timestep. Arrangements of the same piece usually keep the
+    melody while their accompaniment and voicing differ, and songs are
+    already transposed to A when they are stored.
+    Args:
+        notes (list[np.ndarray]): piano roll integers of each timestep
+        ngram (int): number of consecutive melody notes per shingle
+
+    Returns:
+        shingles (np.ndarray): unique shingle hashes below `PRIME`, none for
+            songs with fewer than `ngram` melody notes
+    """
+    melody = np.array([step.max() for step in notes if len(step)], dtype=np.int64)
+    if len(melody) < ngram:
+        # too short to compare, padding would make all short songs look alike
+        return np.zeros(0, dtype=np.int64)
+    windows = np.lib.stride_tricks.sliding_window_view(melody + 1, ngram)
+    codes = np.zeros(len(windows), dtype=np.int64)
+    for i in range(ngram):
+        codes = (codes * (N_PITCHES + 1) + windows[:, i]) % PRIME
+    return np.unique(codes)
+
+
+def minhash_signatures(shingle_sets, n_perm=128, seed=0):
+    """
+    Computes a MinHash signature of every set of shingles with `n_perm`
+    universal hash functions `(a * x + b) mod PRIME`. The fraction of equal
+    entries of two signatures estimates the Jaccard similarity of their sets.
+
+    Returns:
+        signatures (np.ndarray): (n_sets, n_perm) minimum hashes
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, PRIME, size=n_perm).astype(np.int64)
+    b = rng.randint(0, PRIME, size=n_perm).astype(np.int64)
+    signatures = np.full((len(shingle_sets), n_perm), PRIME, dtype=np.int64)
+    for i, codes in enumerate(shingle_sets):
+        if len(codes):
+            signatures[i] = ((codes[:, None] * a + b) % PRIME).min(axis=0)
+    return signatures
+
+
+def lsh_bands(n_perm, threshold, fn_weight=.9):
+    """
+    Picks the number of LSH bands for high recall at `threshold`. Two songs
+    with Jaccard similarity `s` are candidates with probability
+    `1 - (1 - s ** rows) ** bands`, and the bands minimize the weighted sum of
+    the areas of false negatives, the miss probability above `threshold`, and
+    false positives, the candidate probability below it. Candidates are
+    verified against `threshold` afterwards, so false positives only cost
+    comparisons and false negatives are weighed heavily. Entries of the
+    signatures past `bands * rows` are only used for the verification.
+    Args:
+        n_perm (int): signature length
+        threshold (float): Jaccard similarity of duplicates
+        fn_weight (float): weight of the false negatives, between 0 and 1
+
+    Returns:
+        bands (int): number of bands of `n_perm // bands` rows each
+    """
+    similarity = (np.arange(1000) + .5) / 1000
+    above = similarity >= threshold
+
+    def cost(bands):
+        candidate = 1 - (1 - similarity ** (n_perm // bands)) ** bands
+        false_negatives = (1 - candidate)[above].sum() / len(similarity)
+        false_positives = candidate[~above].sum() / len(similarity)
+        return fn_weight * false_negatives + (1 - fn_weight) * false_positives
+
+    return min(range(1, n_perm + 1), key=cost)
+
+
+def cluster_signatures(signatures, threshold=.6, bands=None):
+    """
+    Clusters near-duplicates: signatures that are equal in any LSH band are
+    candidates, and candidates with an estimated Jaccard similarity of at
+    least `threshold` are linked. Clusters are the connected components of
+    the links, so only candidate pairs are ever compared.
+    Args:
+        signatures (np.ndarray): (n_songs, n_perm) MinHash signatures
+        threshold (float): estimated Jaccard similarity of duplicates
+        bands (int): number of LSH bands, see `lsh_bands` if None
+
+    Returns:
+        labels (np.ndarray): cluster of each song, the index of its first member
+    """
+    n_songs, n_perm = signatures.shape
+    if bands is None:
+        bands = lsh_bands(n_perm, threshold)
+    rows = n_perm // bands
+    parents = np.arange(n_songs)
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for band in range(bands):
+        band_rows = signatures[:, band * rows:(band + 1) * rows]
+        _, buckets, counts = np.unique(band_rows, axis=0, return_inverse=True,
+                                       return_counts=True)
+        # songs grouped by bucket, keeping only buckets with several songs
+        order = np.argsort(buckets.ravel(), kind='stable')
+        groups = np.split(order, np.cumsum(counts)[:-1])
+        for members in (group for group in groups if len(group) > 1):
+            member_signatures = signatures[members]
+            similarity = (member_signatures[:, None] == member_signatures[None]).mean(axis=2)
+            for i, j in zip(*np.nonzero(np.triu(similarity >= threshold, k=1))):
+                root_i, root_j = find(members[i]), find(members[j])
+                if root_i != root_j:
+                    parents[max(root_i, root_j)] = min(root_i, root_j)
+    return np.array([find(i) for i in range(n_songs)])
+
+
+def near_duplicate_clusters(hdf5_path, songs, threshold=.6, ngram=4, n_perm=128, seed=0):
+    """
+    Reads `songs` from the datastore, opening each shard once, and clusters
+    their near-duplicates. Songs missing from the datastore and songs too
+    short to shingle are clusters of their own.
+    Args:
+        hdf5_path (str or Datastore): datastore holding the songs
+        songs (list): song names
+        threshold (float): estimated Jaccard similarity of the melody n-grams
+            of duplicates
+        ngram (int): see `shingles`
+        n_perm (int): signature length, see `minhash_signatures`
+        seed (int): seed of the hash functions
+
+    Returns:
+        clusters (dict): song names and the name of the first song of their
+            cluster, in the order of `songs`
+    """
+    datastore = as_datastore(hdf5_path)
+    shingle_sets = dict()
+    for path, shard_songs in datastore.by_shard(songs).items():
+        if not os.path.isfile(path):
+            continue
+        with h5py.File(path, 'r') as f:
+            for song in shard_songs:
+                if f'songs/{song}' in f:
+                    shingle_sets[song] = shingles(read_steps(f[f'songs/{song}']), ngram)
+    stored = [song for song in songs if len(shingle_sets.get(song, ()))]
+    signatures = minhash_signatures([shingle_sets[song] for song in stored], n_perm, seed)
+    labels = cluster_signatures(signatures, threshold) if stored else []
+    clusters = {song: song for song in songs}
+    clusters.update({song: stored[label] for song, label in zip(stored, labels)})
+    return clusters
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+
+MIDI_EXTS = ('.mid', '.midi')
+
+# bump when the manifest format changes so old manifests are rebuilt
+MANIFEST_VERSION = 1
+
+
+class CorpusManifest:
+    """
+    Recursive listing of the song files under a corpus directory, cached on
+    disk so that startup doesn't rescan the whole corpus.
+
+    The directory tree is walked with `os.scandir` in a single pass, matching
+    extensions case-insensitively. For every directory the manifest keeps its
+    mtime, subdirectories and the (size, mtime) of its song files. A rescan
+    stats every cached directory and only lists the ones whose mtime changed,
+    i.e. where entries were added, removed or renamed. Files rewritten in place
+    don't change their directory's mtime, so their cached size and mtime can
+    be stale until their directory changes, see `scan(full=True)`.
+
+    Args:
+        root (str): corpus directory
+        manifest_path (str): JSON file the manifest is cached in, or None to
+            always scan the whole tree
+        exts (tuple[str]): lowercase file extensions of songs
+    """
+    def __init__(self, root, manifest_path=None, exts=MIDI_EXTS):
+        self.root = root
+        self.manifest_path = manifest_path
+        self.exts = tuple(ext.lower() for ext in exts)
+        self.dirs = self._load()
+
+    def _load(self):
+        if self.manifest_path is None or not os.path.isfile(self.manifest_path):
+            return dict()
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        if (manifest.get('version') != MANIFEST_VERSION or list(manifest.get('exts', ())) != list(self.exts)
+                or manifest.get('root') != os.path.abspath(self.root)):
+            return dict()
+        return manifest['dirs']
+
+    def save(self):
+        """
+        Writes the manifest under a temporary name and moves it into place, so
+        concurrent readers never see a partial file.
+        """
+        if self.manifest_path is None:
+            return
+        manifest_dir = os.path.dirname(self.manifest_path)
+        if manifest_dir:
+            os.makedirs(manifest_dir, exist_ok=True)
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'root': os.path.abspath(self.root),
+            'exts': list(self.exts),
+            'dirs': self.dirs,
+        }
+        tmp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def scan(self, full=False, save=True):
+        """
+        Brings the manifest up to date with the directory tree and saves it.
+        Args:
+            full (bool): whether to list every directory, even unchanged ones
+            save (bool): whether to save the updated manifest, or only keep it
+                in memory, e.g. for read-only status checks
+
+        Returns:
+            n_listed (int): number of directories that were listed
+        """
+        dirs = dict()
+        n_listed = 0
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            path = os.path.join(self.root, rel_dir) if rel_dir else self.root
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            cached = self.dirs.get(rel_dir)
+            if full or cached is None or cached['mtime'] != mtime:
+                cached = self._list_dir(path, rel_dir, mtime)
+                n_listed += 1
+            dirs[rel_dir] = cached
+            stack.extend(cached['dirs'])
+        self.dirs = dirs
+        if save:
+            self.save()
+        return n_listed
+
+    def _list_dir(self, path, rel_dir, mtime):
+        subdirs = list()
+        files = dict()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(f'{rel_dir}/{entry.name}' if rel_dir else entry.name)
+                elif os.path.splitext(entry.name)[1].lower() in self.exts and entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+        return {'mtime': mtime, 'dirs': sorted(subdirs), 'files': files}
+
+    def files(self):
+        """
+        Returns:
+            files (dict): paths relative to `root`, with '/' separators, and
+                their [size, mtime in ns], sorted by path
+        """
+        files = dict()
+        for rel_dir, cached in self.dirs.items():
+            for name, info in cached['files'].items():
+                files[f'{rel_dir}/{name}' if rel_dir else name] = info
+        return dict(sorted(files.items()))
+
+
+def song_name(rel_path):
+    """
+    Names a song after its path relative to the corpus root, without the
+    extension. '/' separates groups in HDF5, so it is percent-encoded along
+    with '%' itself, which keeps names of songs at the root unchanged.
+
+    Returns:
+        song (str): datastore key of the song
+    """
+    name = os.path.splitext(rel_path)[0]
+    return name.replace('%', '%25').replace('/', '%2F')
+
+
+def song_path(song):
+    """
+    Returns:
+        rel_path (str): path relative to the corpus root of `song`, without the
+            extension, the inverse of `song_name`
+    """
+    return song.replace('%2F', '/').replace('%25', '%')
+
+
+def manifest_path_for(root, manifest_dir):
+    """
+    Returns:
+        manifest_path (str): manifest file in `manifest_dir` for the corpus at
+            `root`, named after a hash of its absolute path
+    """
+    digest = hashlib.sha1(os.path.abspath(root).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(manifest_dir, f'corpus-{digest}.json')
+
+
+def find_songs(root, manifest_path=None, exts=MIDI_EXTS, save=True):
+    """
+    Lists the song files under `root` recursively, see `CorpusManifest`. Files
+    whose names differ only by extension, e.g. 'a.mid' and 'a.MIDI', map to the
+    same song, and only the first of them in path order is kept. The manifest
+    is read from `manifest_path` and only written back if `save`.
+
+    Returns:
+        song_file_dict (dict): song names, see `song_name`, and filepaths
+    """
+    manifest = CorpusManifest(root, manifest_path, exts)
+    manifest.scan(save=save)
+    song_file_dict = dict()
+    for rel_path in manifest.files():
+        song = song_name(rel_path)
+        if song in song_file_dict:
+            print(f'skipping {rel_path}: song {song} is already {song_file_dict[song]}')
+            continue
+        song_file_dict[song] = os.path.join(root, *rel_path.split('/'))
+    return song_file_dict
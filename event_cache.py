@@ -0,0 +1,139 @@
+import hashlib
+import os
+
+import numpy as np
+
+# note events of a MIDI file, one row per pitch. `part` numbers the parts in
+# the order music21 parses them, `program` is -1 where a part sets none and
+# `channel` is 0-based, so the General MIDI drum channel 10 is 9.
+EVENT_DTYPE = np.dtype([
+    ('pitch', 'i1'),
+    ('onset', 'f8'),
+    ('duration', 'f4'),
+    ('program', 'i2'),
+    ('channel', 'i1'),
+    ('part', 'i2'),
+])
+DRUM_CHANNEL = 9
+
+# bump when the parser changes so stale entries are reparsed
+CACHE_VERSION = 1
+
+
+class EventCache:
+    """
+    Parse-once cache of the note events of MIDI files.
+
+    Every file is parsed with music21 the first time it is requested and all
+    of its parts are stored as a structured array of `EVENT_DTYPE` in an `.npy`
+    file, keyed by a hash of the file's content. Part selection, drum removal
+    and merging then run as array operations on the cached events (see
+    `select_part`, `remove_drums` and `merge_parts`), so changing how songs are
+    extracted never requires reparsing the corpus.
+
+    Args:
+        root (str): directory of the cache. Created if missing.
+    """
+    def __init__(self, root='data/events'):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, path):
+        """
+        Returns:
+            key (str): hex digest of the content of the file at `path`
+        """
+        digest = hashlib.sha1(str(CACHE_VERSION).encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+        return digest.hexdigest()
+
+    def get(self, path):
+        """
+        Returns:
+            events (np.ndarray): events of the MIDI file at `path`, parsed and
+                cached if they aren't cached yet
+        """
+        cache_path = os.path.join(self.root, f'{self.key(path)}.npy')
+        try:
+            return np.load(cache_path)
+        except FileNotFoundError:
+            pass
+        events = parse_midi(path)
+        # write under a temporary name so concurrent readers never see partial files
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, events)
+        os.replace(tmp_path, cache_path)
+        return events
+
+    def __contains__(self, path):
+        return os.path.isfile(os.path.join(self.root, f'{self.key(path)}.npy'))
+
+
+def parse_midi(path):
+    """
+    Parses every part of a MIDI file with music21.
+
+    Returns:
+        events (np.ndarray): array of `EVENT_DTYPE` sorted by onset, part and
+            pitch, with onsets and durations in quarter notes
+    """
+    import music21 as m21
+
+    score = m21.converter.parse(path)
+    parts = score.parts if score.parts else [score]
+    rows = list()
+    for part_i, part in enumerate(parts):
+        instrument = part.getInstrument(returnDefault=True)
+        program = instrument.midiProgram if instrument.midiProgram is not None else -1
+        channel = instrument.midiChannel if instrument.midiChannel is not None else -1
+        if isinstance(instrument, m21.instrument.UnpitchedPercussion):
+            channel = DRUM_CHANNEL
+        for elem in part.flat.notes:
+            duration = float(elem.duration.quarterLength)
+            for pitch in getattr(elem, 'pitches', ()):
+                rows.append((pitch.midi, float(elem.offset), duration, program, channel, part_i))
+    events = np.array(rows, dtype=EVENT_DTYPE)
+    return np.sort(events, order=('onset', 'part', 'pitch'))
+
+
+def remove_drums(events):
+    """
+    Returns:
+        events (np.ndarray): `events` without those on the drum channel
+    """
+    return events[events['channel'] != DRUM_CHANNEL]
+
+
+def merge_parts(events):
+    """
+    Merges all parts into one, like music21's chordify: notes of every part
+    that start together end up in the same timestep once the events are
+    turned into a `SongMap`. Unlike chordify, sustained notes are not split
+    at the onsets of other notes.
+
+    Returns:
+        events (np.ndarray): `events` sorted by onset and pitch, with `part` 0
+    """
+    merged = events.copy()
+    merged['part'] = 0
+    return np.sort(merged, order=('onset', 'pitch'))
+
+
+def select_part(events, min_notes=50):
+    """
+    Selects the notes of the first non-drum part with at least `min_notes`
+    notes, falling back to all non-drum parts merged if there is none.
+
+    Returns:
+        events (np.ndarray): events of the selected part
+    """
+    events = remove_drums(events)
+    # count onsets rather than pitches, as music21 counts a chord as one note
+    part_onsets = np.unique(np.stack([events['part'], events['onset']], axis=1), axis=0)
+    parts, onset_counts = np.unique(part_onsets[:, 0], return_counts=True)
+    enough = parts[onset_counts >= min_notes]
+    if not len(enough):
+        return merge_parts(events)
+    return events[events['part'] == enough[0]]
@@ -1,35 +1,55 @@
 import inspect
+import random
+import time
 
 from tensorflow.contrib.training import HParams
 from skopt import gp_minimize, forest_minimize
+from skopt.callbacks import DeadlineStopper
 import skopt.space as space
 from skopt.utils import use_named_args
 from skopt.plots import plot_convergence
 
 # local imports
-from lstm import TunatorLSTM
+from lstm import TunatorLSTM, shared_dataset
+from trial_store import TrialStore
 
 TEST = True
 
 
 def main():
 	optimizer = HyperparameterOptimizer(test=TEST)
-	results = optimizer.optimize()
-	plot_convergence(results)
-	print('Hyperparameeter optimization log:\n{optimizer.hparam_log}')
-	print('Best hyperparameters:\n{optimizer.best_hparams}')
+	optimizer.optimize()
+	if optimizer.results is not None:
+		plot_convergence(optimizer.results)
+	print(f'Hyperparameeter optimization log:\n{optimizer.hparam_log}')
+	print(f'Best hyperparameters:\n{optimizer.best_hparams}')
 
 
-def run_LSTM(batch_size_, epochs_, learning_rate_, dropout_):
-    hparams = HParams(
-        batch_size=batch_size_,
-        epochs=epochs_,
-        learning_rate=learning_rate_,
-        dropout=dropout_
-    )
-    tunator = TunatorLSTM(hparams=hparams)
-
+def run_LSTM(hparams, dataset=None, time_budget=None) -> dict:
+    """
+    Trains a `TunatorLSTM` with `hparams` and reports its best validation loss
+    along with the measured training time.
+    Passing the same `dataset` to every trial skips the per-trial MIDI scan and
+    datastore update, and keeps the song split fixed across trials.
+    Args:
+        hparams (dict): hyperparameters to change from the `TunatorLSTM`
+            defaults
+        dataset (TunatorDataset): shared dataset to train on
+        time_budget (float): seconds after which training is stopped early
 
+    Returns:
+        result (dict): `loss`, `train_time`, `stopped_early` and
+            `checkpoint_path` of the trial
+    """
+    tunator = TunatorLSTM(hparams=hparams, dataset=dataset)
+    tunator.build_model()
+    tunator.train(time_budget=time_budget)
+    return {
+        'loss': float(tunator.val_loss),
+        'train_time': tunator.train_time,
+        'stopped_early': tunator.stopped_early,
+        'checkpoint_path': tunator.checkpoint_path,
+    }
 
 
 def set_params() -> HParams:
@@ -70,6 +90,40 @@ def init_search_space_dict(test=False) -> dict:
 	return search_space_dict
 
 
+def init_lstm_hparam_dict(test=False) -> dict:
+	hparam_dict = dict(
+		learning_rate=0.001,
+		dropout=0.0,
+		lstm_units=512,
+		batch_size=32,
+		timesteps=256,
+		epochs=3,
+	)
+	if test:
+		hparam_dict.update({'lstm_units': 64,
+							'batch_size': 8,
+							'timesteps': 32,
+							'epochs': 1})
+	return hparam_dict
+
+
+def init_lstm_search_space_dict(test=False) -> dict:
+	search_space_dict = dict(
+		dim_learning_rate=space.Real(low=1e-5, high=1e-2, prior='log-uniform', name='learning_rate'),
+		dim_dropout=space.Real(low=0.0, high=0.5, name='dropout'),
+		dim_lstm_units=space.Integer(low=64, high=2048, name='lstm_units'),
+		dim_batch_size=space.Integer(low=8, high=128, name='batch_size'),
+		dim_timesteps=space.Integer(low=16, high=512, name='timesteps'),
+		dim_epochs=space.Integer(low=1, high=10, name='epochs'),
+	)
+	if test:
+		search_space_dict.update({'dim_lstm_units': space.Integer(low=16, high=128, name='lstm_units'),
+								  'dim_batch_size': space.Integer(low=4, high=16, name='batch_size'),
+								  'dim_timesteps': space.Integer(low=16, high=64, name='timesteps'),
+								  'dim_epochs': space.Integer(low=1, high=2, name='epochs')})
+	return search_space_dict
+
+
 def init_search_space_list(test=False) -> list:
 	search_space_list = list(init_search_space_dict(test).values())
 	return search_space_list
@@ -123,16 +177,73 @@ def gen_dir_str() -> str:
 
 
 class HyperparameterOptimizer:
-	def __init__(self, test=False, hparam_dict=None, search_dim_dict=None):
+	"""
+	Bayesian hyperparameter search for `TunatorLSTM` over `search_space_dict`.
+	The dataset is prepared once, on first use, and shared by every trial. Every
+	evaluated trial is written to a `TrialStore`, so an interrupted run can be
+	restarted: the stored trials warm-start `gp_minimize` through `x0`/`y0`,
+	only the remaining calls are made, and any proposed point that was already
+	evaluated (within `tolerance`) is answered from the store instead of being
+	re-run.
+
+	Args:
+		test (bool): use the reduced test search space
+		hparam_dict (dict): default hyperparameters, used as the first point
+		search_dim_dict (dict): search dimensions keyed by `dim_<name>`
+		store (TrialStore): trial store to resume from and log to. Defaults to
+			`data/trials.sqlite`.
+		objective (callable): function of a point in `search_space_list`
+			returning either the cost or a dict with a `loss` key and optional
+			`checkpoint_path` and metric entries. Defaults to training a
+			`TunatorLSTM` on the shared dataset via `run_LSTM`.
+		tolerance (float): relative tolerance for treating a proposed point as
+			already evaluated, see `TrialStore.find`
+		midi_dir (str): directory to MIDI files for the shared dataset
+		hdf5_path (str): path for the HDF5 datastore of the shared dataset
+		in_memory (bool): keep the shared dataset's note sequences in memory
+		acq_func (str): `gp_minimize` acquisition function. The default 'EIps'
+			(expected improvement per second) weighs each candidate by its
+			predicted training time, favoring configurations that are both
+			good and cheap to train.
+		time_budget (float): seconds after which a trial's training is stopped
+			early
+		seed (int): seed of the shared dataset's train/validation split. It is
+			stored with the study on first use, and the stored seed is used from
+			then on, so resumed trials are scored on the same split as earlier
+			ones. Defaults to a random seed for a new study.
+		fixed_hparams (dict): hyperparameters every trial is trained with, on
+			top of the `TunatorLSTM` defaults. The searched hyperparameters take
+			precedence. Trials are stored by their searched hyperparameters
+			only, so keep these the same when resuming a study.
+	"""
+	def __init__(self, test=False, hparam_dict=None, search_dim_dict=None,
+				 store=None, objective=None, tolerance=1e-3,
+				 midi_dir='music/midi/final_fantasy/', hdf5_path='data/songs.hdf5',
+				 in_memory=True, acq_func='EIps', time_budget=None, seed=None, fixed_hparams=None):
 		self.test = test
-		self.test = test # Remove one of these?
 		self.lowest_cost = 1
-		if not (hparam_dict and search_dim_dict):
+		if hparam_dict and search_dim_dict:
+			self.hparam_dict = hparam_dict
+			self.search_space_dict = search_dim_dict
+		else:
 			self.hparam_dict = self.init_hparam_dict()
-			self.search_space_dict = init_search_space_dict(test)
+			self.search_space_dict = init_lstm_search_space_dict(test)
+		self.store = store if store is not None else TrialStore()
+		self.objective = objective if objective is not None else self.run_trial
+		self.tolerance = tolerance
+		self.midi_dir = midi_dir
+		self.hdf5_path = hdf5_path
+		self.in_memory = in_memory
+		self.acq_func = acq_func
+		self.time_budget = time_budget
+		self.fixed_hparams = dict(fixed_hparams or dict())
+		if seed is None:
+			seed = random.randrange(2 ** 31)
+		self.seed = self.store.setting('split_seed', seed)
+		self._dataset = None
 
 	def init_hparam_dict(self) -> dict:
-		hparam_dict = set_hparams(self.test).values()
+		hparam_dict = init_lstm_hparam_dict(self.test)
 		return hparam_dict
 
 	@property
@@ -142,7 +253,7 @@ class HyperparameterOptimizer:
 
 	@property
 	def hparam_list(self) -> list:
-		hparam_list = list(self.hparams.values().values())
+		hparam_list = [self.hparam_dict[dim.name] for dim in self.search_space_list]
 		return hparam_list
 
 	@property
@@ -150,21 +261,116 @@ class HyperparameterOptimizer:
 		search_space_list = list(self.search_space_dict.values())
 		return search_space_list
 
-	def optimize(self) -> dict:
+	@property
+	def dataset(self):
+		"""
+		Dataset shared by all trials. Built on first use, which scans
+		`midi_dir` and brings the datastore up to date once for the whole run.
+		No model is set up for it, the trials build their own.
+		"""
+		if self._dataset is None:
+			self._dataset = shared_dataset(self.midi_dir, self.hdf5_path, seed=self.seed,
+										   in_memory=self.in_memory)
+		return self._dataset
+
+	def run_trial(self, point) -> dict:
+		hparams = dict(self.fixed_hparams)
+		hparams.update({dim.name: value.item() if hasattr(value, 'item') else value
+						for dim, value in zip(self.search_space_list, point)})
+		print(hparams)
+		return run_LSTM(hparams, dataset=self.dataset, time_budget=self.time_budget)
+
+	@property
+	def per_second(self) -> bool:
+		return self.acq_func.endswith('ps')
+
+	def evaluate(self, point):
+		"""
+		Objective passed to `gp_minimize`. Returns the stored cost if `point`
+		was already evaluated, otherwise runs `objective` and records the trial.
+		With a per-second acquisition function the cost is returned together
+		with the trial's training time, taken from a `train_time` entry in the
+		objective's result or else the measured wall time.
+		"""
+		dimensions = self.search_space_list
+		params = {dim.name: value for dim, value in zip(dimensions, point)}
+		trial = self.store.find(params, dimensions, self.tolerance)
+		if trial is not None:
+			print(f'skipping trial already evaluated as #{trial["id"]}: {params}')
+			if self.per_second:
+				return trial['loss'], trial['metrics'].get('train_time', trial['wall_time'])
+			return trial['loss']
+
+		start = time.time()
+		result = self.objective(point)
+		wall_time = time.time() - start
+		if isinstance(result, dict):
+			metrics = dict(result)
+			cost = metrics.pop('loss')
+			checkpoint_path = metrics.pop('checkpoint_path', None)
+		else:
+			metrics = dict()
+			cost = result
+			checkpoint_path = None
+		self.store.record(params, cost, metrics=metrics, wall_time=wall_time,
+						  checkpoint_path=checkpoint_path)
+		if cost < self.lowest_cost:
+			self.lowest_cost = cost
+		if self.per_second:
+			return cost, metrics.get('train_time', wall_time)
+		return cost
+
+	def optimize(self, n_calls=100, n_initial_points=10, deadline=None) -> dict:
+		"""
+		Runs the search, resuming from any trials already in the store.
+		Args:
+			n_calls (int): total number of trials, including stored ones
+			n_initial_points (int): number of random trials before the search
+				is guided by the surrogate model, including stored ones
+			deadline (float): seconds after which no new trial is started
+
+		Returns:
+			best_hparams (dict): hyperparameters of the lowest-cost trial, or the
+				defaults from `hparam_dict` if there is no successful trial
+		"""
 		# TODO: optimize arguments to gp_minimize
 		# Documentation: https://scikit-optimize.github.io/optimizer/index.html
-		results = gp_minimize(func=run_bot,
-							  dimensions=self.search_space_list,
-							  acq_func='EI',  # could try something more exploratory or EIps for expected improvement per second
-							  n_calls=100,
-							  # we can change this to "EIps" for 'Expected improvement per second' to account for compute time
-							  x0=self.hparam_list)  # we can mess with the default arguments later
-		best_hparam_list = results.x
-		hparam_space = results.space
-		best_hparams = hparam_space.point_to_dict(best_hparam_list)
+		x0, y0 = self.store.history(self.search_space_list, with_time=self.per_second)
+		if x0:
+			print(f'resuming from {len(x0)} stored trials')
+			n_calls = max(n_calls - len(x0), 0)
+			n_initial_points = max(n_initial_points - len(x0), 0)
+		else:
+			x0 = [self.hparam_list]
+			y0 = None
+			n_initial_points = min(n_initial_points, n_calls - len(x0))
+		callback = [DeadlineStopper(deadline)] if deadline is not None else None
+		results = None
+		if n_calls > 0:
+			results = gp_minimize(func=self.evaluate,
+								  dimensions=self.search_space_list,
+								  acq_func=self.acq_func,
+								  n_calls=n_calls,
+								  n_initial_points=min(n_initial_points, n_calls),
+								  x0=x0,
+								  y0=y0,
+								  callback=callback)
+
+		# report over every stored trial, including those from earlier runs
+		x_iters, func_vals = self.store.history(self.search_space_list)
+		names = [dim.name for dim in self.search_space_list]
+		if func_vals:
+			best_idx = min(range(len(func_vals)), key=func_vals.__getitem__)
+			best_hparams = dict(zip(names, x_iters[best_idx]))
+		else:
+			# no trial ran or none finished with a finite loss
+			print('no successful trials, returning the default hyperparameters')
+			best_hparams = dict(zip(names, self.hparam_list))
 		self.best_hparams = best_hparams
-		self.hparam_log = sorted(zip(results.func_vals, results.x_iters))
+		self.hparam_log = sorted(zip(func_vals, x_iters))
+		self.results = results
 		return best_hparams
 
 
-if __name__ == '__main__':
\ No newline at end of file
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,320 @@
+"""
+Ingest of MIDI files into the datastore: note events are parsed once into the
+event cache, transposed to A, quantized to a grid as a `SongMap` and written to
+the song's shard. Only NumPy, h5py and, for files not parsed yet, music21 are
+needed, so `tunator.py ingest` runs without Keras or TensorFlow.
+"""
+import os
+
+import h5py
+import numpy as np
+
+from datastore import DEFAULT_LAYOUT, as_datastore, read_steps, song_spacing
+from discovery import find_songs, manifest_path_for
+from event_cache import EventCache, select_part
+from keys import detect_key, transpose_to_a
+from piano_roll import midi_to_roll_index
+from profiling import count, stage
+
+# pitch keys are combined with grid positions as position * N_PITCH_KEYS + pitch
+N_PITCH_KEYS = 128
+
+GRIDS = {
+    '1/4': 1.,
+    '1/8': .5,
+    '1/16': .25,
+    '1/4t': 2 / 3,
+    '1/8t': 1 / 3,
+    '1/16t': 1 / 6,
+}
+
+
+def grid_spacing(grid):
+    """
+    Returns:
+        spacing (float): spacing in quarter notes of a grid name in `GRIDS`,
+            or `grid` itself if it is a number
+    """
+    if isinstance(grid, str):
+        return GRIDS[grid]
+    return float(grid)
+
+
+class SongMap:
+    """
+    Sliceable, time-indexed map of a song's timesteps to the piano roll
+    integers sounding at them.
+
+    The map is backed by NumPy arrays in compressed sparse row (CSR) layout:
+    `onsets` holds the sorted, unique onset of each timestep in quarter notes,
+    and the notes of timestep `i` are `pitches[indptr[i]:indptr[i + 1]]`,
+    sorted. Indexing with an onset returns the notes at that onset, and
+    slicing with a range of onsets returns a `SongMap` view of the timesteps in
+    that range, both found by binary search.
+
+        song_map[4.5]        # notes at onset 4.5
+        song_map[16:32]      # timesteps with 16 <= onset < 32
+
+    Args:
+        onsets (np.ndarray): sorted, unique onset of each timestep
+        indptr (np.ndarray): offsets of each timestep's notes in `pitches`,
+            with one more element than `onsets`
+        pitches (np.ndarray): piano roll integers of all timesteps
+        spacing (float): grid the onsets are quantized to, if any
+    """
+    __slots__ = ('onsets', 'indptr', 'pitches', 'spacing')
+
+    def __init__(self, onsets, indptr, pitches, spacing=None):
+        self.onsets = onsets
+        self.indptr = indptr
+        self.pitches = pitches
+        self.spacing = spacing
+
+    @classmethod
+    def from_events(cls, onsets, pitches, spacing=None):
+        """
+        Builds a map from one (onset, pitch) pair per note, in any order.
+        Notes with the same onset are merged into one timestep and duplicate
+        notes are dropped.
+        """
+        onsets = np.asarray(onsets, dtype=float)
+        pitches = np.asarray(pitches, dtype='i1')
+        order = np.lexsort((pitches, onsets))
+        onsets, pitches = onsets[order], pitches[order]
+        unique = np.ones(len(onsets), dtype=bool)
+        unique[1:] = (onsets[1:] != onsets[:-1]) | (pitches[1:] != pitches[:-1])
+        onsets, pitches = onsets[unique], pitches[unique]
+        step_onsets, starts = np.unique(onsets, return_index=True)
+        indptr = np.append(starts, len(pitches))
+        return cls(step_onsets, indptr, pitches, spacing)
+
+    @classmethod
+    def from_datastore(cls, hdf5_path, song):
+        """
+        Reads a song written by `to_datastore` from a datastore path or
+        `Datastore`. Onsets are restored from the stored grid positions, or as
+        consecutive multiples of the spacing for songs stored without them.
+        """
+        with h5py.File(as_datastore(hdf5_path).path_of(song), 'r') as f:
+            grp = f[f'songs/{song}']
+            spacing = song_spacing(grp)
+            if 'indptr' in grp:
+                indptr = grp['indptr'][:].astype(int)
+                pitches = grp['pitches'][:]
+            else:
+                steps = read_steps(grp)
+                indptr = np.zeros(len(steps) + 1, dtype=int)
+                np.cumsum([len(step) for step in steps], out=indptr[1:])
+                pitches = np.concatenate(steps).astype('i1') if steps else np.zeros(0, dtype='i1')
+            if 'positions' in grp:
+                positions = grp['positions'][:]
+            else:
+                positions = np.arange(len(indptr) - 1)
+        return cls(positions * spacing, indptr, pitches, spacing)
+
+    def __len__(self):
+        return len(self.onsets)
+
+    def __iter__(self):
+        """
+        Yields (onset, notes) for each timestep.
+        """
+        for i, onset in enumerate(self.onsets):
+            yield onset, self.pitches[self.indptr[i]:self.indptr[i + 1]]
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            if item.step is not None:
+                raise ValueError('SongMap slices do not take a step')
+            start = 0 if item.start is None else np.searchsorted(self.onsets, item.start)
+            stop = len(self) if item.stop is None else np.searchsorted(self.onsets, item.stop)
+            stop = max(start, stop)
+            indptr = self.indptr[start:stop + 1]
+            return SongMap(self.onsets[start:stop], indptr - indptr[0],
+                           self.pitches[indptr[0]:indptr[-1]], self.spacing)
+        i = np.searchsorted(self.onsets, item)
+        if i == len(self) or self.onsets[i] != item:
+            raise KeyError(item)
+        return self.pitches[self.indptr[i]:self.indptr[i + 1]]
+
+    def __contains__(self, onset):
+        i = np.searchsorted(self.onsets, onset)
+        return i < len(self) and self.onsets[i] == onset
+
+    def __repr__(self):
+        return (f'SongMap({len(self)} timesteps, {len(self.pitches)} notes, '
+                f'spacing={self.spacing})')
+
+    def steps(self):
+        """
+        Returns:
+            steps (list[np.ndarray]): notes of each timestep, as views of
+                `pitches`
+        """
+        return np.split(self.pitches, self.indptr[1:-1])
+
+    def min_spacing(self):
+        """
+        Returns:
+            min_spacing (float): smallest interval between timesteps
+        """
+        if len(self) < 2:
+            raise ValueError('min_spacing needs at least 2 timesteps')
+        return float(np.diff(self.onsets).min())
+
+    def positions(self):
+        """
+        Returns:
+            positions (np.ndarray): integer grid position of each timestep,
+                for maps quantized to a grid
+        """
+        return np.floor(self.onsets / self.spacing + .5).astype(np.int64)
+
+    def quantize(self, grid, rests=False):
+        """
+        Quantizes the map to a grid in a few array operations: every onset is
+        rounded to the nearest grid position, and notes that land on the same
+        position are merged with a single `np.unique` over combined
+        (position, pitch) keys, which also drops duplicates.
+        Args:
+            grid (float): grid spacing in quarter notes, see `grid_spacing`
+            rests (bool): whether to include empty timesteps for the grid
+                positions without notes between the first and last timestep.
+                They only add an onset and an offset each, no notes.
+
+        Returns:
+            song_map (SongMap): the quantized map
+        """
+        positions = np.floor(self.onsets / grid + .5).astype(np.int64)
+        note_positions = np.repeat(positions, np.diff(self.indptr))
+        keys = np.unique(note_positions * N_PITCH_KEYS + self.pitches)
+        note_positions, pitches = np.divmod(keys, N_PITCH_KEYS)
+        step_positions, starts = np.unique(note_positions, return_index=True)
+        counts = np.diff(np.append(starts, len(pitches)))
+        if rests and len(step_positions):
+            all_positions = np.arange(step_positions[0], step_positions[-1] + 1)
+            all_counts = np.zeros(len(all_positions), dtype=counts.dtype)
+            all_counts[step_positions - step_positions[0]] = counts
+            step_positions, counts = all_positions, all_counts
+        indptr = np.zeros(len(step_positions) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return SongMap(step_positions * grid, indptr, pitches.astype('i1'), grid)
+
+    def to_datastore(self, hdf5_path, song, layout=DEFAULT_LAYOUT):
+        """
+        Writes the timesteps to the datastore as `songs/<song>`, with the
+        map's spacing, or the smallest interval between timesteps if it isn't
+        quantized. Quantized maps also store the grid position of each
+        timestep in `songs/<song>/positions`, so their timing is kept without
+        storing rests. See `datastore.DEFAULT_LAYOUT` for the `layout`. With a
+        sharded datastore the song goes to its shard.
+        """
+        datastore = as_datastore(hdf5_path)
+        if self.spacing is None:
+            datastore.write_song(song, self.steps(), self.min_spacing(), layout=layout)
+        else:
+            datastore.write_song(song, self.steps(), self.spacing, positions=self.positions(),
+                                 layout=layout)
+
+
+def discover_songs(midi_dir, hdf5_path):
+    """
+    Lists the MIDI files under `midi_dir`, see `discovery.find_songs`, with the
+    listing cached in a manifest next to the datastore at `hdf5_path`, so only
+    directories that changed since the last run are rescanned.
+
+    Returns:
+        song_file_dict (dict): song names and filepaths
+    """
+    manifest_path = manifest_path_for(midi_dir, os.path.dirname(hdf5_path))
+    with stage('discover_songs'):
+        return find_songs(midi_dir, manifest_path)
+
+
+def parse_song(event_cache, file, grid, rests=False):
+    """
+    Parses a MIDI file to a `SongMap` of timesteps and corresponding notes.
+    The note events are read from the event cache, which parses the file the
+    first time. The lowest numbered non-drum part that has at least 50 notes
+    is extracted, or all parts merged if there is none, see
+    `event_cache.select_part`. The key of the extracted notes is detected,
+    weighted by duration, and the notes are transposed to A and quantized to
+    `grid`. Notes transposed beyond the piano roll are dropped.
+    Args:
+        event_cache (EventCache): cache of parsed note events
+        file (str): MIDI file
+        grid (float): grid spacing in quarter notes, see `grid_spacing`
+        rests (bool): whether to keep empty timesteps, see `SongMap.quantize`
+
+    Returns:
+        song_map (SongMap): the quantized song
+    """
+    with stage('parse_midi'):
+        events = select_part(event_cache.get(file))
+        key = detect_key(midi_to_roll_index(events['pitch'].astype(int)), events['duration'])
+    with stage('parse_notes'):
+        note_ints = midi_to_roll_index(transpose_to_a(events['pitch'].astype(int), key))
+        in_roll = note_ints >= 0
+        song_map = SongMap.from_events(events['onset'][in_roll], note_ints[in_roll])
+        song_map = song_map.quantize(grid, rests=rests)
+    if len(song_map) < 2:
+        raise ValueError(f'{file} has fewer than 2 timesteps')
+    return song_map
+
+
+def ingest_songs(hdf5_path, song_file_dict, grid=.5, rests=False, layout=DEFAULT_LAYOUT,
+                 event_dir=None):
+    """
+    Parses the MIDI files of `song_file_dict` and writes them to the datastore,
+    each song to its shard. Songs must not be stored yet, see
+    `Datastore.query`.
+    Args:
+        hdf5_path (str or Datastore): datastore to write to
+        song_file_dict (dict): names and MIDI filepaths of the songs to add
+        grid (float): grid spacing in quarter notes, see `grid_spacing`
+        rests (bool): whether to store empty timesteps
+        layout (dict): storage layout of the notes, see `datastore.DEFAULT_LAYOUT`
+        event_dir (str): directory of the event cache, by default `events`
+            next to the datastore, so every file is only parsed once
+    """
+    datastore = as_datastore(hdf5_path)
+    if event_dir is None:
+        event_dir = os.path.join(os.path.dirname(datastore.path), 'events')
+    event_cache = EventCache(event_dir)
+    for song, file in song_file_dict.items():
+        print(f'updating datastore: {file}...')
+        song_map = parse_song(event_cache, file, grid, rests)
+        with stage('write_to_datastore'):
+            song_map.to_datastore(datastore, song, layout=layout)
+        count('songs_ingested')
+
+
+def update_datastore(hdf5_path, song_file_dict, grid=.5, rests=False, layout=DEFAULT_LAYOUT):
+    """
+    Adds the songs of `song_file_dict` that are missing from the datastore,
+    see `ingest_songs`. With a datastore restricted to some of its shards,
+    only the songs of those shards are added, so workers owning different
+    shards can ingest in parallel.
+
+    Returns:
+        added (list): names of the songs that were added
+    """
+    datastore = as_datastore(hdf5_path)
+    _, missing = datastore.query([song for song in song_file_dict if datastore.owns(song)])
+    added = sorted(missing)
+    ingest_songs(datastore, {song: song_file_dict[song] for song in added}, grid=grid,
+                 rests=rests, layout=layout)
+    return added
+
+
+def transcribed_songs(hdf5_path):
+    """
+    Looks up the songs in the datastore that were transcribed from audio by
+    `preprocessing/transcription.py` rather than parsed from MIDI files.
+
+    Returns:
+        song_file_dict (dict): song names and the audio filepaths they were
+            transcribed from
+    """
+    return {name: attrs['file'] for name, attrs in as_datastore(hdf5_path).songs().items()
+            if attrs.get('source') == 'audio'}
@@ -0,0 +1,166 @@
+"""
+Lookup tables for key normalization, precomputed for all 24 major and minor
+keys when the module is imported.
+
+Keys are numbered by the pitch class of their tonic (C = 0), plus 12 for minor
+keys. Normalizing a song to its key is then a table lookup and an integer
+shift of the pitch arrays that were already parsed, instead of building and
+transposing music21 objects.
+"""
+import numpy as np
+
+from piano_roll import NOTE_NAMES, roll_index_to_pitch_class
+
+MAJOR, MINOR = 0, 1
+MODES = ('major', 'minor')
+N_KEYS = 24
+
+_LETTER_PITCH_CLASSES = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+KEY_NAMES = [f'{NOTE_NAMES[tonic]} {mode}' for mode in MODES for tonic in range(12)]
+KEY_TONICS = np.tile(np.arange(12), 2)
+KEY_MODES = np.repeat([MAJOR, MINOR], 12)
+
+# scale degree 1 - 12 of every pitch class, counted in semitones from the
+# tonic of the key's relative major, so minor keys share the degrees of their
+# relative major: SCALE_DEGREES[key, pitch_class]
+_MAJOR_TONICS = (KEY_TONICS + 3 * KEY_MODES) % 12
+SCALE_DEGREES = (np.arange(12)[np.newaxis, :] - _MAJOR_TONICS[:, np.newaxis]) % 12 + 1
+
+# the same, indexed by position within a piano roll octave (A = 0)
+ROLL_SCALE_DEGREES = SCALE_DEGREES[:, roll_index_to_pitch_class(np.arange(12))]
+
+# semitones to transpose a song up by so that its tonic becomes A
+TRANSPOSE_TO_A = (9 - KEY_TONICS) % 12
+
+# Krumhansl-Kessler probe-tone profiles, from the tonic up
+KRUMHANSL_MAJOR = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+KRUMHANSL_MINOR = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+# profile of every key indexed by pitch class, standardized so that a matrix
+# product with standardized histograms gives Pearson correlations:
+# KEY_PROFILES[key, pitch_class]
+_profiles = np.stack([
+    np.roll(KRUMHANSL_MINOR if mode else KRUMHANSL_MAJOR, tonic)
+    for tonic, mode in zip(KEY_TONICS, KEY_MODES)])
+KEY_PROFILES = ((_profiles - _profiles.mean(axis=1, keepdims=True))
+                / _profiles.std(axis=1, keepdims=True))
+
+for _table in (KEY_TONICS, KEY_MODES, SCALE_DEGREES, ROLL_SCALE_DEGREES, TRANSPOSE_TO_A,
+               KRUMHANSL_MAJOR, KRUMHANSL_MINOR, KEY_PROFILES):
+    _table.setflags(write=False)
+
+
+def pitch_class(name):
+    """
+    Returns:
+        pitch_class (int): pitch class of a note name like 'C#', 'B-' or 'E#',
+            with C = 0
+    """
+    return (_LETTER_PITCH_CLASSES[name[0].upper()]
+            + name.count('#') - name.count('-')) % 12
+
+
+def key_index(tonic, mode='major'):
+    """
+    Args:
+        tonic (str or int): name or pitch class of the key's tonic
+        mode (str): 'major' or 'minor'
+
+    Returns:
+        key (int): index of the key in the lookup tables
+    """
+    if isinstance(tonic, str):
+        tonic = pitch_class(tonic)
+    return int(tonic) % 12 + 12 * MODES.index(mode)
+
+
+def music21_key_index(key):
+    """
+    Returns:
+        key (int): index of a `music21.key.Key` in the lookup tables
+    """
+    return key_index(key.tonic.name, key.mode)
+
+
+def transpose_to_a(midi, key):
+    """
+    Transposes MIDI note numbers up so that the tonic of `key` becomes A, like
+    `music21.stream.Stream.transpose` with the number of semitones in
+    `TRANSPOSE_TO_A`.
+    Args:
+        midi (np.ndarray): MIDI note numbers
+        key (int or np.ndarray): key index, or one per note
+
+    Returns:
+        midi (np.ndarray): transposed MIDI note numbers
+    """
+    return np.asarray(midi) + TRANSPOSE_TO_A[key]
+
+
+def pitch_class_histograms(songs, durations=None):
+    """
+    Builds duration-weighted pitch-class histograms for a batch of songs with a
+    single `np.bincount` over all of their notes.
+    Args:
+        songs (list[np.ndarray]): piano roll integers of the notes of each
+            song. Negative integers, for notes outside of the piano roll, are
+            left out.
+        durations (list[np.ndarray]): duration of each note, in any unit. Every
+            note counts once if None.
+
+    Returns:
+        histograms (np.ndarray): array of shape (songs, 12), indexed by pitch
+            class with C = 0
+    """
+    lengths = np.array([len(notes) for notes in songs])
+    if not lengths.sum():
+        return np.zeros((len(songs), 12))
+    note_ints = np.concatenate(songs).astype(int)
+    bins = np.repeat(12 * np.arange(len(songs)), lengths) + roll_index_to_pitch_class(note_ints)
+    weights = None if durations is None else np.concatenate(durations).astype(float)
+    # leave out notes that are outside of the piano roll
+    in_roll = note_ints >= 0
+    bins = bins[in_roll]
+    if weights is not None:
+        weights = weights[in_roll]
+    return np.bincount(bins, weights=weights, minlength=12 * len(songs)).reshape(-1, 12)
+
+
+def detect_keys(histograms):
+    """
+    Estimates the key of each pitch-class histogram by correlating it with the
+    Krumhansl-Kessler profiles of all 24 keys in one matrix product, like
+    music21's `analyze('key.krumhanslkessler')` does one song at a time.
+    music21's default `analyze('key')` weights with Aarden-Essen profiles
+    instead, so it disagrees on some songs.
+    Args:
+        histograms (np.ndarray): array of shape (songs, 12) or (12,)
+
+    Returns:
+        keys (np.ndarray or int): index of the best correlated key per
+            histogram. Songs without notes get C major.
+        correlations (np.ndarray): array of shape (songs, 24) or (24,) of the
+            correlation with every key
+    """
+    histograms = np.asarray(histograms, dtype=float)
+    centered = histograms - histograms.mean(axis=-1, keepdims=True)
+    std = centered.std(axis=-1, keepdims=True)
+    standardized = np.divide(centered, std, out=np.zeros_like(centered), where=std > 0)
+    correlations = standardized @ KEY_PROFILES.T / 12
+    keys = correlations.argmax(axis=-1)
+    if keys.ndim == 0:
+        keys = int(keys)
+    return keys, correlations
+
+
+def detect_key(note_ints, durations=None):
+    """
+    Returns:
+        key (int): key index of a single song given the piano roll integers
+            and optional durations of its notes, see `detect_keys`
+    """
+    histograms = pitch_class_histograms(
+        [note_ints], None if durations is None else [durations])
+    keys, _ = detect_keys(histograms)
+    return int(keys[0])
@@ -1,23 +1,31 @@
 from abc import ABC, abstractmethod
 from datetime import datetime
-import fractions
-import glob
 from itertools import islice
 from itertools import islice
 import h5py
 import math
-import music21 as m21
 import numpy as np
 import os
 import random
-import ipdb
-
-from keras.callbacks import ModelCheckpoint, TensorBoard
-from keras.layers import Dense, TimeDistributed, Dropout, CuDNNLSTM, Activation, LSTM
-from keras.models import Sequential
+import time
+
+from keras.callbacks import Callback, ModelCheckpoint, TensorBoard
+from keras.layers import Dense, TimeDistributed, Dropout, CuDNNLSTM, Activation, LSTM, Embedding, \
+    Input, Lambda
+from keras.models import Model
+from keras.optimizers import RMSprop
+from keras import backend as K
 from keras.utils import Sequence
 from tensorflow.contrib.training import HParams
 
+# local imports
+from datastore import DEFAULT_LAYOUT, as_datastore, read_steps, song_length
+from dedup import near_duplicate_clusters
+import ingest
+from ingest import discover_songs, grid_spacing, transcribed_songs
+from piano_roll import build_piano_roll
+from profiling import count, profiled, stage
+
 
 def main():
     hparams = {
@@ -34,7 +42,6 @@ def main():
     tunator_lstm.build_model()
     tunator_lstm.train()
     tunator_lstm.compose(128)
-    ipdb.set_trace()
 
 
 class TunatorLSTM:
@@ -54,57 +61,94 @@ class TunatorLSTM:
 
     Args:
         midi_dir (str): directory to MIDI files
-        hdf5_path (str): path for HDF5 datastore
+        hdf5_path (str): path for HDF5 datastore, or the `.json` manifest of a
+            sharded datastore, see `datastore.Datastore`
         hparams (dict): any hyperparameters to be changed from defaults.
             Defaults are shown under `hparams` property. They can also be
             changed dynamically by passing a dict to the `hparams` setter.
+        dataset (TunatorDataset): already prepared dataset to train on. When
+            given, `midi_dir` is not scanned, the datastore is not updated and
+            the dataset's song split is reused. Useful for sharing one dataset
+            across many models, e.g. hyperparameter tuning trials.
+        grid (str or float): grid that note onsets of new songs are quantized
+            to, either a name in `GRIDS` such as '1/8' or '1/8t' for eighth
+            note triplets, or a spacing in quarter notes
+        rests (bool): whether new songs get empty timesteps for the grid
+            positions without notes, rather than only their occupied timesteps
+        layout (dict): storage layout of the notes of new songs, see
+            `datastore.named_layouts` and `datastore.DEFAULT_LAYOUT`
+        worker (tuple[int]): index and count of parallel workers sharing a
+            sharded datastore. The worker only ingests and trains on the songs
+            of its own shards.
+        dedup_threshold (float): similarity at which near-duplicate songs are
+            clustered and kept on one side of the train/validation split, see
+            `TunatorDataset`
+        dedup_representatives (bool): whether to train and validate only on
+            the longest song of each near-duplicate cluster. Requires
+            `dedup_threshold`.
+        seed (int): seed of the train/validation split, so that separate runs
+            train and validate on the same songs
+        scan_midi (bool): whether to scan `midi_dir` and add its missing songs
+            to the datastore. Otherwise only the songs already stored are
+            used, e.g. to compose from a trained model.
     """
-    def __init__(self, midi_dir='music/midi/final_fantasy/', hdf5_path='data/songs.hdf5', hparams=None):
+    def __init__(self, midi_dir='music/midi/final_fantasy/', hdf5_path='data/songs.hdf5', hparams=None, dataset=None,
+                 grid='1/8', rests=False, layout=DEFAULT_LAYOUT, worker=None, dedup_threshold=None,
+                 dedup_representatives=False, seed=None, scan_midi=True):
         self.midi_dir = midi_dir
         self.hdf5_path = hdf5_path
+        self.datastore = as_datastore(hdf5_path)
+        if worker is not None:
+            self.datastore = self.datastore.subset(*worker)
         self._hparams = hparams
+        self.grid = grid_spacing(grid)
+        self.rests = rests
+        self.layout = layout
 
         # set up piano roll
-        octaves = 10
-        scale = ['A', 'B', 'C', 'D', 'E', 'F', 'G']
-        sharps = ['A#', 'C#', 'D#', 'F#', 'G#']
-        flats = ['B-', 'D-', 'E-', 'G-', 'A-']
-        sharps_scale = sorted(scale + sharps)
-        sharps_oct = [note + str(i) for i in range(octaves) for note in sharps]
-        flats_oct = [note + str(i) for i in range(octaves) for note in flats]
-        flat_sharp_dict = dict(zip(flats_oct, sharps_oct))
-        self.piano_roll = [
-            note + str(i) for i in range(octaves) for note in sharps_scale]
-        self.piano_roll_dict = {
-            note: i for i, note in enumerate(self.piano_roll)}
-        self.piano_roll_dict.update(
-            {flat: self.piano_roll_dict[sharp]
-             for flat, sharp in flat_sharp_dict.items()})
+        self.piano_roll, self.piano_roll_dict = build_piano_roll()
 
         # prepare data
-        self.song_file_dict = self.get_song_file_dict()
-        songs = list(self.song_file_dict)
-        random.shuffle(songs)
-        split = int(.8 * len(songs))
-        self.train_songs = songs[:split]
-        self.val_songs = songs[split:]
-        self.update_datastore()
+        if dataset is None:
+            if scan_midi:
+                self.song_file_dict = self.get_song_file_dict()
+                self.update_datastore()
+            else:
+                self.song_file_dict = {song: attrs.get('file') for song, attrs
+                                       in self.datastore.songs().items()}
+            # include songs transcribed from audio by preprocessing/transcription.py
+            self.song_file_dict.update(self.get_transcribed_song_dict())
+            dataset = TunatorDataset(self.song_file_dict, self.datastore, seed=seed,
+                                     dedup_threshold=dedup_threshold,
+                                     representatives=dedup_representatives)
+        else:
+            self.song_file_dict = dataset.song_file_dict
+        self.dataset = dataset
+        self.initial_epoch = 0
+        self.train_songs = dataset.train_songs
+        self.val_songs = dataset.val_songs
 
         # instantiate tensor generators for lazy evaluation during training
         self.train_tensor_gen = NoteChordOneHotTensorGen(
             self.train_songs,
             self.hparams.batch_size,
             self.hparams.timesteps,
-            hdf5_path,
+            dataset.datastore,
             self.piano_roll_dict,
-            self.n_vocab)
+            self.n_vocab,
+            dataset=dataset,
+            input_mode=self.hparams.input_mode,
+            max_polyphony=self.hparams.max_polyphony)
         self.val_tensor_gen = NoteChordOneHotTensorGen(
             self.val_songs,
             self.hparams.batch_size,
             self.hparams.timesteps,
-            hdf5_path,
+            dataset.datastore,
             self.piano_roll_dict,
-            self.n_vocab)
+            self.n_vocab,
+            dataset=dataset,
+            input_mode=self.hparams.input_mode,
+            max_polyphony=self.hparams.max_polyphony)
 
     @property
     def hparams(self):
@@ -116,6 +160,14 @@ class TunatorLSTM:
             'batch_size': 32,
             'timesteps': 256,
             'epochs': 3,
+            # 'multi_hot' feeds (timesteps, n_vocab) piano roll vectors, 'index'
+            # feeds (timesteps, max_polyphony) padded piano roll integers that
+            # are embedded and summed by the first layer. `embedding_dim` has to
+            # stay well below `n_vocab` (120) for the first LSTM's input matmul
+            # to shrink compared to 'multi_hot'.
+            'input_mode': 'multi_hot',
+            'max_polyphony': 8,
+            'embedding_dim': 48,
         }
 
         if isinstance(self._hparams, HParams):
@@ -135,10 +187,12 @@ class TunatorLSTM:
 
     @hparams.setter
     def hparams(self, values):
-        if not isinstance(self._hparams, HParams):
-            self._hparams = HParams()
+        hparams = self.hparams
         for k, v in values.items():
-            self._hparams.add_hparam(k, v)
+            if k in hparams.values():
+                hparams.set_hparam(k, v)
+            else:
+                hparams.add_hparam(k, v)
 
     @property
     def n_vocab(self):
@@ -150,34 +204,45 @@ class TunatorLSTM:
 
     def build_model(self):
         """
-
-        Returns:
-
+        Builds and compiles the model for the `input_mode` hyperparameter. In
+        'index' mode the first layer looks up a learned embedding for each
+        active pitch of a timestep and sums them, which is equivalent to
+        multiplying the multi-hot vector by the embedding matrix without ever
+        building it. The first LSTM's input matmul then has `embedding_dim`
+        rather than `n_vocab` rows, so 'index' mode only saves compute with an
+        `embedding_dim` well below `n_vocab`. Both modes output multi-hot piano
+        roll vectors.
         """
-        self.model = Sequential()
-        input_shape = (None, self.n_vocab)
+        if self.hparams.input_mode == 'index':
+            inputs = Input(shape=(None, self.hparams.max_polyphony), dtype='int8')
+            # index 0 is padding, pitch i is index i + 1
+            embedded = Embedding(self.n_vocab + 1, self.hparams.embedding_dim)(inputs)
+            x = Lambda(_sum_active_embeddings)([embedded, inputs])
+        elif self.hparams.input_mode == 'multi_hot':
+            inputs = Input(shape=(None, self.n_vocab))
+            x = inputs
+        else:
+            raise ValueError(f'unknown input_mode: {self.hparams.input_mode}')
 
-        self.model.add(CuDNNLSTM(
-            self.hparams.lstm_units,
-            input_shape=input_shape,
-            return_sequences=True,
-        ))
-        self.model.add(Dropout(self.hparams.dropout))
+        x = CuDNNLSTM(self.hparams.lstm_units, return_sequences=True)(x)
+        x = Dropout(self.hparams.dropout)(x)
 
-        self.model.add(CuDNNLSTM(self.hparams.lstm_units, return_sequences=True))
-        self.model.add(Dropout(self.hparams.dropout))
+        x = CuDNNLSTM(self.hparams.lstm_units, return_sequences=True)(x)
+        x = Dropout(self.hparams.dropout)(x)
 
-        self.model.add(CuDNNLSTM(self.hparams.lstm_units, return_sequences=True))
-        self.model.add(Dropout(self.hparams.dropout))
+        x = CuDNNLSTM(self.hparams.lstm_units, return_sequences=True)(x)
+        x = Dropout(self.hparams.dropout)(x)
 
-        self.model.add(TimeDistributed(Dense(self.n_vocab)))
-        self.model.add(Dropout(self.hparams.dropout))
+        x = TimeDistributed(Dense(self.n_vocab))(x)
+        x = Dropout(self.hparams.dropout)(x)
 
-        self.model.add(TimeDistributed(Dense(self.n_vocab)))
-        self.model.add(Dropout(self.hparams.dropout))
+        x = TimeDistributed(Dense(self.n_vocab))(x)
+        x = Dropout(self.hparams.dropout)(x)
 
-        self.model.add(TimeDistributed(Activation('sigmoid')))
-        self.model.compile(loss='binary_crossentropy', optimizer='rmsprop')
+        outputs = TimeDistributed(Activation('sigmoid'))(x)
+        self.model = Model(inputs=inputs, outputs=outputs)
+        optimizer = RMSprop(lr=self.hparams.learning_rate)
+        self.model.compile(loss='binary_crossentropy', optimizer=optimizer)
 
     def load_model(self, model_path):
         """
@@ -191,25 +256,61 @@ class TunatorLSTM:
         self.build_model()
         self.model.load_weights(model_path)
 
-    def train(self):
+    def save_state(self, path):
         """
+        Saves the model weights to `<path>.hdf5` and the optimizer state to
+        `<path>-optimizer.npz`, so that training can be resumed from them by
+        another model with the same architecture.
+        Args:
+            path (str): path prefix for the saved files
+        """
+        self.model.save_weights(f'{path}.hdf5')
+        np.savez(f'{path}-optimizer.npz', *self.model.optimizer.get_weights())
 
-        Returns:
+    def load_state(self, path):
+        """
+        Loads model weights and optimizer state saved by `save_state`. The
+        learning rate is taken from the current hparams rather than the saved
+        state.
+        Args:
+            path (str): path prefix of the saved files
+        """
+        self.model.load_weights(f'{path}.hdf5')
+        with np.load(f'{path}-optimizer.npz') as f:
+            optimizer_weights = [f[f'arr_{i}'] for i in range(len(f.files))]
+        # optimizer weights are only created along with the training function
+        self.model._make_train_function()
+        self.model.optimizer.set_weights(optimizer_weights)
+        K.set_value(self.model.optimizer.lr, self.hparams.learning_rate)
+
+    def train(self, time_budget=None, epochs=None):
+        """
+        Trains the model on the training songs, validating on a fixed slice of
+        the validation songs. Weights are checkpointed to
+        `checkpoints/<log_name>/` whenever the validation loss improves (the
+        training loss if there is no validation data), and the path to the
+        best checkpoint is kept in `checkpoint_path`, so it holds the weights
+        that scored `val_loss`. The wall-clock
+        training time is kept in `train_time` and the best validation loss in
+        `val_loss`.
+        Args:
+            time_budget (float): seconds after which training is stopped early,
+                at the end of the current batch. If the budget runs out before
+                an epoch completes, `val_loss` is evaluated on the current
+                weights.
+            epochs (int): number of epochs to train for. Defaults to the
+                `epochs` hparam. Repeated calls continue the epoch count from
+                where the previous call stopped.
 
+        Returns:
+            history (keras.callbacks.History): training history
         """
+        start = time.time()
+        if epochs is None:
+            epochs = self.hparams.epochs
         timestamp = datetime.now()
         log_name = f'note-chord-one-hot-songs_{timestamp}'
         tensorboard = TensorBoard(log_dir=f'logs/{log_name}', histogram_freq=1, write_graph=True, write_grads=True, batch_size=4) #write_images
-        # if adding embeddings, add those parameters
-        checkpoint_name = 'weights-improvement-epoch_{epoch:02d}-loss_{loss:.4f}.hdf5'
-        checkpoint = ModelCheckpoint(
-            f'checkpoints/{checkpoint_name}',
-            monitor='loss',
-            verbose=0,
-            save_best_only=True,
-            mode='min'
-        )
-
         val_slice = list(islice(self.val_tensor_gen, 10))
         X_val_list = list()
         Y_val_list = list()
@@ -221,39 +322,85 @@ class TunatorLSTM:
         Y_val = np.concatenate(Y_val_list, axis=0)
         del Y_val_list
         val_data = (X_val, Y_val)
-        self.model.fit_generator(
+
+        # checkpoint on the same loss that is reported as `val_loss`
+        monitor = 'val_loss' if len(X_val) else 'loss'
+        # if adding embeddings, add those parameters
+        checkpoint_name = f'weights-improvement-epoch_{{epoch:02d}}-{monitor}_{{{monitor}:.4f}}.hdf5'
+        checkpoint_dir = f'checkpoints/{log_name}'
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        checkpoint = ModelCheckpoint(
+            f'{checkpoint_dir}/{checkpoint_name}',
+            monitor=monitor,
+            verbose=0,
+            save_best_only=True,
+            mode='min'
+        )
+        callbacks = [checkpoint, tensorboard]
+        budget = None
+        if time_budget is not None:
+            budget = TimeBudget(time_budget)
+            callbacks.append(budget)
+        history = self.model.fit_generator(
             self.train_tensor_gen,
             validation_data=val_data,
             # validation_steps=10,
             steps_per_epoch=self.train_tensor_gen.n_batches,
-            epochs=self.hparams.epochs,
-            callbacks=[checkpoint, tensorboard]
+            epochs=self.initial_epoch + epochs,
+            initial_epoch=self.initial_epoch,
+            callbacks=callbacks
         )
+        self.initial_epoch += len(history.epoch)
+
+        losses = history.history.get(monitor, [])
+        if losses:
+            best_epoch = int(np.argmin(losses))
+            self.checkpoint_path = f'{checkpoint_dir}/{checkpoint_name}'.format(
+                epoch=history.epoch[best_epoch] + 1, **{monitor: losses[best_epoch]})
+        else:
+            self.checkpoint_path = None
+        val_losses = history.history.get('val_loss', [])
+        if val_losses:
+            self.val_loss = min(val_losses)
+        else:
+            self.val_loss = self.model.evaluate(X_val, Y_val, verbose=0)
+        self.stopped_early = budget is not None and budget.stopped_early
+        self.train_time = time.time() - start
+        return history
 
     def get_song_file_dict(self):
         """
         Creates a lookup dictionary to get filepath from song name.
+
+        MIDI files are found recursively under `midi_dir` and named after their
+        path relative to it, see `discovery.song_name`, so songs in nested
+        directories don't collide. The listing is cached in a manifest next to
+        the datastore, so only directories that changed since the last run
+        are rescanned.
         Returns:
             song_file_dict (dict): Dictionary with song names as keys and
                 filepaths relative to the current directory as values, including
                 file extension.
         """
-        file_exts = ('*.mid', '*.midi', '*.MID', '*.MIDI')
-        song_files = list()
-        for ext in file_exts:
-            song_files += glob.glob(os.path.join(self.midi_dir, ext))
-        get_song_name = lambda x: os.path.splitext(os.path.basename(x))[0]
-        song_names = [get_song_name(file) for file in song_files]
-        # dict to look up filepath by song name
-        song_file_dict = dict(zip(song_names, song_files))
-        return song_file_dict
+        return discover_songs(self.midi_dir, self.hdf5_path)
+
+    def get_transcribed_song_dict(self):
+        """
+        Looks up the songs in the datastore that were transcribed from audio
+        rather than parsed from MIDI files.
+        Returns:
+            song_file_dict (dict): song names and the audio filepaths they were
+                transcribed from
+        """
+        return transcribed_songs(self.datastore)
 
     def query_datastore(self, query, grp_path='songs'):
         """
         Checks datastore at `hdf5_path` for keys specified by `query` within the
-        group specified by `grp_path` non-recursively. If the datastore does not
-        exist, the query will not raise an error, but instead return all of the
-        queried items in `not_found` and none of them in `found`.
+        group specified by `grp_path` non-recursively. Each key is looked up in
+        the shard it is assigned to. If the datastore or shard does not exist,
+        the query will not raise an error, but instead return the queried
+        items in `not_found` and none of them in `found`.
         Args:
             query (iterable): keys for which to search within the grp_path in
                 the datastore
@@ -264,204 +411,69 @@ class TunatorLSTM:
             not_found (set): query items that were not found in the group
         """
         # TODO: what about querying the base group?
-        if os.path.isfile(self.hdf5_path):
-            grp = h5py.File(self.hdf5_path, 'r')[grp_path]
-            keys = list(grp.keys())
-        else:
-            keys = list()
-
-        found = set(query).intersection(keys)
-        not_found = set(query) - set(found)
-        return found, not_found
+        return self.datastore.query(query, grp_path)
 
     def update_datastore(self):
         """
         Updates HDF5 datastore with note sequences for any songs in midi_dir
-        that are not already present in the datastore.
-        """
-        def _parse_midi(song):
-            """
-            The songs are transposed to the key of A. The parser extracts
-            the lowest numbered part that has greater than 50 notes. If that
-            doesn't work, it flattens all of the parts into a single "flat" part
-            which contains all the instruments.
-            Args:
-                song:
-
-            Returns:
-
-            """
-            # TODO: convert output to namedtuples with metadata
-            file = self.song_file_dict[song]
-            print(f'updating datastore: {file}...')
-            midi = m21.converter.parse(file)
-
-            # transpose to A
-            transpose_dict ={
-                'A#': 11, 'B-': 11, 'B': 10, 'C': 9, 'C#': 8, 'D-': 8, 'D': 7,
-                'D#': 6, 'E-': 6, 'E': 5, 'F': 4, 'F#': 3,'G-': 3, 'G': 2,
-                'G#': 1, 'A-': 1, 'A': 0,
-            }
-            key = midi.analyze('key').getTonic().name
-            midi = midi.transpose(transpose_dict[key])
-            # extract piano, or other
-            try:
-                midi_parts = m21.instrument.partitionByInstrument(midi).parts
-                part = midi_parts[0]
-                if not part.partName == 'Piano':
-                    pass
-                notes_to_parse = part.recurse().notes
-                part_i = 0
-                while len(notes_to_parse) < 50:
-                    part_i += 1
-                    part = midi_parts[part_i]
-                    notes_to_parse = part.recurse().notes
-
-            except Exception:  # file has notes in a flat structure
-                notes_to_parse = midi.flat.chordify().notes
-
-            return notes_to_parse
-
-        def _parse_notes(notes_to_parse):
-            """
-            Parse MIDI data to a dictionary of timesteps and corresponding
-            notes.
-            """
-            notes = dict()
-            for elem in notes_to_parse:
-                time = elem.offset
-                
-                # TODO: remove after time fix
-                if time % 0.5 != 0:
-                    continue
-                
-                if time not in notes:
-                    notes[time] = set()
-
-                if isinstance(elem, m21.note.Note):
-                    note_int = self.piano_roll_dict[str(elem.pitch)]
-                    notes[time].add(note_int)
-                elif isinstance(elem, m21.chord.Chord):
-                    note_ints = [self.piano_roll_dict[str(pitch)] for pitch in elem.pitches]
-                    notes[time].update(note_ints)
-                else:
-                    raise ValueError()
-
-            # TODO: SongMap slicable hashmap class
-            # correct fractional indices
-            frac_notes = {k: v for k, v in notes.items() if isinstance(k, fractions.Fraction)}
-            for k, v in frac_notes.items():
-                del notes[k]
-                nearest_quarter = round(k * 4) / 4
-                if nearest_quarter in notes:
-                    notes[nearest_quarter].update(v)
-                else:
-                    notes[nearest_quarter] = v
-
-            # fill missing time indices
-            # temporarily remove because only rests were generated
-            
-            time_list = sorted(notes)
-            if not time_list:
-                raise ValueError()
-            end_time = max(time_list)
-            min_space = min([j - i for i, j in zip(time_list[:-1], time_list[1:])])
-            """
-            expected_times = np.array(range(int(end_time / min_space))) * min_space
-            missing_times = set(expected_times) - set(time_list)
-            if missing_times:
-                print(f'filling in {len(missing_times)} missing timepoints in '
-                      f'existing {len(notes)}...')
-                notes.update({time: set() for time in missing_times})
-            """
-            # convert to half notes
-
-            # convert notes to a list of strings
-            #str_notes = ['.'.join(sorted(notes[k])) for k in sorted(notes)]
-            # remove leading and trailing rests
-            #for i in (0, -1):
-            #    while str_notes and str_notes[i] == '':
-            #        str_notes.pop(i)
-            # encoding required by h5py
-            #str_notes = np.array(str_notes).astype('|S9')
-
-            #vocab = np.array(list(set(str_notes))).astype('|S9')
-            return notes, min_space
-
-        def _write_to_datastore(notes, min_space):
-            """
-            Write a sequence of piano roll integers to HDF5 datastore.
-            Args:
-                notes (np.array):
-                min_space (float):
-
-            Returns:
-
-            """
-            notes_list = np.array([np.array(list(notes[k])).astype('i8') for k in sorted(notes)])
-            with h5py.File(self.hdf5_path, 'a') as f:
-                grp = f.create_group(f'songs/{song}')
-                dt = h5py.special_dtype(vlen=np.dtype('int8'))
-                dset_notes = grp.create_dataset(
-                    name='notes',
-                    shape=(len(notes_list), 1),
-                    data=notes_list,
-                    dtype=dt)
-                dset_notes.attrs['spacing'] = min_space
-
-        song_names = set(self.song_file_dict)
-        _, missing_songs = self.query_datastore(song_names)
-
-        for song in missing_songs:
-            notes_to_parse = _parse_midi(song)
-            notes, min_space = _parse_notes(notes_to_parse)
-            _write_to_datastore(notes, min_space)
-
-    def compose(self, timesteps):
+        that are not already present in the datastore, see
+        `ingest.update_datastore`. With a sharded datastore, only the songs of
+        this instance's shards are added, so workers owning different shards
+        can ingest in parallel.
+        """
+        ingest.update_datastore(self.datastore, self.song_file_dict, grid=self.grid, rests=self.rests,
+                                layout=self.layout)
+
+    def compose(self, timesteps, output_path=None):
         """
         Generate MIDI file of length `timesteps` starting from a random seed
         note from a song in the datastore.
         Args:
             timesteps (int): number to timesteps to synthesize
+            output_path (str): MIDI file to write, see `_output_midi`
 
         Returns:
-
+            Y_hat_strs (list[list[str]]): piano roll names of the notes of
+                every timestep
         """
         seed_note = np.array([])
+        song_names = list(self.datastore.songs())
         while seed_note.size == 0:
-            with h5py.File(self.hdf5_path) as f:
-                grp = f['songs']
-                song_names = list(grp.keys())
-                song_idx = np.random.randint(0, len(song_names))
-                song = grp[song_names[song_idx]]['notes']
-                note_idx = np.random.randint(0, len(song))
-                seed_note = song[note_idx][0]
+            song_name = song_names[np.random.randint(0, len(song_names))]
+            with h5py.File(self.datastore.path_of(song_name), 'r') as f:
+                grp = f[f'songs/{song_name}']
+                note_idx = np.random.randint(0, song_length(grp))
+                seed_note = read_steps(grp, note_idx, note_idx + 1)[0]
         
-        x = np.zeros(self.n_vocab)
-        x[seed_note] = 1
+        x = self.train_tensor_gen.build_inputs([seed_note])
 
         # generate notes
         Y_hat_inds_seq = []
         for i in range(timesteps):
             x = np.expand_dims(x, axis=0)
-            x = np.expand_dims(x, axis=0)
-            y_hat = self.model.predict(x)
+            with stage('predict'):
+                y_hat = self.model.predict(x)[0, -1]
             y_hat_inds = np.argwhere(y_hat > .5).flatten()
             if y_hat_inds.size == 0:
                 y_hat_inds = np.argmax(y_hat).flatten()
             Y_hat_inds_seq.append(y_hat_inds)
-            x = np.zeros(self.n_vocab)
-            x[y_hat_inds] = 1
-        
-        ipdb.set_trace()
+            x = self.train_tensor_gen.build_inputs([y_hat_inds])
+
         rev_piano_roll_dict = {v: k for k, v in self.piano_roll_dict.items()}
         Y_hat_strs = [[rev_piano_roll_dict[ind] for ind in Y_hat_inds] for Y_hat_inds in Y_hat_inds_seq]
 
-        self._output_midi(Y_hat_strs)
+        self._output_midi(Y_hat_strs, output_path)
 
         return Y_hat_strs
 
-    def _output_midi(self, Y_hat_strs):
+    @profiled('output_midi')
+    def _output_midi(self, Y_hat_strs, output_path=None):
+        """
+        Writes composed timesteps to a MIDI file at `output_path`, by default
+        `test_output-<timesteps>-<timestamp>.mid` in the current directory.
+        """
+        import music21 as m21
+
         timesteps = len(Y_hat_strs)
         offset = 0
         output_notes = []
@@ -490,18 +502,212 @@ class TunatorLSTM:
             offset += 1
 
         midi = m21.stream.Stream(output_notes)
-        midi.write('midi', fp=f'test_output-{timesteps}-{self.timestamp}.mid')
+        if output_path is None:
+            output_path = f'test_output-{timesteps}-{self.timestamp}.mid'
+        midi.write('midi', fp=output_path)
 
 
-class SongMap:
-    def __init__(self):
-        pass
+def _sum_active_embeddings(tensors):
+    """
+    Sums the embeddings of the non-padding indices of every timestep.
+    Args:
+        tensors (list): embeddings of shape (batch, timesteps, max_polyphony,
+            embedding_dim) and the indices they were looked up for
 
-    def __getitem__(self, item):
-        pass
+    Returns:
+        summed (tensor): tensor of shape (batch, timesteps, embedding_dim)
+    """
+    embedded, indices = tensors
+    active = K.cast(K.not_equal(indices, 0), K.floatx())
+    return K.sum(embedded * K.expand_dims(active, axis=-1), axis=2)
 
-    def __setitem__(self, key, value):
-        pass
+
+def shared_dataset(midi_dir, hdf5_path, seed=None, in_memory=True, layout=DEFAULT_LAYOUT, **kwargs):
+    """
+    Builds a `TunatorDataset` for many models to share, e.g. the trials of a
+    hyperparameter search, without setting up a model for it. `midi_dir` is
+    scanned and the datastore brought up to date once, like `TunatorLSTM`
+    does, and songs transcribed from audio are included.
+    Args:
+        midi_dir (str): directory to MIDI files
+        hdf5_path (str or Datastore): datastore of the songs
+        seed (int): seed of the train/validation split
+        in_memory (bool): whether to read all note sequences into memory
+        layout (dict): storage layout of the notes of new songs, see
+            `datastore.DEFAULT_LAYOUT`
+        kwargs: further `TunatorDataset` arguments
+
+    Returns:
+        dataset (TunatorDataset): the dataset
+    """
+    datastore = as_datastore(hdf5_path)
+    song_file_dict = discover_songs(midi_dir, datastore.path)
+    ingest.update_datastore(datastore, song_file_dict, layout=layout)
+    song_file_dict.update(transcribed_songs(datastore))
+    return TunatorDataset(song_file_dict, datastore, seed=seed, in_memory=in_memory, **kwargs)
+
+
+def song_lengths(datastore, songs):
+    """
+    Reads the number of timesteps of `songs`, opening each shard once.
+    Returns:
+        song_lengths (dict): song names and lengths, without songs missing
+            from the datastore
+    """
+    lengths = dict()
+    for path, shard_songs in datastore.by_shard(songs).items():
+        if not os.path.isfile(path):
+            for song in shard_songs:
+                print(f'song: {song} missing from datastore')
+            continue
+        with h5py.File(path, 'r') as f:
+            for song in shard_songs:
+                try:
+                    grp = f[f'songs/{song}']
+                except KeyError:
+                    print(f'song: {song} missing from datastore')
+                    continue
+                lengths[song] = song_length(grp)
+    return lengths
+
+
+class TimeBudget(Callback):
+    """
+    Keras callback that stops training at the end of the first batch after
+    `budget` seconds have passed since training began.
+    """
+    def __init__(self, budget):
+        super().__init__()
+        self.budget = budget
+        self.stopped_early = False
+
+    def on_train_begin(self, logs=None):
+        self._start = time.time()
+
+    def on_batch_end(self, batch, logs=None):
+        if time.time() - self._start > self.budget:
+            self.stopped_early = True
+            self.model.stop_training = True
+
+
+class TunatorDataset:
+    """
+    Song list, train/validation split and sample index for a datastore,
+    prepared once and shared by every model trained on it. Song lengths are
+    read from the datastore when the dataset is created, so building the
+    sample windows for a new `timesteps` value does not touch the HDF5 file,
+    and the windows for each (songs, timesteps) pair are only built once.
+
+    Args:
+        song_file_dict (dict): song names and their MIDI filepaths, as returned
+            by `TunatorLSTM.get_song_file_dict`
+        hdf5_path (str or Datastore): path to the HDF5 datastore holding the
+            songs, or to the manifest of a sharded datastore. Only the songs
+            of the datastore's shards are used.
+        val_split (float): fraction of songs held out for validation
+        seed (int): seed for the song split and sample shuffling
+        in_memory (bool): whether to read all of the note sequences into memory
+            up front so batches are built without HDF5 reads. They can also be
+            loaded later with `load`.
+        worker (tuple[int]): index and count of data-parallel workers. The
+            dataset is restricted to this worker's share of the shards.
+        dedup_threshold (float): when given, near-duplicate songs are
+            clustered with `dedup.near_duplicate_clusters` at this similarity
+            and every cluster is kept on one side of the train/validation split
+        representatives (bool): whether to keep only the longest song of each
+            near-duplicate cluster. Requires `dedup_threshold`.
+    """
+    def __init__(self, song_file_dict, hdf5_path, val_split=.2, seed=None, in_memory=False,
+                 worker=None, dedup_threshold=None, representatives=False):
+        self.song_file_dict = song_file_dict
+        self.datastore = as_datastore(hdf5_path)
+        if worker is not None:
+            self.datastore = self.datastore.subset(*worker)
+        self.hdf5_path = self.datastore.path
+        self._random = random.Random(seed)
+
+        songs = sorted(song for song in song_file_dict if self.datastore.owns(song))
+        self.song_lengths = song_lengths(self.datastore, songs)
+
+        # song names by cluster, each song its own cluster without dedup
+        if dedup_threshold is None:
+            self.clusters = {song: [song] for song in songs}
+        else:
+            self.clusters = dict()
+            for song, cluster in near_duplicate_clusters(self.datastore, songs,
+                                                         dedup_threshold).items():
+                self.clusters.setdefault(cluster, list()).append(song)
+        if representatives:
+            self.clusters = {cluster: [max(members, key=lambda song: self.song_lengths.get(song, 0))]
+                             for cluster, members in self.clusters.items()}
+
+        # split whole clusters so duplicates don't leak into validation
+        clusters = list(self.clusters.values())
+        self._random.shuffle(clusters)
+        n_train = int((1 - val_split) * sum(len(members) for members in clusters))
+        self.train_songs = list()
+        self.val_songs = list()
+        for members in clusters:
+            split_songs = self.train_songs if len(self.train_songs) < n_train else self.val_songs
+            split_songs.extend(members)
+
+        self.notes = None
+        self._seq_info_cache = dict()
+        if in_memory:
+            self.load()
+
+    def load(self):
+        """
+        Reads the note sequences of all songs in the dataset into `notes`.
+        """
+        notes = dict()
+        for path, songs in self.datastore.by_shard(self.song_lengths).items():
+            with h5py.File(path, 'r') as f:
+                for song in songs:
+                    notes[song] = read_steps(f[f'songs/{song}'])
+        self.notes = notes
+
+    def seq_info(self, songs, timesteps):
+        """
+        Sample windows of length `timesteps + 1` for `songs`, shuffled. The
+        result is cached, so models with the same `timesteps` share it.
+        Args:
+            songs (list): song names
+            timesteps (int): number of timesteps per sample
+
+        Returns:
+            seq_info (list): tuples of song name and (start, stop) slice, see
+                `NoteChordOneHotTensorGen.get_seq_info`
+        """
+        key = (tuple(songs), timesteps)
+        if key not in self._seq_info_cache:
+            seq_info = list()
+            for song in songs:
+                if song not in self.song_lengths:
+                    continue
+                n_seq = math.floor(self.song_lengths[song] / (timesteps + 1))
+                for i in range(n_seq):
+                    slice_ = (i * timesteps, (i + 1) * timesteps + 1)
+                    seq_info.append((song, slice_))
+            self._random.shuffle(seq_info)
+            self._seq_info_cache[key] = seq_info
+        return self._seq_info_cache[key]
+
+
+def _flatten_seq(seq):
+    """
+    Flattens a sequence of piano roll integer arrays.
+
+    Returns:
+        rows (np.ndarray): timestep of each note
+        cols (np.ndarray): position of each note within its timestep
+        pitches (np.ndarray): piano roll integer of each note
+    """
+    lengths = np.fromiter((len(notes) for notes in seq), dtype=int, count=len(seq))
+    pitches = np.concatenate(seq).astype(int) if lengths.sum() else np.zeros(0, dtype=int)
+    rows = np.repeat(np.arange(len(seq)), lengths)
+    cols = np.arange(len(pitches)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return rows, cols, pitches
 
 
 class TensorGen(ABC):
@@ -537,14 +743,25 @@ class NoteChordOneHotTensorGen(Sequence):
     on musical data. Data is read from HDF5 datasets and encoded to piano roll
     vectors. This class is intended to be used with the Keras `fit_generator`
     method.
+
+    With `input_mode='index'` the inputs are instead padded arrays of the
+    active piano roll integers of each timestep, shifted by one so that 0 is
+    padding, of dtype int8 and shape (batch, timesteps, max_polyphony). Only
+    the first `max_polyphony` notes of a timestep are kept. The targets are
+    multi-hot vectors in both modes.
     """
-    def __init__(self, songs, batch_size, timesteps, hdf5_path, vocab_dict, n_vocab):
+    def __init__(self, songs, batch_size, timesteps, hdf5_path, vocab_dict, n_vocab, dataset=None,
+                 input_mode='multi_hot', max_polyphony=8):
         self.songs = songs
         self.batch_size = batch_size
         self.timesteps = timesteps
-        self.hdf5_path = hdf5_path
+        self.datastore = as_datastore(hdf5_path)
+        self.hdf5_path = self.datastore.path
         self.vocab_dict = vocab_dict
         self.n_vocab = n_vocab
+        self.dataset = dataset
+        self.input_mode = input_mode
+        self.max_polyphony = max_polyphony
 
         self.batch_counter = 0
         self.epoch_counter = 0
@@ -560,26 +777,20 @@ class NoteChordOneHotTensorGen(Sequence):
 
         X_list = list()
         Y_list = list()
-        with h5py.File(self.hdf5_path, 'r') as f:
-            for info in batch_info:
-                name = info[0]
-                slice_ = info[1]
-                grp_song = f[f'songs/{name}/notes']
-                seq = grp_song[slice_[0]: slice_[1]].flatten()
-                X = self.build_vector(seq)
-                Y = X[1:]
-                X = X[:-1]
-                X_list.append(X)
-                Y_list.append(Y)
+        for seq in self.read_seqs(batch_info):
+            X_list.append(self.build_inputs(seq[:-1]))
+            Y_list.append(self.build_vector(seq[1:]))
 
         X_batch = np.array(X_list)
         Y_batch = np.array(Y_list)
         self.batch_counter += 1
-        assert X_batch.shape == Y_batch.shape
-        assert X_batch.shape == (self.batch_size, self.timesteps, self.n_vocab)
+        count('batches')
+        assert Y_batch.shape == (self.batch_size, self.timesteps, self.n_vocab)
+        assert X_batch.shape[:2] == Y_batch.shape[:2]
 
         return X_batch, Y_batch
 
+    @profiled('get_seq_info')
     def get_seq_info(self):
         """
         Builds a lookup dictionary for song samples. The integer keys are
@@ -596,38 +807,88 @@ class NoteChordOneHotTensorGen(Sequence):
                      ...
                      }
         """
+        if self.dataset is not None:
+            return self.dataset.seq_info(self.songs, self.timesteps)
+
         seq_info = list()
-        with h5py.File(self.hdf5_path, 'r') as f:
-            for song in self.songs:
-                try:
-                    grp = f[f'songs/{song}/notes']
-                except:
-                    print(f'song: {song} missing from datastore')
-                    continue
-                song_len = len(grp)
-                n_seq = math.floor(song_len / (self.timesteps + 1))
-                for i in range(n_seq):
-                    slice_ = (i * self.timesteps, (i + 1) * self.timesteps + 1)
-                    new_seq_info = (song, slice_)
-                    seq_info.append(new_seq_info)
+        for song, song_len in song_lengths(self.datastore, self.songs).items():
+            n_seq = math.floor(song_len / (self.timesteps + 1))
+            for i in range(n_seq):
+                slice_ = (i * self.timesteps, (i + 1) * self.timesteps + 1)
+                new_seq_info = (song, slice_)
+                seq_info.append(new_seq_info)
 
         random.shuffle(seq_info)
         return seq_info
 
+    def read_seqs(self, batch_info):
+        """
+        Reads the note sequences for a batch, from the dataset's in-memory notes
+        if they are loaded, otherwise from the datastore.
+        Args:
+            batch_info (list): tuples of song name and (start, stop) slice
+
+        Returns:
+            seqs (list[np.array]): piano roll integer arrays for each timestep
+        """
+        if self.dataset is not None and self.dataset.notes is not None:
+            return [self.dataset.notes[name][slice_[0]: slice_[1]]
+                    for name, slice_ in batch_info]
+
+        count('hdf5_windows_read', len(batch_info))
+        # only datastore reads are timed, in-memory slicing would skew the stage
+        with stage('read_seqs'):
+            # open each shard once per batch
+            seqs = [None] * len(batch_info)
+            shard_seqs = dict()
+            for i, (name, _) in enumerate(batch_info):
+                shard_seqs.setdefault(self.datastore.path_of(name), list()).append(i)
+            for path, seq_indices in shard_seqs.items():
+                with h5py.File(path, 'r') as f:
+                    for i in seq_indices:
+                        name, slice_ = batch_info[i]
+                        seqs[i] = read_steps(f[f'songs/{name}'], slice_[0], slice_[1])
+        return seqs
+
+    def build_inputs(self, seq):
+        """
+        Builds model inputs for a sequence of piano roll integer arrays,
+        according to `input_mode`.
+        """
+        if self.input_mode == 'index':
+            return self.build_indices(seq)
+        return self.build_vector(seq)
+
+    @profiled('build_vector')
     def build_vector(self, seq):
         """
         Build one- or multi-hot encoded vector on piano roll from piano roll
         integers
         Args:
-            seq:
+            seq (list[np.array]): piano roll integers of each timestep
 
         Returns:
+            X (np.array): array of shape (timesteps, n_vocab)
+        """
+        rows, _, pitches = _flatten_seq(seq)
+        X = np.zeros((len(seq), self.n_vocab))
+        X[rows, pitches] = 1
+        return X
 
+    def build_indices(self, seq):
+        """
+        Builds padded index arrays from piano roll integers
+        Args:
+            seq (list[np.array]): piano roll integers of each timestep
+
+        Returns:
+            X (np.array): int8 array of shape (timesteps, max_polyphony) of the
+                piano roll integers plus one, padded with 0
         """
-        # create a dictionary to map pitches to integers
-        X = np.array([np.zeros(self.n_vocab) for i in seq])
-        for i, event in enumerate(seq):
-            X[i][event] = 1
+        rows, cols, pitches = _flatten_seq(seq)
+        keep = cols < self.max_polyphony
+        X = np.zeros((len(seq), self.max_polyphony), dtype='i1')
+        X[rows[keep], cols[keep]] = pitches[keep] + 1
         return X
 
     def on_epoch_end(self):
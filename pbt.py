@@ -0,0 +1,254 @@
+import multiprocessing as mp
+import os
+import queue
+import random
+import traceback
+
+from keras import backend as K
+
+# local imports
+from lstm import TunatorLSTM, shared_dataset
+
+
+def main():
+    hparams = {
+        'learning_rate': 0.001,
+        'dropout': 0.2,
+        'lstm_units': 512,
+        'batch_size': 32,
+        'timesteps': 128,
+    }
+    dataset = shared_dataset('music/midi/final_fantasy/', 'data/songs.hdf5')
+    trainer = PopulationBasedTrainer(hparams, dataset, population_size=4, rounds=10)
+    best = trainer.run()
+    print(f'Best member:\n{best}')
+
+
+def perturb_learning_rate(value, rng):
+    return value * rng.choice((0.8, 1.2))
+
+
+def perturb_dropout(value, rng):
+    return min(max(value + rng.choice((-0.05, 0.05)), 0.0), 0.9)
+
+
+PERTURBATIONS = {
+    'learning_rate': perturb_learning_rate,
+    'dropout': perturb_dropout,
+}
+
+
+class WorkerError(RuntimeError):
+    """
+    Raised in the parent when a member's process failed, with the traceback
+    from the worker as its message.
+    """
+
+
+def _worker(worker_id, hparams, dataset, commands, results):
+    """
+    Process loop owning a single `TunatorLSTM`. Commands are read from the
+    `commands` queue as (name, args) tuples and answered on `results` with
+    (worker_id, value) tuples:
+        ('train', epochs): train for `epochs` more epochs, answers `val_loss`
+        ('save', path): save weights and optimizer state to `path`
+        ('load', (path, hparams)): adopt `hparams` and load the state at `path`
+        ('stop', None): exit the loop
+    Any exception ends the loop and is answered with a `WorkerError`, so the
+    parent doesn't wait for an answer that never comes.
+    """
+    try:
+        tunator = TunatorLSTM(hparams=hparams, dataset=dataset)
+        tunator.build_model()
+        while True:
+            command, args = commands.get()
+            if command == 'train':
+                tunator.train(epochs=args)
+                results.put((worker_id, float(tunator.val_loss)))
+            elif command == 'save':
+                tunator.save_state(args)
+                results.put((worker_id, args))
+            elif command == 'load':
+                path, new_hparams = args
+                # dropout is fixed when the graph is built, so rebuild before
+                # loading the inherited weights into the same architecture. The
+                # old graph is dropped first, or every round adds one to the
+                # session and the worker's memory grows.
+                tunator.hparams = new_hparams
+                K.clear_session()
+                tunator.build_model()
+                tunator.load_state(path)
+                results.put((worker_id, path))
+            elif command == 'stop':
+                break
+            else:
+                raise ValueError(f'unknown command: {command}')
+    except Exception:
+        results.put((worker_id, WorkerError(f'member {worker_id} failed:\n{traceback.format_exc()}')))
+
+
+class PopulationBasedTrainer:
+    """
+    Population-based training (PBT) of `TunatorLSTM` models.
+
+    A fixed population of models is trained in parallel, one per local
+    process, all on the same dataset. After every `ready_epochs` epochs the
+    members are ranked by validation loss. Each member in the bottom
+    `exploit_fraction` copies the weights and optimizer state of a random
+    member of the top `exploit_fraction` (exploit), and inherits that member's
+    hyperparameters with the mutable ones perturbed (explore). Because members
+    keep training from the best weights found so far rather than starting from
+    random weights, good models are reached with far less compute than the
+    same number of independent trials.
+
+    Only hyperparameters that do not change the shape of the weights can be
+    perturbed; the defaults are `learning_rate` and `dropout`.
+
+    Args:
+        hparams (dict): starting hyperparameters for every member. The mutable
+            ones are perturbed once per member so the population starts diverse.
+        dataset (TunatorDataset): dataset shared by all members. Loading it into
+            memory first (`dataset.load`) spares every worker the HDF5 reads.
+        population_size (int): number of members, each trained in its own
+            process
+        rounds (int): number of train/exploit/explore rounds
+        ready_epochs (int): epochs trained by each member per round
+        exploit_fraction (float): fraction of the population that is replaced
+            by, and replaces, other members each round. At least one member is,
+            and the top and bottom members must not overlap, so it is at most
+            .5 and the population has at least 2 members.
+        perturbations (dict): hparam names and functions of (value, rng)
+            returning the perturbed value
+        pbt_dir (str): directory for the states exchanged between members
+        seed (int): seed for member selection and perturbations
+        poll_seconds (float): interval at which the parent checks that the
+            members it waits for are still alive
+    """
+    def __init__(self, hparams, dataset, population_size=4, rounds=10,
+                 ready_epochs=1, exploit_fraction=.25, perturbations=None,
+                 pbt_dir='checkpoints/pbt', seed=None, poll_seconds=10.):
+        if rounds < 1:
+            raise ValueError(f'rounds must be at least 1, got {rounds}')
+        if population_size < 2:
+            raise ValueError(f'population_size must be at least 2, got {population_size}')
+        if not 0 < exploit_fraction <= .5:
+            raise ValueError(f'exploit_fraction must be in (0, .5], got {exploit_fraction}')
+        self.hparams = dict(hparams)
+        self.dataset = dataset
+        self.population_size = population_size
+        self.rounds = rounds
+        self.ready_epochs = ready_epochs
+        self.exploit_fraction = exploit_fraction
+        # members replaced each round, and members they copy from
+        self.n_exploit = max(1, int(exploit_fraction * population_size))
+        self.perturbations = perturbations if perturbations is not None else PERTURBATIONS
+        self.pbt_dir = pbt_dir
+        self._random = random.Random(seed)
+        self.poll_seconds = poll_seconds
+        self.log = list()
+
+    def perturb(self, hparams):
+        perturbed = dict(hparams)
+        for name, perturb in self.perturbations.items():
+            if name in perturbed:
+                perturbed[name] = perturb(perturbed[name], self._random)
+        return perturbed
+
+    def run(self):
+        """
+        Trains the population for `rounds` rounds. Every round is appended to
+        `log` as a list of (member, val_loss, hparams) tuples.
+
+        Returns:
+            best (dict): `member`, `val_loss`, `hparams` and `path` of the best
+                member after the last round. Its state is saved to `path`.
+        """
+        os.makedirs(self.pbt_dir, exist_ok=True)
+        # spawn rather than fork so every worker initializes its own TF session
+        ctx = mp.get_context('spawn')
+        results = ctx.Queue()
+        members = [self.perturb(self.hparams) for _ in range(self.population_size)]
+        commands = [ctx.Queue() for _ in range(self.population_size)]
+        workers = [
+            ctx.Process(target=_worker, args=(i, members[i], self.dataset, commands[i], results))
+            for i in range(self.population_size)]
+        for worker in workers:
+            worker.start()
+        self._workers = workers
+
+        try:
+            for round_i in range(self.rounds):
+                losses = self._broadcast(commands, results, 'train', self.ready_epochs)
+                ranking = sorted(range(self.population_size), key=losses.__getitem__)
+                self.log.append([(i, losses[i], dict(members[i])) for i in ranking])
+                print(f'round {round_i}: ' + ', '.join(
+                    f'{i}: {losses[i]:.4f}' for i in ranking))
+                if round_i == self.rounds - 1:
+                    break
+
+                top = ranking[:self.n_exploit]
+                bottom = ranking[-self.n_exploit:]
+                for i in top:
+                    commands[i].put(('save', self._state_path(i)))
+                self._gather(results, top)
+                for i in bottom:
+                    donor = self._random.choice(top)
+                    members[i] = self.perturb(members[donor])
+                    print(f'member {i} inherits from {donor}: {members[i]}')
+                    commands[i].put(('load', (self._state_path(donor), members[i])))
+                self._gather(results, bottom)
+
+            best = ranking[0]
+            commands[best].put(('save', self._state_path(best)))
+            self._gather(results, [best])
+        finally:
+            for command_queue in commands:
+                command_queue.put(('stop', None))
+            for worker in workers:
+                worker.join(self.poll_seconds)
+                # a member still busy after an error elsewhere is not waited for
+                if worker.is_alive():
+                    worker.terminate()
+                    worker.join()
+
+        return {
+            'member': best,
+            'val_loss': losses[best],
+            'hparams': members[best],
+            'path': self._state_path(best),
+        }
+
+    def _state_path(self, member):
+        return os.path.join(self.pbt_dir, f'member_{member}')
+
+    def _broadcast(self, commands, results, command, args):
+        for command_queue in commands:
+            command_queue.put((command, args))
+        return self._gather(results, range(len(commands)))
+
+    def _gather(self, results, members):
+        """
+        Waits for an answer from each of `members`, returning them as a list
+        indexed by member. Raises `WorkerError` if a member answers with an
+        error or its process exits without answering.
+        """
+        answers = [None] * self.population_size
+        pending = set(members)
+        while pending:
+            try:
+                member, value = results.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                dead = [i for i in pending if not self._workers[i].is_alive()]
+                if dead:
+                    raise WorkerError(f'members {dead} exited with codes '
+                                      f'{[self._workers[i].exitcode for i in dead]}')
+                continue
+            if isinstance(value, WorkerError):
+                raise value
+            answers[member] = value
+            pending.discard(member)
+        return answers
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import numpy as np
+
+
+NOTE_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+def build_piano_roll(octaves=10):
+    """
+    Builds the piano roll used to encode notes as integers. Each octave number
+    runs from A to G#, and flats are mapped to the same integer as their
+    enharmonic sharps.
+    Args:
+        octaves (int): number of octaves, numbered from 0
+
+    Returns:
+        piano_roll (list[str]): note names in order of their integer
+        piano_roll_dict (dict): note names, including flats, and their integer
+    """
+    scale = ['A', 'B', 'C', 'D', 'E', 'F', 'G']
+    sharps = ['A#', 'C#', 'D#', 'F#', 'G#']
+    flats = ['B-', 'D-', 'E-', 'G-', 'A-']
+    sharps_scale = sorted(scale + sharps)
+    sharps_oct = [note + str(i) for i in range(octaves) for note in sharps]
+    flats_oct = [note + str(i) for i in range(octaves) for note in flats]
+    flat_sharp_dict = dict(zip(flats_oct, sharps_oct))
+    piano_roll = [
+        note + str(i) for i in range(octaves) for note in sharps_scale]
+    piano_roll_dict = {
+        note: i for i, note in enumerate(piano_roll)}
+    piano_roll_dict.update(
+        {flat: piano_roll_dict[sharp]
+         for flat, sharp in flat_sharp_dict.items()})
+    return piano_roll, piano_roll_dict
+
+
+def midi_to_roll_index(midi, octaves=10):
+    """
+    Maps MIDI note numbers to piano roll integers. The piano roll numbers its
+    octaves from A to G# but names notes like music21, whose octaves run from C
+    to B, so e.g. C4 (MIDI 60) comes right after A#4 and B4 rather than after
+    B3.
+    Args:
+        midi (np.ndarray): MIDI note numbers
+        octaves (int): number of octaves of the piano roll
+
+    Returns:
+        note_ints (np.ndarray): piano roll integers, -1 for notes outside of
+            the piano roll
+    """
+    midi = np.asarray(midi)
+    octave = midi // 12 - 1
+    note_ints = 12 * octave + (midi - 9) % 12
+    return np.where((octave >= 0) & (octave < octaves), note_ints, -1)
+
+
+def roll_index_to_pitch_class(note_ints):
+    """
+    Returns:
+        pitch_classes (np.ndarray): pitch class of piano roll integers, with
+            C = 0
+    """
+    return (np.asarray(note_ints) % 12 + 9) % 12
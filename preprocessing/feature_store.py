@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+class FeatureStore:
+    """
+    On-disk cache of spectral features shared by the audio preprocessing
+    stages.
+
+    Entries are keyed by a hash of the audio samples together with the
+    parameters the features were computed with, so any stage that gets the same
+    audio and parameters reuses the stored features instead of recomputing
+    them from the waveform. Every feature is stored as an `.npy` file in the
+    entry's directory and loaded memory-mapped, so only the parts that are
+    actually read are paged in. When the store grows beyond `max_bytes`, the
+    least recently used entries are evicted.
+
+    Layout:
+        <root>/<key>/params.json    parameters of the entry
+        <root>/<key>/<name>.npy     one file per feature
+        <root>/<key>/last_used      touched on every access, for LRU eviction
+
+    Entries are written to a temporary directory that is renamed to
+    `<root>/<key>` once complete, so an entry is either missing or has all of
+    its features, even while other processes are writing it.
+
+    Args:
+        root (str): directory of the store. Created if missing.
+        max_bytes (int): disk budget for all entries
+    """
+    def __init__(self, root='working_dir/features', max_bytes=2 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, audio, params):
+        """
+        Returns:
+            key (str): hex digest of the audio content and `params`
+        """
+        digest = hashlib.sha1()
+        audio = np.ascontiguousarray(audio)
+        digest.update(str(audio.dtype).encode())
+        digest.update(audio.view(np.uint8).data)
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key, names):
+        """
+        Loads the features `names` of entry `key`, memory-mapped.
+
+        Returns:
+            features (dict or None): arrays by name, or None if the entry or
+                any of the features is missing
+        """
+        entry_dir = os.path.join(self.root, key)
+        try:
+            features = {name: np.load(os.path.join(entry_dir, f'{name}.npy'), mmap_mode='r')
+                        for name in names}
+        except FileNotFoundError:
+            return None
+        self._touch(entry_dir)
+        return features
+
+    def put(self, key, params, features):
+        """
+        Stores `features` under entry `key`, then evicts least recently used
+        entries until the store is within its disk budget. The entry is
+        written to a temporary directory and renamed into place, so concurrent
+        readers in other processes never see a partial entry. If another
+        process stored the entry first, its features are kept.
+
+        Returns:
+            features (dict): the entry another process stored first, memory-mapped,
+                or else `features` as arrays. These are not read back from the
+                store, where another process may already have evicted them.
+        """
+        entry_dir = os.path.join(self.root, key)
+        tmp_dir = os.path.join(self.root, f'.{key}.{os.getpid()}.tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        with open(os.path.join(tmp_dir, 'params.json'), 'w') as f:
+            json.dump(params, f, sort_keys=True)
+        for name, array in features.items():
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), np.asarray(array))
+        stored = None
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:  # the entry already exists
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            stored = self.get(key, list(features))
+        self._touch(entry_dir)
+        self.evict(keep=key)
+        if stored is not None:
+            return stored
+        return {name: np.asarray(array) for name, array in features.items()}
+
+    def get_or_compute(self, audio, params, compute):
+        """
+        Returns the features for `audio` and `params` from the store, calling
+        `compute` and storing its result if they aren't there yet.
+        Args:
+            audio (np.ndarray): audio samples the features are derived from
+            params (dict): JSON-serializable parameters of the computation,
+                including a name for the stage that computes them
+            compute (callable): function without arguments returning a dict of
+                feature names and arrays
+
+        Returns:
+            features (dict): arrays by name
+        """
+        key = self.key(audio, params)
+        stored = self._names(key)
+        if stored:
+            features = self.get(key, stored)
+            if features is not None:
+                return features
+        return self.put(key, params, compute())
+
+    def size(self):
+        return sum(size for _, _, size in self._entries())
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries, other than `keep`, until the total
+        size is within `max_bytes`.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        for key, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+            total -= size
+
+    def _entries(self):
+        """
+        Yields (key, last used time, size in bytes) for every entry.
+        """
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or entry.name.startswith('.'):  # being written
+                continue
+            try:
+                last_used = os.stat(os.path.join(entry.path, 'last_used')).st_mtime
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            except FileNotFoundError:  # being written or evicted by another process
+                continue
+            yield entry.name, last_used, size
+
+    def _names(self, key):
+        entry_dir = os.path.join(self.root, key)
+        if not os.path.isdir(entry_dir):
+            return []
+        return [os.path.splitext(fname)[0] for fname in os.listdir(entry_dir)
+                if fname.endswith('.npy')]
+
+    @staticmethod
+    def _touch(entry_dir):
+        path = os.path.join(entry_dir, 'last_used')
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except FileNotFoundError:
+            try:
+                open(path, 'a').close()
+            except FileNotFoundError:  # evicted by another process
+                pass
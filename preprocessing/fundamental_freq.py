@@ -1,33 +1,59 @@
-from collections import deque
+from collections import deque, namedtuple
 import itertools
 import numpy as np
 import librosa
 import os
-import matplotlib.pyplot as plt
+import sys
+import time
+import soundfile as sf
 
-import ipdb
+from feature_store import FeatureStore
 
 
 RING_BUFFER_SIZE = 40
 SAMPLE_RATE = 22050
-# THRESHOLD_MULTIPLIER = 5
+THRESHOLD_MULTIPLIER = 5
 WINDOW_SIZE = 2048
-# THRESHOLD_WINDOW_SIZE = 7
+THRESHOLD_WINDOW_SIZE = 7
 
-np.set_printoptions(threshold=np.nan)
+np.set_printoptions(threshold=sys.maxsize)
 
 
 class SpectralAnalyzer:
+    """
+    Onset and fundamental frequency detection on consecutive windows of audio.
+
+    Windows can be fed one at a time with `process_data`, which keeps the
+    spectrum, flux and peak state between calls like a streaming component, or
+    a whole signal can be analyzed at once with `analyze`, which computes the
+    same results for every frame with vectorized operations.
+
+    Args:
+        window_size (int): number of samples per window
+        segments_buf (int): number of past flux values kept for thresholding
+        threshold_multiplier (float): multiplier for the mean flux over the
+            thresholding window. Defaults to `THRESHOLD_MULTIPLIER`.
+        threshold_window_size (int): number of flux values averaged for the
+            threshold. Defaults to `THRESHOLD_WINDOW_SIZE`.
+        sample_rate (int): sample rate of the analyzed audio
+    """
 
     FREQUENCY_RANGE = (100, 1000)
 
-    def __init__(self, window_size, segments_buf=None):
+    def __init__(self, window_size, segments_buf=None, threshold_multiplier=None,
+                 threshold_window_size=None, sample_rate=SAMPLE_RATE):
         self._window_size = window_size
+        self._sample_rate = sample_rate
         if segments_buf is None:
-            segments_buf = int(SAMPLE_RATE / window_size)
+            segments_buf = int(sample_rate / window_size)
         self._segments_buf = segments_buf
 
-        self._thresholding_window_size = THRESHOLD_WINDOW_SIZE
+        if threshold_multiplier is None:
+            threshold_multiplier = THRESHOLD_MULTIPLIER
+        if threshold_window_size is None:
+            threshold_window_size = THRESHOLD_WINDOW_SIZE
+        self._threshold_multiplier = threshold_multiplier
+        self._thresholding_window_size = threshold_window_size
         assert self._thresholding_window_size <= segments_buf
 
         self._last_spectrum = np.zeros(window_size, dtype=np.int16)
@@ -53,13 +79,11 @@ class SpectralAnalyzer:
         Calculates the difference between the current and last spectrum,
         then applies a thresholding function and checks if a peak occurred.
         """
-        last_spectrum = self._last_spectrum
-        flux = sum([max(spectrum[i] - last_spectrum[i], 0)
-            for i in range(self._window_size)])
+        flux = np.maximum(spectrum - self._last_spectrum, 0).sum()
         self._last_flux.append(flux)
 
         thresholded = np.mean(
-            self._get_flux_for_thresholding()) * THRESHOLD_MULTIPLIER
+            self._get_flux_for_thresholding()) * self._threshold_multiplier
         prunned = flux - thresholded if thresholded <= flux else 0
         peak = prunned if prunned > self._last_prunned_flux else 0
         self._last_prunned_flux  = prunned
@@ -70,12 +94,12 @@ class SpectralAnalyzer:
         # search for maximum between 0.08ms (=1200Hz) and 2ms (=500Hz)
         # as it's about the recorder's frequency range of one octave
         min_freq, max_freq = self.FREQUENCY_RANGE
-        start = int(SAMPLE_RATE / max_freq)
-        end = int(SAMPLE_RATE / min_freq)
+        start = int(self._sample_rate / max_freq)
+        end = int(self._sample_rate / min_freq)
         narrowed_cepstrum = cepstrum[start:end]
 
         peak_ix = narrowed_cepstrum.argmax()
-        freq0 = SAMPLE_RATE / (start + peak_ix)
+        freq0 = self._sample_rate / (start + peak_ix)
 
         if freq0 < min_freq or freq0 > max_freq:
             # Ignore the note out of the desired frequency range
@@ -84,6 +108,17 @@ class SpectralAnalyzer:
         return freq0
 
     def process_data(self, data):
+        _, freq0 = self.process_hop(data)
+        return freq0
+
+    def process_hop(self, data):
+        """
+        Like `process_data`, but also returns the onset strength.
+
+        Returns:
+            onset (float): onset peak strength, 0 where there is no onset
+            freq0 (float or None): fundamental frequency at an onset
+        """
         spectrum = self.autopower_spectrum(data)
 
         onset = self.find_onset(spectrum)
@@ -91,11 +126,120 @@ class SpectralAnalyzer:
 
         if self._first_peak:
             self._first_peak = False
-            return
+            return 0, None
 
         if onset:
             freq0 = self.find_fundamental_freq(data)
-            return freq0
+            return onset, freq0
+        return 0, None
+
+    def analyze(self, signal):
+        """
+        Analyzes a whole signal in consecutive, non-overlapping windows. This
+        gives the same results as calling `process_data` on each window in
+        turn, and likewise continues from (and updates) the analyzer's state.
+        A trailing partial window is zero-padded.
+        Args:
+            signal (np.ndarray): mono audio samples
+
+        Returns:
+            onsets (np.ndarray): onset peak strength per frame, 0 where there
+                is no onset
+            freqs (np.ndarray): fundamental frequency per frame, NaN where
+                `process_data` would return None
+        """
+        frames = self.frame(signal)
+        spectra = self.autopower_spectra(frames)
+        flux = self.spectral_flux(spectra)
+        onsets = self.pick_onsets(flux)
+        freqs = self.find_fundamental_freqs(frames)
+        freqs[onsets == 0] = np.nan
+
+        if self._first_peak:
+            onsets[0] = 0
+            freqs[0] = np.nan
+            self._first_peak = False
+        self._last_spectrum = spectra[-1]
+        return onsets, freqs
+
+    def frame(self, signal):
+        """
+        Returns a read-only strided view of `signal` as consecutive,
+        non-overlapping windows, zero-padding a trailing partial window.
+        """
+        signal = np.asarray(signal, dtype=np.float64)
+        n_frames = max(1, -(-len(signal) // self._window_size))
+        padding = n_frames * self._window_size - len(signal)
+        if padding:
+            signal = np.concatenate((signal, np.zeros(padding)))
+        stride = signal.strides[0]
+        return np.lib.stride_tricks.as_strided(
+            signal,
+            shape=(n_frames, self._window_size),
+            strides=(stride * self._window_size, stride),
+            writeable=False)
+
+    def autopower_spectra(self, frames):
+        """
+        Batch version of `autopower_spectrum` for frames of shape
+        (n_frames, window_size), using one real FFT over all frames.
+        """
+        windowed = frames * self._hanning_window
+        spectra = np.fft.rfft(windowed, n=2 * self._window_size, axis=1)
+        spectra /= self._window_size
+        autopower = spectra.real ** 2 + spectra.imag ** 2
+        return autopower[:, :self._window_size]
+
+    def spectral_flux(self, spectra):
+        """
+        Spectral flux of each spectrum against the one before it, starting
+        from the analyzer's last spectrum.
+        """
+        previous = np.vstack((self._last_spectrum[np.newaxis], spectra[:-1]))
+        return np.maximum(spectra - previous, 0).sum(axis=1)
+
+    def pick_onsets(self, flux):
+        """
+        Vectorized thresholding and peak picking of `find_onset` over a flux
+        array. The analyzer's flux ring buffer provides the history for the
+        first thresholds, and is updated along with the last prunned flux.
+        """
+        peaks, prunned = threshold_peaks(
+            flux,
+            [self._threshold_multiplier],
+            [self._thresholding_window_size],
+            history=np.array(self._last_flux, dtype=np.float64),
+            last_prunned=self._last_prunned_flux)
+
+        self._last_flux.extend(flux)
+        self._last_prunned_flux = prunned[0, 0, -1]
+        return peaks[0, 0]
+
+    def find_fundamental_freqs(self, frames):
+        """
+        Batch version of `find_fundamental_freq` for frames of shape
+        (n_frames, window_size). Frequencies outside of `FREQUENCY_RANGE` are
+        NaN.
+        """
+        cepstra = self.cepstra(frames)
+        min_freq, max_freq = self.FREQUENCY_RANGE
+        start = int(self._sample_rate / max_freq)
+        end = int(self._sample_rate / min_freq)
+        peak_ix = cepstra[:, start:end].argmax(axis=1)
+        freqs = self._sample_rate / (start + peak_ix)
+        freqs[(freqs < min_freq) | (freqs > max_freq)] = np.nan
+        return freqs
+
+    def cepstra(self, frames):
+        """
+        Batch version of `cepstrum` for frames of shape (n_frames, window_size).
+        The log magnitude spectrum of a real frame is real and symmetric, so the
+        real FFT pair gives the same result as the complex one.
+        """
+        spectra = np.fft.rfft(frames, axis=1)
+        with np.errstate(divide='ignore'):
+            log_spectra = np.log(np.abs(spectra))
+        return np.fft.irfft(log_spectra, n=frames.shape[1], axis=1)
 
     def autopower_spectrum(self, samples):
         """
@@ -122,61 +266,326 @@ class SpectralAnalyzer:
         return cepstrum
 
 
-os.chdir('working_dir')
-song, sample_rate = librosa.load('vocals_isolated_phased.wav')
-
-# set up iteration to vary THRESHOLD_MULTIPLIER and THRESHOLD_WINDOW_SIZE
-start_1 = 2
-stop_1 = 11
-step_1 = 2
-range_1 = range(start_1, stop_1, step_1)
-dim_1 = len(range_1)
-start_2 = 6
-stop_2 = 20
-step_2 = 2
-range_2 = range(start_2, stop_2, step_2)
-dim_2 = len(range_2)
-fig = plt.figure()
-
-# Jake VanDerplas implementation
-# for i in range(2):
-#     for j in range(3):
-#         ax[i, j].text(0.5, 0.5, str((i, j)),
-#                       fontsize=18, ha='center')
-
-# vary THRESHOLD_MULTIPLIER
-for i in range_1:
-    THRESHOLD_MULTIPLIER = i
-
-    # vary THRESHOLD_WINDOW_SIZE
-    for j in range_2:
-        THRESHOLD_WINDOW_SIZE = j
-
-        fig
-        # set up plot
-        col = (j - start_2) / step_2
-        row = (i - start_1) / step_1
-        plt_i = (row * dim_2) + col + 1
-        print(f'i: {i}\nj: {j}\ncol: {col}\nrow: {row}\nplt_i: {plt_i}')
-        ax = fig.add_subplot(dim_1, dim_2, plt_i)
-
-        # initialize spectral analyzer with new globals
-        spectral_analyzer = SpectralAnalyzer(
-            window_size=WINDOW_SIZE,
-            segments_buf=RING_BUFFER_SIZE,
+PitchEvent = namedtuple('PitchEvent', ['timestamp', 'f0', 'onset'])
+
+
+class StreamingPitchTracker:
+    """
+    Real-time onset and pitch tracking on an audio stream.
+
+    Audio is read incrementally in hops of `window_size` samples into
+    preallocated buffers and each hop is passed through a `SpectralAnalyzer`,
+    whose state is bounded by its flux ring buffer. Memory use is therefore
+    constant in the length of the recording, and the latency of an event is at
+    most one hop plus the time it took to process that hop. The processing
+    time of the last `latency_buf` hops is kept in a ring buffer and reported
+    by `latency_stats`.
+
+    Args:
+        window_size (int): number of samples per hop
+        sample_rate (int): sample rate of the stream
+        segments_buf (int): number of past flux values kept for thresholding
+        threshold_multiplier (float): see `SpectralAnalyzer`
+        threshold_window_size (int): see `SpectralAnalyzer`
+        latency_buf (int): number of per-hop latencies kept
+    """
+    def __init__(self, window_size=WINDOW_SIZE, sample_rate=SAMPLE_RATE,
+                 segments_buf=RING_BUFFER_SIZE, threshold_multiplier=None,
+                 threshold_window_size=None, latency_buf=1024):
+        self.window_size = window_size
+        self.sample_rate = sample_rate
+        self.analyzer = SpectralAnalyzer(
+            window_size=window_size,
+            segments_buf=segments_buf,
+            threshold_multiplier=threshold_multiplier,
+            threshold_window_size=threshold_window_size,
+            sample_rate=sample_rate,
         )
+        self._latencies = np.zeros(latency_buf)
+        self._n_hops = 0
 
-        freq_arr = np.array([])
-        # iterate over wav file in chunks of WINDOW_SIZE
-        for k in range(round(len(song) / WINDOW_SIZE)):
-            window_start = k * WINDOW_SIZE
-            window_end = (k + 1) * WINDOW_SIZE
-            data_array = song[window_start:window_end]
-            freq = spectral_analyzer.process_data(data_array)
-            freq_arr = np.append(freq_arr, [freq])
-        ax.scatter(range(len(freq_arr)), freq_arr, s=4)
-        ax.title.set_text(f'MULTIPLIER: {i}, WINDOW: {j}')
-
-plt.subplots_adjust(hspace=.5)
-plt.show()
-
+    def events(self, stream, dtype='int16', channels=1):
+        """
+        Yields a `PitchEvent` for every onset detected in `stream`, as soon as
+        the hop containing it has been processed. `f0` is None if the onset has
+        no fundamental frequency within `SpectralAnalyzer.FREQUENCY_RANGE`.
+        Args:
+            stream: either a `soundfile.SoundFile`, or a binary file-like
+                object with `readinto` (file, pipe, socket) delivering
+                interleaved raw PCM samples
+            dtype (str): sample type of a raw PCM stream
+            channels (int): number of channels of a raw PCM stream
+
+        Yields:
+            event (PitchEvent): onset time in seconds, f0 in Hz and onset
+                strength
+        """
+        if isinstance(stream, sf.SoundFile):
+            if stream.samplerate != self.sample_rate:
+                raise ValueError(
+                    f'stream sample rate {stream.samplerate} does not match '
+                    f'tracker sample rate {self.sample_rate}')
+            read_hop = self._soundfile_reader(stream)
+        else:
+            read_hop = self._pcm_reader(stream, np.dtype(dtype), channels)
+
+        hop_duration = self.window_size / self.sample_rate
+        hop_i = 0
+        while True:
+            samples = read_hop()
+            if samples is None:
+                break
+            start = time.perf_counter()
+            onset, freq0 = self.analyzer.process_hop(samples)
+            self._latencies[self._n_hops % len(self._latencies)] = \
+                time.perf_counter() - start
+            self._n_hops += 1
+            if onset:
+                yield PitchEvent(hop_i * hop_duration, freq0, onset)
+            hop_i += 1
+
+    def latency_stats(self):
+        """
+        Returns:
+            stats (dict): mean, 95th percentile and maximum processing latency
+                in seconds over the kept hops, and the real-time factor, i.e.
+                the mean latency as a fraction of the hop duration
+        """
+        latencies = self._latencies[:min(self._n_hops, len(self._latencies))]
+        if not len(latencies):
+            return dict()
+        hop_duration = self.window_size / self.sample_rate
+        return {
+            'hops': self._n_hops,
+            'mean': float(latencies.mean()),
+            'p95': float(np.percentile(latencies, 95)),
+            'max': float(latencies.max()),
+            'real_time_factor': float(latencies.mean() / hop_duration),
+        }
+
+    def _soundfile_reader(self, stream):
+        frames = np.zeros((self.window_size, stream.channels))
+        mono = np.zeros(self.window_size)
+
+        def read_hop():
+            n = len(stream.read(self.window_size, always_2d=True, out=frames))
+            if n == 0:
+                return None
+            # zero-pad a trailing partial hop
+            frames[n:] = 0
+            return frames.mean(axis=1, out=mono)
+
+        return read_hop
+
+    def _pcm_reader(self, stream, dtype, channels):
+        raw = np.zeros(self.window_size * channels, dtype=dtype)
+        raw_bytes = memoryview(raw).cast('B')
+        mono = np.zeros(self.window_size)
+        scale = 1.
+        if dtype.kind == 'i':
+            scale = 1 / np.iinfo(dtype).max
+
+        def read_hop():
+            # pipes and sockets may return less than requested before the end
+            n_bytes = 0
+            while n_bytes < len(raw_bytes):
+                n = stream.readinto(raw_bytes[n_bytes:])
+                if not n:
+                    break
+                n_bytes += n
+            if n_bytes == 0:
+                return None
+            raw_bytes[n_bytes:] = bytes(len(raw_bytes) - n_bytes)
+            np.mean(raw.reshape(-1, channels), axis=1, out=mono)
+            return np.multiply(mono, scale, out=mono)
+
+        return read_hop
+
+
+def track_pitch(path, **kwargs):
+    """
+    Streams the audio file at `path` through a `StreamingPitchTracker`,
+    printing events as they are detected and the latency stats at the end.
+    Keyword arguments are passed on to the tracker.
+    """
+    with sf.SoundFile(path) as stream:
+        tracker = StreamingPitchTracker(sample_rate=stream.samplerate, **kwargs)
+        for event in tracker.events(stream):
+            print(event)
+    print(tracker.latency_stats())
+    return tracker
+
+
+def threshold_peaks(flux, multipliers, window_sizes, history=None, last_prunned=0.):
+    """
+    Adaptive thresholding and peak picking of `SpectralAnalyzer.find_onset`
+    for every combination of threshold multiplier and thresholding window size
+    at once. The threshold of each frame is the mean of the flux over the last
+    `window_size` frames (including the frame itself) times the multiplier.
+    Args:
+        flux (np.ndarray): spectral flux per frame
+        multipliers (iterable[float]): threshold multipliers
+        window_sizes (iterable[int]): thresholding window sizes, none of them
+            longer than `history`
+        history (np.ndarray): flux values preceding `flux`. Defaults to the
+            zeros a new `SpectralAnalyzer` starts with.
+        last_prunned (float): prunned flux of the frame preceding `flux`
+
+    Returns:
+        peaks (np.ndarray): onset peak strength of shape
+            (len(window_sizes), len(multipliers), len(flux))
+        prunned (np.ndarray): prunned flux of the same shape
+    """
+    if history is None:
+        history = np.zeros(RING_BUFFER_SIZE)
+    multipliers = np.asarray(multipliers, dtype=np.float64)
+    window_sizes = np.asarray(window_sizes)
+    assert window_sizes.max() <= len(history)
+
+    extended = np.concatenate((history, flux))
+    cumsum = np.concatenate(([0.], np.cumsum(extended)))
+    ends = np.arange(len(flux)) + len(history) + 1
+    # mean flux over each thresholding window: (window_sizes, frames)
+    means = (cumsum[ends] - cumsum[ends - window_sizes[:, np.newaxis]]) \
+        / window_sizes[:, np.newaxis]
+    thresholded = means[:, np.newaxis, :] * multipliers[:, np.newaxis]
+
+    prunned = np.where(thresholded <= flux, flux - thresholded, 0)
+    previous = np.concatenate(
+        (np.full(prunned.shape[:2] + (1,), last_prunned), prunned[..., :-1]),
+        axis=-1)
+    peaks = np.where(prunned > previous, prunned, 0)
+    return peaks, prunned
+
+
+def spectral_features(signal, window_size=WINDOW_SIZE, sample_rate=SAMPLE_RATE, store=None):
+    """
+    Threshold-independent features of `SpectralAnalyzer.analyze` for a signal:
+    the spectral flux of each frame against the previous one (starting from a
+    silent frame, like a new analyzer) and the cepstral fundamental frequency
+    of each frame. With a `store`, the features are read from it if they were
+    computed for the same audio and parameters before, and added to it
+    otherwise.
+
+    Returns:
+        features (dict): `flux` and `freqs` arrays with one value per frame
+    """
+    analyzer = SpectralAnalyzer(window_size=window_size, sample_rate=sample_rate)
+
+    def _compute():
+        frames = analyzer.frame(signal)
+        return {
+            'flux': analyzer.spectral_flux(analyzer.autopower_spectra(frames)),
+            'freqs': analyzer.find_fundamental_freqs(frames),
+        }
+
+    if store is None:
+        return _compute()
+    params = {'stage': 'spectral_analyzer', 'window_size': window_size,
+              'sample_rate': sample_rate,
+              'frequency_range': list(SpectralAnalyzer.FREQUENCY_RANGE)}
+    return store.get_or_compute(signal, params, _compute)
+
+
+def sweep_thresholds(signal, multipliers, window_sizes, window_size=WINDOW_SIZE,
+                     sample_rate=SAMPLE_RATE, segments_buf=RING_BUFFER_SIZE, store=None):
+    """
+    Onset and fundamental frequency detection over a grid of threshold
+    multipliers and thresholding window sizes. The spectra, flux and cepstra
+    don't depend on the thresholds, so they are computed once and only the
+    thresholding is repeated, vectorized over the whole grid. The results for
+    each configuration are the same as `SpectralAnalyzer.analyze` with those
+    thresholds.
+    Args:
+        signal (np.ndarray): mono audio samples
+        multipliers (iterable[float]): threshold multipliers
+        window_sizes (iterable[int]): thresholding window sizes
+        window_size (int): number of samples per frame
+        sample_rate (int): sample rate of `signal`
+        segments_buf (int): number of past flux values kept for thresholding
+        store (FeatureStore): feature store for the flux and cepstra, see
+            `spectral_features`
+
+    Returns:
+        sweep (dict): `multipliers` and `window_sizes` of the grid; `onsets` and
+            `freqs` arrays of shape (len(multipliers), len(window_sizes),
+            n_frames) laid out like the output of `SpectralAnalyzer.analyze`;
+            and `stats`, a list of dicts with the number of onsets, number of
+            pitched onsets and median f0 for each configuration
+    """
+    multipliers = list(multipliers)
+    window_sizes = list(window_sizes)
+    features = spectral_features(signal, window_size=window_size, sample_rate=sample_rate,
+                                 store=store)
+    flux = features['flux']
+    freqs = features['freqs']
+
+    peaks, _ = threshold_peaks(
+        flux, multipliers, window_sizes, history=np.zeros(segments_buf))
+    onsets = peaks.swapaxes(0, 1)
+    # the first frame is never reported, see `SpectralAnalyzer.process_data`
+    onsets[..., 0] = 0
+    sweep_freqs = np.where(onsets > 0, freqs, np.nan)
+
+    stats = list()
+    for i, multiplier in enumerate(multipliers):
+        for j, thresholding_window_size in enumerate(window_sizes):
+            pitched = sweep_freqs[i, j][~np.isnan(sweep_freqs[i, j])]
+            stats.append({
+                'multiplier': multiplier,
+                'window_size': thresholding_window_size,
+                'n_onsets': int(np.count_nonzero(onsets[i, j])),
+                'n_pitched': len(pitched),
+                'median_f0': float(np.median(pitched)) if len(pitched) else np.nan,
+            })
+
+    return {
+        'multipliers': multipliers,
+        'window_sizes': window_sizes,
+        'onsets': onsets,
+        'freqs': sweep_freqs,
+        'stats': stats,
+    }
+
+
+def plot_sweep(sweep):
+    """
+    Scatter plots the f0 per frame for every configuration of a
+    `sweep_thresholds` result, one subplot per configuration with multipliers
+    along the rows and thresholding window sizes along the columns.
+    """
+    import matplotlib.pyplot as plt
+
+    multipliers = sweep['multipliers']
+    window_sizes = sweep['window_sizes']
+    fig = plt.figure()
+    for row, multiplier in enumerate(multipliers):
+        for col, thresholding_window_size in enumerate(window_sizes):
+            plt_i = row * len(window_sizes) + col + 1
+            ax = fig.add_subplot(len(multipliers), len(window_sizes), plt_i)
+            freq_arr = sweep['freqs'][row, col]
+            ax.scatter(range(len(freq_arr)), freq_arr, s=4)
+            ax.title.set_text(
+                f'MULTIPLIER: {multiplier}, WINDOW: {thresholding_window_size}')
+
+    plt.subplots_adjust(hspace=.5)
+    plt.show()
+
+
+def main(plot=True):
+    os.chdir('working_dir')
+    song, sample_rate = librosa.load('vocals_isolated_phased.wav')
+
+    # vary THRESHOLD_MULTIPLIER and THRESHOLD_WINDOW_SIZE
+    multipliers = range(2, 11, 2)
+    window_sizes = range(6, 20, 2)
+    sweep = sweep_thresholds(song, multipliers, window_sizes, sample_rate=sample_rate,
+                             store=FeatureStore('features'))
+    for stats in sweep['stats']:
+        print(stats)
+    if plot:
+        plot_sweep(sweep)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,45 @@
+from concurrent.futures import ProcessPoolExecutor
 import music21
-import ipdb
 import numpy as np
 from itertools import islice
 from math import floor
 from collections import namedtuple
 import os
+import sys
 import matplotlib.pyplot as plt
 import matplotlib.lines as mlines
 
+# the key tables and event cache live at the repository root next to lstm.py
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_ROOT)
+from event_cache import EventCache, remove_drums
+from keys import SCALE_DEGREES, detect_key
+from piano_roll import midi_to_roll_index
+
 # from ..utils.peek import peek
 
 # TODO: use .highestOffest or highestTime to get len of song
 
+# 12 tones in octave + octave number + duration, for each of melody and chord
+N_TONE_FEATURES = 14
+N_FEATURES = 2 * N_TONE_FEATURES
+OCTAVE_FEATURE_IDX = 12
+DURATION_FEATURE_IDX = 13
+
+# the event cache `TunatorLSTM` keeps next to the default datastore
+DEFAULT_EVENT_DIR = os.path.join(REPO_ROOT, 'data', 'events')
+
 
 def main():
     dir_ = '../music/mini_classical_violin'
     filepath_list = [os.path.join(dir_, fname) for fname in os.listdir(dir_)]
-    # for file in filepath_list:
-    #     print_parts_countour(open_midi(file).measures(0, 6))
-    tensor_gen = gen_batch_tensor(filepath_list, batch_size=5)
+    tensor_gen = gen_batch_tensor(filepath_list, batch_size=5, n_workers=os.cpu_count())
     X_batch, Y_batch = next(tensor_gen)
     print(X_batch.shape, Y_batch.shape)
     np.save('X_batch.np', X_batch)
     np.save('Y_batch.np', Y_batch)
 
 
-def open_midi(path, remove_drums=True):
-    mf = music21.midi.MidiFile()
-    mf.open(path)
-    mf.read()
-    mf.close()
-    if remove_drums:
-        for i in range(len(mf.tracks)):
-            if 10 in mf.tracks[0].getChannels():
-                mf.tracks[i].events = [ev for ev in mf.tracks[i].events if ev.channel != 10]
-
-    score = music21.midi.translate.midiFileToStream(mf)
-    return score
-
-
 def gen_song_metadata(score_list):
     # TODO: get bpm, key,
     pass
@@ -51,228 +52,184 @@ def gen_song_metadata(score_list):
 # else: # file has notes in a flat structure
 #     notes_to_parse = midi.flat.notes
 
-def gen_batch_tensor(file_list, batch_size, sample_range=(500, 1000)):
+def gen_batch_tensor(file_list, batch_size, sample_range=(500, 1000), n_workers=None,
+                     epochs=1, shuffle=False, seed=None, event_dir=DEFAULT_EVENT_DIR):
     """
-    Generates 2-dim tensor for song. The song is normalized to to it's major
-    key, with features for the degrees 1 - 12 within the key, and additional
-    features for octave and duration.
+    Generates batches of scale-degree tensors for songs. Each song is
+    normalized to its major key, with features for the degrees 1 - 12 within
+    the key, and additional features for octave and duration.
+
+    Note events are read from the event cache shared with `lstm.py`, so each
+    file is only parsed by music21 the first time it is used anywhere. Songs
+    are encoded once, in the first epoch, optionally across a process pool.
+    The encoded samples are kept in memory, so later epochs replay them
+    without touching the cache. Songs that are too short for
+    `sample_range`, or whose key can't be analyzed, are skipped. Leftover songs
+    that don't fill a whole batch are dropped at the end of every epoch.
 
     Args:
-        score_gen (generator):
-        sample_range (tuple[int]):
+        file_list (list[str]): MIDI filepaths
+        batch_size (int): songs per batch
+        sample_range (tuple[int]): first and last timestep of each song to use
+        n_workers (int): number of processes to encode songs in. Songs are
+            encoded in this process if None or 0.
+        epochs (int): number of passes over the songs, or None to stream
+            batches indefinitely
+        shuffle (bool): shuffle the song order of every epoch after the first
+        seed (int): seed for shuffling
+        event_dir (str): directory of the event cache. Defaults to
+            `data/events` at the repository root, wherever this is run from.
 
     Yields:
-        tensor (np.ndarray): 2-dim input tensor for song. It is helpful to
-            imagine it as a 3-dim tensor, but in reality, the "part" dimension
-            is flattened into the feature dimension. The dimensions will be
-            described below as if it were 3-dim.
-            Dimensions:
-                time: descretized by smallest time interval in song
-                part: melody and chords
-                features:
-                    0-11: binary encodings for each degree in the major key
-                      12: octave (normalized assuming 7 total octaves)
-                      13: duration in quarter notes
+        X_batch (np.ndarray): input tensor of shape (batch, time, 28). The
+            "part" dimension, melody and chords, is flattened into the feature
+            dimension:
+                0-11: binary encodings for each degree in the major key
+                  12: octave (normalized assuming 7 total octaves)
+                  13: duration in quarter notes
+               14-27: the same features for the chord
+        Y_batch (np.ndarray): X_batch one timestep ahead, transposed to shape
+            (time, batch, 28) to use as time series outputs
+    """
+    rng = np.random.RandomState(seed)
+    samples = list()
+
+    def _gen_samples():
+        if n_workers:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                yield from executor.map(
+                    _encode_sample, file_list, [sample_range] * len(file_list),
+                    [event_dir] * len(file_list),
+                    chunksize=max(1, len(file_list) // (4 * n_workers)))
+        else:
+            for path in file_list:
+                yield _encode_sample(path, sample_range, event_dir)
+
+    def _gen_batches(sample_gen):
+        len_ = sample_range[1] - sample_range[0]
+        batch = list()
+        for sample in sample_gen:
+            batch.append(sample)
+            if len(batch) < batch_size:
+                continue
+            X_batch = np.empty((batch_size, len_, N_FEATURES))
+            Y_batch = np.empty((batch_size, len_, N_FEATURES))
+            for i, sample_i in enumerate(batch):
+                X_batch[i] = sample_i[:-1]
+                Y_batch[i] = sample_i[1:]
+            batch = list()
+            yield X_batch, np.swapaxes(Y_batch, 0, 1)
+
+    # parse each file once, keeping the samples for later epochs
+    def _cache(sample_gen):
+        for sample in sample_gen:
+            if sample is not None:
+                samples.append(sample)
+                yield sample
+
+    yield from _gen_batches(_cache(_gen_samples()))
+    epoch = 1
+    while samples and (epochs is None or epoch < epochs):
+        order = rng.permutation(len(samples)) if shuffle else range(len(samples))
+        yield from _gen_batches(samples[i] for i in order)
+        epoch += 1
+
+
+def encode_events(events, sample_range=(500, 1000)):
+    """
+    Encodes note events as a 2-dim scale-degree tensor, see `gen_batch_tensor`
+    for the features. Notes that start together within a part form a chord,
+    as music21 parses them, and go to the chord features; all other notes go
+    to the melody features. Time is discretized by the onsets of the events,
+    and blank rows are added for timesteps with no notes on the grid of the
+    smallest interval between onsets, so that time integrity is maintained.
 
+    Args:
+        events (np.ndarray): note events, see `event_cache.EVENT_DTYPE`
+        sample_range (tuple[int]): only the events needed for the timesteps up
+            to `sample_range[1]` are encoded
+
+    Returns:
+        tensor (np.ndarray): tensor of shape (time, 28)
+    """
+    if not len(events):
+        raise ValueError('song has no events')
+    scale = build_scale(events)
+    times, time_idx = np.unique(events['onset'], return_inverse=True)
+    times = times[:sample_range[1] + 1]
+    keep = time_idx < len(times)
+    events, time_idx = events[keep], time_idx[keep]
+
+    # 0 for melody notes, 1 for chord notes
+    parts = events['part'].astype(int)
+    _, group, group_counts = np.unique(
+        time_idx * (parts.max() + 1) + parts, return_inverse=True, return_counts=True)
+    row = (group_counts[group] > 1).astype(int)
+
+    pitches = events['pitch'].astype(int)
+    vectors = np.zeros((len(times), 2, N_TONE_FEATURES))
+    vectors[time_idx, row, scale[pitches % 12] - 1] = 1
+    # octave of the lowest note and the longest duration of each vector
+    lowest = np.full((len(times), 2), 128)
+    np.minimum.at(lowest, (time_idx, row), pitches)
+    longest = np.zeros((len(times), 2))
+    np.maximum.at(longest, (time_idx, row), events['duration'])
+    vectors[..., OCTAVE_FEATURE_IDX] = np.where(lowest < 128, (lowest // 12 - 1) / 7, 0)
+    vectors[..., DURATION_FEATURE_IDX] = longest
+
+    # place the vectors on the time grid, leaving blank rows for missing times
+    min_space = np.diff(times).min() if len(times) > 1 else 1
+    expected_times = np.arange(int(times[-1] / min_space)) * min_space
+    all_times = np.union1d(times, expected_times)
+    tensor = np.zeros((len(all_times), N_FEATURES))
+    tensor[np.searchsorted(all_times, times)] = vectors.reshape(len(times), -1)
+    return tensor
+
+
+def slice_sample(tensor, sample_range=(500, 1000)):
+    """
+    Slices a song tensor to the timesteps specified by `sample_range`, plus one
+    more timestep so that inputs and targets can be taken from the sample
+    offset by one. Songs that end before `sample_range[1] + 1` are sliced to
+    their last timesteps instead.
+
+    Returns:
+        sample (np.ndarray): tensor of shape (sample_range[1] - sample_range[0] + 1, 28)
+    """
+    start, end = sample_range
+    len_ = end - start
+    if len(tensor) >= end + 1:
+        return tensor[start:end + 1]
+    elif len(tensor) > len_:
+        return tensor[-len_ - 1:]
+    else:
+        raise ValueError('song too short')
+
+
+def _encode_sample(path, sample_range, event_dir):
+    """
+    Encodes the events of the file at `path`, read from the event cache,
+    returning None for songs that can't be used, including files music21
+    fails to parse, so one malformed file doesn't end the batch stream.
+    Defined at module level so it can run in a process pool.
+    """
+    try:
+        events = remove_drums(EventCache(event_dir).get(path))
+        return slice_sample(encode_events(events, sample_range), sample_range)
+    except Exception as e:
+        print(f'skipping {path}: {type(e).__name__}: {e}')
+        return None
+
+
+def build_scale(events):
+    """
+    Returns:
+        scale (np.ndarray): degree 1 - 12 of each pitch class (C = 0) in the
+            major key of the events. Minor keys are converted to their relative
+            major.
     """
-    _score_gen = (open_midi(path, remove_drums=True).flat for path in file_list)
-
-    # create dict of key relative degrees (1 - 7)
-
-    def _gen_score_tensor():
-        def _build_scale_new(_score):
-            key = _score.analyze('key')
-
-            default_degrees = {'A': 0, 'A#': 1, 'B-': 1, 'B': 2, 'C': 3,
-                               'C#': 4, 'D-': 4, 'D': 5, 'D#': 6, 'E-': 6,
-                               'E': 7, 'F': 8, 'F#': 9, 'G-': 10, 'G': 11,
-                               'G#': 11, 'A-': 11}
-            key_idx = default_degrees[key]
-            shifted_degrees = {k: v - key_idx for k, v in default_degrees}
-            degrees = {k: v if v >= 0 else 12 + v for k, v in shifted_degrees}
-            print(key, degrees)
-
-        def _build_scale(_score):
-            key = _score.analyze('key')
-            if key.type == 'major':
-                pitch_list = [1, 3, 5, 6, 8, 10, 12]
-                _scale = {pitch.name: pitch_list[i]
-                          for i, pitch in enumerate(key.pitches[0:7])}
-            elif key.type == 'minor':
-                # convert to major key
-                pitch_list = [10, 12, 1, 3, 5, 6, 8]
-                _scale = {pitch.name: pitch_list[i]
-                          for i, pitch in enumerate(key.pitches[0:7])}
-            else:
-                raise ValueError()
-
-            scale_lookup = {v: k for k, v in _scale.items()}
-            for i in (set(range(1, 13)) - set(pitch_list)):
-                note_below = music21.note.Note(scale_lookup[i - 1])
-                name = note_below.transpose(1).name
-                _scale.update({name: i})
-
-            # update synonymous sharps and flats
-            sharps = ('A#', 'C#', 'D#', 'F#', 'G#')
-            flats = ('B-', 'D-', 'E-', 'G-', 'A-')
-            synonyms = {sharps[i]: flats[i] for i in range(len(sharps))}
-            synonyms.update({flats[i]: sharps[i] for i in range(len(flats))})
-            _scale.update({k: _scale[synonyms[k]]
-                           for k in synonyms if k not in _scale})
-            return _scale
-
-        def _update_vector_octave(_time, _event, _type):
-            # get row of tone vector
-            if _type == 'melody':
-                vector_row = 0
-            elif _type == 'chord':
-                vector_row = 1
-            else:
-                raise ValueError()
-
-            octave = _event.octave
-            octave_norm = octave / 7
-            octave_feature_idx = 12
-            song_dict[_time][vector_row][octave_feature_idx] = octave_norm
-
-        def _update_vector_note(_time, _event, _type):
-            # get row of tone vector
-            if _type == 'melody':
-                vector_row = 0
-            elif _type == 'chord':
-                vector_row = 1
-            else:
-                raise ValueError()
-            try:
-                tone = scale[_event.name]
-            except:
-                ipdb.set_trace()
-            tone_idx = tone - 1
-            song_dict[_time][vector_row][tone_idx] = 1
-
-        def _update_vector_duration(_time, _event, _type):
-            # get row of tone vector
-            if _type == 'melody':
-                vector_row = 0
-            elif _type == 'chord':
-                vector_row = 1
-            else:
-                raise ValueError()
-
-            duration = _event.duration._qtrLength
-            duration_feature_idx = 13
-            song_dict[_time][vector_row][duration_feature_idx] = duration
-
-        def _fill_missing_vectors():
-            """
-            Adds blank vectors to tensor for timesteps with no notes so that time
-            integrity is maintained in output tensor
-            """
-            time_list = sorted(song_dict)
-            end_time = max(time_list)
-            min_space = min([j - i for i, j in zip(time_list[:-1], time_list[1:])])
-            expected_times = np.array(range(int(end_time / min_space))) * min_space
-            missing_times = set(expected_times) - set(time_list)
-            if missing_times:
-                song_dict.update({time: tone_vector_init for time in missing_times})
-
-        def _slice_tensors_in_time(_tensor):
-            """
-            Slices tensors to timesteps of song specified by sample_range. Y is one
-            timestep ahead of X, but both tensors are the same size.
-            Args:
-                _tensor (np.ndarray):
-
-            Returns:
-                _X (np.ndarray):
-                _Y (np.ndarray):
-            """
-            X_start = sample_range[0]
-            X_end = sample_range[1]
-            Y_start = sample_range[0] + 1
-            Y_end = sample_range[1] + 1
-            len_ = sample_range[1] - sample_range[0]
-            if len(_tensor) >= Y_end:
-                _X = _tensor[X_start:X_end]
-                _Y = _tensor[Y_start:Y_end]
-            elif X_start < len(_tensor) < Y_start:
-                _X = _tensor[-len_ - 1:-1]
-                _Y = _tensor[-len_:]
-            else:
-                raise ValueError('song too short')
-            return _X, _Y
-
-        for score_i in range(batch_size):
-            score = next(_score_gen)
-            scale = _build_scale(score)
-            # 12 tones in octave + octave number + duration
-            tone_vector_init = np.zeros((2, 14))
-            song_dict = dict()
-
-            for event in score.notesAndRests:
-                if len(song_dict) >= sample_range[1]:
-                    break
-
-                time = event.offset
-                if time not in song_dict:
-                    song_dict[time] = tone_vector_init
-
-                if isinstance(event, music21.note.Note):
-                    _update_vector_octave(time, event, 'melody')
-                    _update_vector_duration(time, event, 'melody')
-                    _update_vector_note(time, event, 'melody')
-
-                elif isinstance(event, music21.chord.Chord):
-                    low_note = event[0]
-                    _update_vector_octave(time, low_note, 'chord')
-                    _update_vector_duration(time, event, 'chord')
-                    for note in event:
-                        _update_vector_note(time, note, 'chord')
-
-                elif isinstance(event, music21.note.Rest):
-                    pass
-
-                else:
-                    raise ValueError()
-
-            _fill_missing_vectors()
-            tensor = np.array([song_dict[t].flatten() for t in sorted(song_dict)])
-            X, Y = _slice_tensors_in_time(tensor)
-
-            yield X, Y
-
-    n_batches = floor(len(file_list) / batch_size)
-    for batch_i in range(n_batches):
-
-        # initialize 3D tensors
-        X_batch = None
-        Y_batch = None
-
-        # generate tensor for each score in batch and append to batch tensor
-        for score_i in range(batch_size):
-            X, Y = next(_gen_score_tensor())
-            if X_batch is None:
-
-                # expand X and Y to the "score" dimension so all scores in the
-                # batch can be stacked on axis 0
-                X_batch = np.expand_dims(X, axis=0)
-                Y_batch = np.expand_dims(Y, axis=0)
-            else:
-                X_expanded = np.expand_dims(X, axis=0)
-                Y_expanded = np.expand_dims(Y, axis=0)
-
-                X_batch = np.concatenate((X_batch, X_expanded))
-                Y_batch = np.concatenate((Y_batch, Y_expanded))
-
-            # transpose Y to use as time series outputs
-        Y_batch = np.swapaxes(Y_batch, 0, 1)
-
-        yield X_batch, Y_batch
-
-        # for i in range(len(X_batch)):
-        #     X = X_batch[i]
-        #     Y = Y_batch[i]
-        #     yield X, Y
+    note_ints = midi_to_roll_index(events['pitch'].astype(int))
+    return SCALE_DEGREES[detect_key(note_ints, events['duration'])]
 
 
 def gen_midi(tone_tensor):
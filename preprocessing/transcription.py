@@ -0,0 +1,190 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import numpy as np
+import os
+import sys
+import time
+import traceback
+import librosa
+
+from feature_store import FeatureStore
+from fundamental_freq import SpectralAnalyzer, SAMPLE_RATE, WINDOW_SIZE
+from vocal_extraction import list_audio_files, output_names
+
+# the datastore and piano roll live at the repository root next to lstm.py
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datastore import Datastore
+from keys import KEY_NAMES, detect_key, transpose_to_a
+from piano_roll import midi_to_roll_index
+
+# prefix of transcribed song names, keeping them apart from MIDI songs
+SONG_PREFIX = 'audio%2F'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Transcribe isolated-vocal audio into the LSTM training datastore.')
+    parser.add_argument('inputs', nargs='+', help='audio files or directories of audio files')
+    parser.add_argument('--hdf5-path', default='data/songs.hdf5',
+                        help='datastore, or the .json manifest of a sharded datastore')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: number of cores)')
+    parser.add_argument('--grid', type=float, default=0.5,
+                        help='timestep spacing in quarter notes')
+    parser.add_argument('--feature-store', default=None,
+                        help='directory of a feature store to reuse spectral features from')
+    args = parser.parse_args()
+
+    store = FeatureStore(args.feature_store) if args.feature_store else None
+    report = transcribe_batch(args.inputs, args.hdf5_path, n_workers=args.workers,
+                              grid=args.grid, store=store)
+    print(f"{len(report['written'])} written, {len(report['skipped'])} already stored, "
+          f"{len(report['failed'])} failed")
+    for path, error in report['failed'].items():
+        print(f'{path}: {error}')
+
+
+def transcribe(path, grid=0.5, window_size=WINDOW_SIZE, sample_rate=SAMPLE_RATE,
+               threshold_multiplier=None, threshold_window_size=None, store=None):
+    """
+    Transcribes a monophonic (e.g. isolated vocal) recording into piano roll
+    timesteps, in the same representation `TunatorLSTM.update_datastore`
+    produces from MIDI files.
+
+    Note onsets and their fundamental frequencies come from `SpectralAnalyzer`.
+    Onset times are converted to quarter notes with the tempo estimated by
+    librosa's beat tracker and quantized to `grid`. The notes are transposed to
+    A using the key detected from them, and only timesteps with notes
+    are kept, with their grid positions, as for MIDI songs.
+    Args:
+        path (str): audio file
+        grid (float): timestep spacing in quarter notes
+        window_size (int): analysis window size in samples
+        sample_rate (int): rate the audio is resampled to
+        threshold_multiplier (float): onset threshold multiplier, see
+            `SpectralAnalyzer`
+        threshold_window_size (int): onset threshold window, see
+            `SpectralAnalyzer`
+        store (FeatureStore): cache for the spectral features
+
+    Returns:
+        notes (list[np.ndarray]): piano roll integers of each timestep
+        positions (np.ndarray): grid position of each timestep
+        info (dict): `tempo`, `key` and number of `onsets` found
+    """
+    signal, _ = librosa.load(path, sr=sample_rate)
+    analyzer = SpectralAnalyzer(window_size, threshold_multiplier=threshold_multiplier,
+                                threshold_window_size=threshold_window_size,
+                                sample_rate=sample_rate)
+    if store is None:
+        onsets, freqs = analyzer.analyze(signal)
+    else:
+        params = {
+            'stage': 'transcription', 'window_size': window_size, 'sample_rate': sample_rate,
+            'threshold_multiplier': analyzer._threshold_multiplier,
+            'threshold_window_size': analyzer._thresholding_window_size,
+        }
+        features = store.get_or_compute(
+            signal, params, lambda: dict(zip(('onsets', 'freqs'), analyzer.analyze(signal))))
+        onsets, freqs = features['onsets'], features['freqs']
+
+    frames = np.flatnonzero(np.isfinite(freqs) & (freqs > 0))
+    if not len(frames):
+        raise ValueError(f'no pitched onsets found in {path}')
+    midi = np.rint(69 + 12 * np.log2(freqs[frames] / 440.)).astype(int)
+
+    tempo, _ = librosa.beat.beat_track(y=signal, sr=sample_rate)
+    tempo = float(np.atleast_1d(tempo)[0])
+    if not tempo > 0:
+        raise ValueError(f'could not estimate the tempo of {path}')
+    seconds_per_step = 60. / tempo * grid
+    steps = np.rint(frames * window_size / sample_rate / seconds_per_step).astype(int)
+
+    # transpose to A
+    key = detect_key(midi_to_roll_index(midi))
+    midi = transpose_to_a(midi, key)
+
+    # map to the piano roll, dropping pitches outside of it
+    note_ints = midi_to_roll_index(midi)
+    keep = note_ints >= 0
+    steps, note_ints = steps[keep], note_ints[keep]
+    if not len(steps):
+        raise ValueError(f'no pitches of {path} fit the piano roll')
+
+    # merge the notes of each occupied timestep
+    order = np.lexsort((note_ints, steps))
+    steps, note_ints = steps[order], note_ints[order]
+    positions, starts = np.unique(steps, return_index=True)
+    notes = [np.unique(step_notes) for step_notes in np.split(note_ints, starts[1:])]
+    return notes, positions, {'tempo': tempo, 'key': KEY_NAMES[key], 'onsets': len(frames)}
+
+
+def transcribe_batch(inputs, hdf5_path='data/songs.hdf5', n_workers=None, grid=0.5, store=None,
+                     **kwargs):
+    """
+    Transcribes audio files in parallel and writes them to the datastore as
+    `songs/<name>`, with `source` and `file` attributes on the song
+    group so `TunatorLSTM` can include them in its training corpus, and the
+    grid position of each timestep. Songs are named by `SONG_PREFIX` and
+    `vocal_extraction.output_names` of the files, so they don't collide with
+    each other or with MIDI songs, and songs already in the datastore are
+    skipped. Transcription runs in a process pool while this
+    process is the only writer to the HDF5 file.
+    Args:
+        inputs (list[str]): audio files or directories of audio files
+        hdf5_path (str): path of the datastore, or the manifest of a sharded
+            datastore
+        n_workers (int): number of worker processes, defaults to the number of
+            cores
+        grid (float): timestep spacing in quarter notes
+        store (FeatureStore): cache for the spectral features
+        **kwargs: passed to `transcribe`
+
+    Returns:
+        report (dict): `written` songs with their tempo, key and timestep count,
+            `skipped` songs and `failed` files with their errors
+    """
+    paths = list_audio_files(inputs)
+    datastore = Datastore(hdf5_path)
+    existing = set(datastore.songs())
+
+    report = {'written': dict(), 'skipped': list(), 'failed': dict()}
+    songs = dict()
+    for path, name in output_names(paths).items():
+        song = SONG_PREFIX + name
+        if song in existing or song in songs:
+            report['skipped'].append(song)
+        else:
+            songs[song] = path
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_transcribe_timed, path, grid, store, kwargs): song
+                   for song, path in songs.items()}
+        for future in as_completed(futures):
+            song = futures[future]
+            path = songs[song]
+            result = future.result()
+            if 'error' in result:
+                print(f'failed: {path}')
+                report['failed'][path] = result['error']
+                continue
+            datastore.write_song(song, result['notes'], grid, positions=result['positions'],
+                                 attrs={'source': 'audio', 'file': path})
+            info = result['info']
+            info.update(steps=len(result['notes']), seconds=result['seconds'])
+            report['written'][song] = info
+            print(f'transcribed {path}: {info}')
+    return report
+
+
+def _transcribe_timed(path, grid, store, kwargs):
+    start = time.time()
+    try:
+        notes, positions, info = transcribe(path, grid=grid, store=store, **kwargs)
+    except Exception:
+        return {'error': traceback.format_exc()}
+    return {'notes': notes, 'positions': positions, 'info': info, 'seconds': time.time() - start}
+
+
+if __name__ == '__main__':
+    main()
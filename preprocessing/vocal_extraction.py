@@ -1,33 +1,250 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import json
 import numpy as np
 import os
-import matplotlib.pyplot as plt
+import sys
+import time
+import traceback
 import librosa
 import soundfile as sf
 
-from pydub import AudioSegment
+from feature_store import FeatureStore
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from discovery import song_name
 
-import librosa.display
 # rate, data = wf.read('clairvoyant.wav')
 
+AUDIO_EXTS = ('.wav', '.flac', '.ogg', '.aiff', '.aif')
+
 
 def main():
-    orig_filepath = "music/the_story_so_far/The Story So Far 'Small Talk'-LHIVOa-9AgE.wav"
-    sides_subtracted = 'sides_subtracted.wav'
-    vocals_isolated = 'vocals_isolated.wav'
-    vocals_isolated_phased = 'vocals_isolated_phased.wav'
-    working_dir = 'working_dir'
+    parser = argparse.ArgumentParser(
+        description='Isolate vocals by mid/side subtraction and soft-mask separation.')
+    parser.add_argument('inputs', nargs='*', help='audio files or directories of audio files')
+    parser.add_argument('--output-dir', default='working_dir')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: number of cores)')
+    parser.add_argument('--chunked', action='store_true',
+                        help='separate in overlapping blocks to bound memory on long recordings')
+    parser.add_argument('--plot', action='store_true', help='show spectrogram figures')
+    parser.add_argument('--write-sides', action='store_true',
+                        help='also write the mid channel to sides_subtracted.wav')
+    parser.add_argument('--mmap', action='store_true',
+                        help='memory-map PCM WAV input instead of decoding it into memory')
+    parser.add_argument('--feature-store', default=None,
+                        help='directory of a feature store to reuse spectrograms from')
+    parser.add_argument('--feature-store-bytes', type=int, default=2 * 1024 ** 3,
+                        help='disk budget of the feature store')
+    args = parser.parse_args()
+
+    store = None
+    if args.feature_store:
+        store = FeatureStore(args.feature_store, max_bytes=args.feature_store_bytes)
+    if not args.inputs:
+        orig_filepath = "music/the_story_so_far/The Story So Far 'Small Talk'-LHIVOa-9AgE.wav"
+        extract_vocals(orig_filepath, args.output_dir, chunked=args.chunked, plot=True,
+                       write_sides=args.write_sides, mmap=args.mmap, store=store)
+        return
+    extract_vocals_batch(args.inputs, args.output_dir, n_workers=args.workers,
+                         chunked=args.chunked, plot=args.plot, write_sides=args.write_sides,
+                         mmap=args.mmap, store=store)
+
+
+def extract_vocals(path, output_dir, chunked=False, plot=False, write_sides=False, mmap=False,
+                   store=None):
+    """
+    Isolates the vocals of the stereo recording at `path`. The side channel is
+    subtracted first with `subtract_sides`, which removes everything panned
+    away from the center, then the remaining center channel is separated into
+    foreground and background with `separate_vocals`. Writes
+    `vocals_isolated.wav` (foreground magnitude only, not with `chunked`) and
+    `vocals_isolated_phased.wav` to `output_dir`.
+    Args:
+        path (str): path of a stereo audio file
+        output_dir (str): directory to write the outputs to. Created if missing.
+        chunked (bool): separate with `extract_vocals_chunked`, which reads and
+            downmixes the recording block by block itself
+        plot (bool): show spectrograms of the full, background and foreground
+            signal
+        write_sides (bool): also write the center channel to
+            `sides_subtracted.wav`
+        mmap (bool): see `subtract_sides`
+        store (FeatureStore): feature store to read the spectrograms from, or
+            to add them to. Not used with `chunked`.
+
+    Returns:
+        output_path (str): path of the phased vocals
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    sides_subtracted = os.path.join(output_dir, 'sides_subtracted.wav')
+    vocals_isolated = os.path.join(output_dir, 'vocals_isolated.wav')
+    vocals_isolated_phased = os.path.join(output_dir, 'vocals_isolated_phased.wav')
+
+    if chunked:
+        extract_vocals_chunked(path, vocals_isolated_phased)
+        return vocals_isolated_phased
+
+    y, sr = subtract_sides(path, mmap=mmap)
+    if write_sides:
+        sf.write(sides_subtracted, y, sr, subtype='PCM_24')
+
+    S_full, phase, S_foreground, S_background = spectral_features(y, sr, store=store)
+    if plot:
+        plot_spectrograms(S_full, S_background, S_foreground, sr)
+
+    sf.write(vocals_isolated, librosa.istft(S_foreground), sr, subtype='PCM_24')
+    D_foreground = S_foreground * phase
+    sf.write(vocals_isolated_phased, librosa.istft(D_foreground), sr, subtype='PCM_24')
+    return vocals_isolated_phased
+
+
+def extract_vocals_batch(inputs, output_dir, n_workers=None, chunked=False, plot=False,
+                         write_sides=False, mmap=False, store=None):
+    """
+    Runs `extract_vocals` over many recordings in a process pool. The outputs
+    of each recording go to `<output_dir>/<recording name>/`, see
+    `output_names`. A recording that fails is reported and doesn't stop the
+    others.
+    Args:
+        inputs (str or list[str]): a directory, or a list of audio files and
+            directories. Directories are searched non-recursively for files
+            with one of `AUDIO_EXTS`.
+        output_dir (str): directory for the outputs and `report.json`
+        n_workers (int): number of worker processes. Defaults to the number of
+            cores.
+        chunked (bool): see `extract_vocals`
+        plot (bool): see `extract_vocals`. Only useful with a display.
+        write_sides (bool): see `extract_vocals`
+        mmap (bool): see `extract_vocals`
+        store (FeatureStore): see `extract_vocals`
 
-    sound_stereo = AudioSegment.from_file(orig_filepath, format='wav')
-    os.chdir(working_dir)
+    Returns:
+        report (list[dict]): per file: `file`, `output`, `status` ('ok' or
+            'failed'), `seconds` and, for failures, `error`
+    """
+    paths = list_audio_files(inputs)
+    os.makedirs(output_dir, exist_ok=True)
+    report = list()
+    start = time.time()
+    with ProcessPoolExecutor(n_workers) as executor:
+        futures = list()
+        for path, name in output_names(paths).items():
+            futures.append(executor.submit(
+                _extract_vocals_timed, path, os.path.join(output_dir, name), chunked, plot,
+                write_sides, mmap, store))
+        for future in as_completed(futures):
+            result = future.result()
+            print(f'{result["status"]}: {result["file"]} ({result["seconds"]:.1f}s)')
+            report.append(result)
 
-    sound_L = sound_stereo.split_to_mono()[0]
-    sound_R = sound_stereo.split_to_mono()[1]
-    sound_S = sound_L + sound_R.invert_phase()
-    sound_voice = sound_stereo + sound_S.invert_phase()
-    sound_voice.export(sides_subtracted, format='wav')
+    report.sort(key=lambda result: result['file'])
+    with open(os.path.join(output_dir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    n_failed = sum(result['status'] == 'failed' for result in report)
+    print(f'{len(report) - n_failed}/{len(report)} files processed in '
+          f'{time.time() - start:.1f}s, {n_failed} failed')
+    return report
 
-    y, sr = librosa.load(sides_subtracted)
-    S_full, phase = librosa.magphase(librosa.stft(y))
+
+def list_audio_files(inputs):
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    paths = list()
+    for item in inputs:
+        if os.path.isdir(item):
+            paths += sorted(
+                os.path.join(item, fname) for fname in os.listdir(item)
+                if os.path.splitext(fname)[1].lower() in AUDIO_EXTS)
+        else:
+            paths.append(item)
+    return paths
+
+
+def output_names(paths):
+    """
+    Names the output directories of `paths` uniquely. Each recording is named
+    after its path relative to the deepest directory containing all of them,
+    without the extension and with '/' encoded as in `discovery.song_name`.
+    Recordings that only differ by extension keep it, e.g. 'x.wav' and
+    'x.flac'.
+
+    Returns:
+        names (dict): paths and their output directory names
+    """
+    if not paths:
+        return dict()
+    dirs = [os.path.dirname(os.path.abspath(path)) for path in paths]
+    root = os.path.commonpath(dirs)
+    rel_paths = [os.path.relpath(os.path.abspath(path), root).replace(os.sep, '/')
+                 for path in paths]
+    names = [song_name(rel_path) for rel_path in rel_paths]
+    counts = dict()
+    for name in names:
+        counts[name] = counts.get(name, 0) + 1
+    return {path: name + os.path.splitext(rel_path)[1] if counts[name] > 1 else name
+            for path, rel_path, name in zip(paths, rel_paths, names)}
+
+
+def _extract_vocals_timed(path, output_dir, chunked, plot, write_sides, mmap, store):
+    start = time.time()
+    result = {'file': path, 'output': None, 'status': 'ok'}
+    try:
+        result['output'] = extract_vocals(path, output_dir, chunked=chunked, plot=plot,
+                                          write_sides=write_sides, mmap=mmap, store=store)
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.time() - start
+    return result
+
+
+def subtract_sides(path, sr=22050, mmap=False):
+    """
+    Removes the side channel (L - R) of a stereo recording, leaving the center
+    channel (L + R) / 2 where vocals are usually mixed. The file is decoded once
+    into a NumPy array, so the result can go straight to the STFT.
+    Args:
+        path (str): path of the audio file. Mono files are returned as is.
+        sr (int): sample rate to resample to, None to keep the file's rate. The
+            default matches the `librosa.load` default used previously.
+        mmap (bool): memory-map the samples of a PCM WAV file instead of
+            decoding them into memory
+
+    Returns:
+        y (np.ndarray): center channel as float32
+        sr (int): sample rate of `y`
+    """
+    if mmap:
+        from scipy.io import wavfile
+        file_sr, data = wavfile.read(path, mmap=True)
+        scale = 1.
+        if data.dtype.kind == 'i':
+            scale = -1 / np.iinfo(data.dtype).min
+        elif data.dtype.kind == 'u':  # 8-bit PCM is unsigned
+            data = data.astype(np.float32) - 128
+            scale = 1 / 128
+    else:
+        data, file_sr = sf.read(path, dtype='float32', always_2d=True)
+        scale = 1.
+
+    if data.ndim == 1:
+        y = data.astype(np.float32) * scale
+    elif data.shape[1] == 1:
+        y = data[:, 0].astype(np.float32) * scale
+    else:
+        y = (data[:, 0].astype(np.float32) + data[:, 1]) * (.5 * scale)
+    if sr is not None and sr != file_sr:
+        y = librosa.resample(y, orig_sr=file_sr, target_sr=sr)
+    else:
+        sr = file_sr
+    return y, sr
+
+
+def plot_spectrograms(S_full, S_background, S_foreground, sr):
+    import matplotlib.pyplot as plt
+    import librosa.display
 
     plt.figure(figsize=(12, 4))
     librosa.display.specshow(librosa.amplitude_to_db(S_full, ref=np.max), y_axis='log',
@@ -36,17 +253,6 @@ def main():
     plt.colorbar()
     plt.tight_layout()
 
-    S_filter = librosa.decompose.nn_filter(S_full, aggregate=np.median, metric='cosine',
-                                           width=int(librosa.time_to_frames(2, sr=sr)))
-    S_filter = np.minimum(S_full, S_filter)
-
-    margin_i, margin_v = 2, 10
-    power = 2
-    mask_i = librosa.util.softmask(S_filter, margin_i * (S_full - S_filter), power=power)
-    mask_v = librosa.util.softmask(S_full - S_filter, margin_v * S_filter, power=power)
-    S_foreground = mask_v * S_full
-    S_background = mask_i * S_full
-
     plt.figure(figsize=(12, 8))
     plt.subplot(3, 1, 1)
     librosa.display.specshow(librosa.amplitude_to_db(S_full, ref=np.max), y_axis='log',
@@ -66,9 +272,140 @@ def main():
     plt.tight_layout()
     plt.show()
 
-    sf.write(vocals_isolated, librosa.istft(S_foreground), sr, subtype='PCM_24')
-    D_foreground = S_foreground * phase
-    sf.write(vocals_isolated_phased, librosa.istft(D_foreground), sr, subtype='PCM_24')
+
+def spectral_features(y, sr, store=None, n_fft=2048, hop_length=512, margin_i=2, margin_v=10,
+                      power=2, width_seconds=2):
+    """
+    STFT magnitude and phase of `y`, and its foreground and background
+    magnitudes from `separate_vocals`, with the separation parameters
+    `margin_i`, `margin_v`, `power` and `width_seconds`. With a `store`, the
+    features are read from it if they were computed for the same audio and
+    parameters before, and added to it otherwise.
+
+    Returns:
+        S_full, phase, S_foreground, S_background (np.ndarray): spectrograms
+    """
+    def _stft():
+        S_full, phase = librosa.magphase(librosa.stft(y, n_fft=n_fft, hop_length=hop_length))
+        return {'magnitude': S_full, 'phase': phase}
+
+    stft_params = {'stage': 'stft', 'sr': sr, 'n_fft': n_fft, 'hop_length': hop_length}
+    if store is None:
+        stft = _stft()
+    else:
+        stft = store.get_or_compute(y, stft_params, _stft)
+    S_full, phase = stft['magnitude'], stft['phase']
+
+    separate_params = {'margin_i': margin_i, 'margin_v': margin_v, 'power': power,
+                       'width_seconds': width_seconds}
+
+    def _separate():
+        S_foreground, S_background = separate_vocals(S_full, sr, **separate_params)
+        return {'foreground': S_foreground, 'background': S_background}
+
+    if store is None:
+        separated = _separate()
+    else:
+        separated = store.get_or_compute(
+            y, dict(stft_params, stage='separate_vocals', **separate_params), _separate)
+    return S_full, phase, separated['foreground'], separated['background']
+
+
+def separate_vocals(S_full, sr, margin_i=2, margin_v=10, power=2, width_seconds=2):
+    """
+    Separates a magnitude spectrogram into foreground (vocals) and background
+    with soft masks. The background is estimated by a median over the
+    nearest-neighbor frames of each frame by cosine similarity, considering
+    only neighbors at least `width_seconds` away.
+    Args:
+        S_full (np.ndarray): magnitude spectrogram
+        sr (int): sample rate of the audio
+        margin_i (float): mask margin for the background
+        margin_v (float): mask margin for the foreground
+        power (float): exponent of the soft masks
+        width_seconds (float): minimum time between neighboring frames. Cut
+            down to what fits in spectrograms shorter than twice the width.
+
+    Returns:
+        S_foreground (np.ndarray): foreground magnitude spectrogram
+        S_background (np.ndarray): background magnitude spectrogram
+    """
+    # nn_filter needs the width below half of the number of frames
+    width = min(int(librosa.time_to_frames(width_seconds, sr=sr)), (S_full.shape[-1] - 1) // 2 - 1)
+    if width < 1:
+        raise ValueError(f'{S_full.shape[-1]} frames are too few to separate')
+    S_filter = librosa.decompose.nn_filter(S_full, aggregate=np.median, metric='cosine',
+                                           width=width)
+    S_filter = np.minimum(S_full, S_filter)
+
+    mask_i = librosa.util.softmask(S_filter, margin_i * (S_full - S_filter), power=power)
+    mask_v = librosa.util.softmask(S_full - S_filter, margin_v * S_filter, power=power)
+    S_foreground = mask_v * S_full
+    S_background = mask_i * S_full
+    return S_foreground, S_background
+
+
+def extract_vocals_chunked(in_path, out_path, block_seconds=30, overlap_seconds=4, **kwargs):
+    """
+    Vocal extraction for long recordings in bounded memory. The audio is read
+    in blocks of `block_seconds` overlapping by `overlap_seconds`, and each
+    block is separated with `separate_vocals` on its own, so the
+    nearest-neighbor search, which grows quadratically with the number of
+    frames, only spans one block. The phased foreground of each block is
+    resynthesized and crossfaded with the previous block over the overlap
+    (overlap-add with complementary sin² ramps), and finished audio is written
+    to `out_path` as it is produced. A remainder shorter than half a block is
+    folded into the last full block rather than separated on its own, so peak
+    memory depends on the block length only, not on the length of the
+    recording.
+
+    Audio is processed at the file's own sample rate and downmixed to mono,
+    which for a stereo file is its center channel, see `subtract_sides`.
+    For a recording no longer than one block the output is the same as
+    separating the full track at that rate.
+    Args:
+        in_path (str): path of the audio to separate
+        out_path (str): path of the WAV file to write the vocals to
+        block_seconds (float): length of each block
+        overlap_seconds (float): overlap between consecutive blocks. Should be
+            a few seconds so that STFT edge effects are crossfaded away.
+        **kwargs: passed on to `separate_vocals`
+    """
+    with sf.SoundFile(in_path) as f_in:
+        sr = f_in.samplerate
+        block = int(block_seconds * sr)
+        overlap = int(overlap_seconds * sr)
+        if not 0 < overlap < block:
+            raise ValueError('overlap must be positive and shorter than a block')
+        fade_in = np.sin(.5 * np.pi * np.linspace(0, 1, overlap)) ** 2
+        fade_out = 1 - fade_in
+        n_frames = f_in.frames
+        step = block - overlap
+
+        with sf.SoundFile(out_path, 'w', sr, channels=1, subtype='PCM_24') as f_out:
+            tail = None
+            start = 0
+            while start < n_frames:
+                stop = start + block
+                if n_frames - (start + step) < block // 2:
+                    # the next block would be too short to separate on its own
+                    stop = n_frames
+                f_in.seek(start)
+                y = f_in.read(min(stop, n_frames) - start, dtype='float64', always_2d=True)
+                y = y.mean(axis=1)
+                S_full, phase = librosa.magphase(librosa.stft(y))
+                S_foreground, _ = separate_vocals(S_full, sr, **kwargs)
+                vocals = librosa.istft(S_foreground * phase, length=len(y))
+
+                if tail is not None:
+                    vocals[:overlap] = fade_in * vocals[:overlap] + fade_out * tail
+                if stop >= n_frames:
+                    f_out.write(vocals)
+                    break
+                # hold back the overlap to crossfade it with the next block
+                f_out.write(vocals[:-overlap])
+                tail = vocals[-overlap:]
+                start += step
 
 
 if __name__ == '__main__':
@@ -0,0 +1,275 @@
+"""
+Named timers and counters for the stages of the pipeline.
+
+Stages are timed with the `stage` context manager or the `profiled`
+decorator, and events are counted with `count`. Both are no-ops until
+profiling is enabled, either with `enable` (see the `--profile` option of
+`tunator.py`) or by setting the `TUNATOR_PROFILE` environment variable:
+
+    TUNATOR_PROFILE=1                    print the report at exit
+    TUNATOR_PROFILE=profile.json         also write it as JSON
+    TUNATOR_PROFILE=tunator.prom         also write it in the Prometheus
+                                         text-file format
+    TUNATOR_PROFILE_CAPTURE=read_seqs    run cProfile around one stage
+    TUNATOR_PROFILE_CAPTURE=read_seqs:tracemalloc
+                                         trace its allocations instead
+
+The durations of every stage are kept, so the report has exact p50 and p95.
+"""
+import atexit
+from contextlib import contextmanager
+import functools
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+CAPTURE_MODES = ('cprofile', 'tracemalloc')
+
+
+class Profiler:
+    """
+    Collects stage durations and counters. An optional capture runs cProfile
+    or tracemalloc around every call of a single stage, since profiling
+    every stage at once would distort the timings of all of them.
+
+    Args:
+        output (str): path the report is written to by `dump`. Paths ending in
+            `.prom` are written in the Prometheus text-file format, others as
+            JSON. Only printed if None.
+        capture (str): name of the stage to capture, optionally followed by
+            `:cprofile` (the default) or `:tracemalloc`
+    """
+    def __init__(self, output=None, capture=None):
+        self.output = output
+        self.durations = dict()
+        self.counters = dict()
+        self._lock = threading.Lock()
+        self.capture_stage, self.capture_mode = None, None
+        if capture:
+            stage_name, _, mode = capture.partition(':')
+            mode = mode or 'cprofile'
+            if mode not in CAPTURE_MODES:
+                raise ValueError(f'unknown capture mode {mode}, expected one of {CAPTURE_MODES}')
+            self.capture_stage, self.capture_mode = stage_name, mode
+        self._cprofile = None
+        self._peaks = list()
+
+    @contextmanager
+    def stage(self, name):
+        capturing = name == self.capture_stage
+        if capturing:
+            self._start_capture()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if capturing:
+                self._stop_capture()
+            with self._lock:
+                self.durations.setdefault(name, list()).append(seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _start_capture(self):
+        if self.capture_mode == 'cprofile':
+            import cProfile
+
+            if self._cprofile is None:
+                self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        else:
+            import tracemalloc
+
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+
+    def _stop_capture(self):
+        if self.capture_mode == 'cprofile':
+            self._cprofile.disable()
+        else:
+            import tracemalloc
+
+            self._peaks.append(tracemalloc.get_traced_memory()[1])
+
+    def report(self):
+        """
+        Returns:
+            report (dict): `stages` with the `count`, `total`, `mean`, `p50`,
+                `p95` and `max` of their durations in seconds, and `counters`.
+                With a tracemalloc capture, the captured stage also has the
+                `p50_peak_bytes` and `max_peak_bytes` of its calls.
+        """
+        with self._lock:
+            durations = {name: sorted(seconds) for name, seconds in self.durations.items()}
+            counters = dict(self.counters)
+        stages = dict()
+        for name, seconds in sorted(durations.items()):
+            stages[name] = {
+                'count': len(seconds),
+                'total': sum(seconds),
+                'mean': sum(seconds) / len(seconds),
+                'p50': percentile(seconds, 50),
+                'p95': percentile(seconds, 95),
+                'max': seconds[-1],
+            }
+        if self._peaks and self.capture_stage in stages:
+            peaks = sorted(self._peaks)
+            stages[self.capture_stage].update(p50_peak_bytes=percentile(peaks, 50),
+                                              max_peak_bytes=peaks[-1])
+        return {'stages': stages, 'counters': dict(sorted(counters.items()))}
+
+    def to_prometheus(self, prefix='tunator'):
+        """
+        Returns:
+            text (str): the report in the Prometheus exposition format, stage
+                durations as a summary and counters as counters
+        """
+        report = self.report()
+        lines = [f'# TYPE {prefix}_stage_seconds summary']
+        for name, stats in report['stages'].items():
+            label = _label(name)
+            for quantile in ('p50', 'p95'):
+                lines.append(f'{prefix}_stage_seconds{{stage="{label}",quantile="0.{quantile[1:]}"}} '
+                             f'{stats[quantile]!r}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{label}"}} {stats["total"]!r}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{label}"}} {stats["count"]}')
+        lines.append(f'# TYPE {prefix}_events_total counter')
+        for name, value in report['counters'].items():
+            lines.append(f'{prefix}_events_total{{name="{_label(name)}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def print_report(self):
+        report = self.report()
+        print(f"{'stage':<24}{'count':>8}{'total s':>10}{'p50 ms':>10}{'p95 ms':>10}")
+        for name, stats in report['stages'].items():
+            print(f"{name:<24}{stats['count']:>8}{stats['total']:>10.3f}"
+                  f"{stats['p50'] * 1e3:>10.2f}{stats['p95'] * 1e3:>10.2f}")
+        for name, value in report['counters'].items():
+            print(f'{name:<24}{value:>8}')
+
+    def dump(self, output=None):
+        """
+        Prints the report and writes it to `output`, or to `self.output`, along
+        with the capture if there is one: cProfile stats in `<output>.pstats`,
+        loadable with `pstats.Stats`, or a tracemalloc snapshot of the memory
+        still allocated since the first captured call in
+        `<output>.tracemalloc`, loadable with `tracemalloc.Snapshot.load`.
+        """
+        output = output if output is not None else self.output
+        self.print_report()
+        if output is None:
+            return
+        if output.endswith('.prom'):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.report(), indent=2)
+        # write under a temporary name, as the text-file collector may read at any time
+        tmp_path = f'{output}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, output)
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(f'{output}.pstats')
+        if self._peaks:
+            import tracemalloc
+
+            if tracemalloc.is_tracing():
+                tracemalloc.take_snapshot().dump(f'{output}.tracemalloc')
+
+
+def percentile(values, q):
+    """
+    Returns:
+        value (float): nearest-rank percentile `q` of the sorted `values`
+    """
+    rank = max(int(-(-q * len(values) // 100)), 1)
+    return values[rank - 1]
+
+
+def _label(name):
+    return name.replace('\\', '\\\\').replace('"', '\\"')
+
+
+# the active profiler, None while profiling is disabled
+PROFILER = None
+
+
+def enable(output=None, capture=None, at_exit=True):
+    """
+    Starts profiling with a new `Profiler`, see its arguments.
+    Args:
+        at_exit (bool): whether to dump the report when the interpreter exits
+
+    Returns:
+        profiler (Profiler): the active profiler
+    """
+    global PROFILER
+    PROFILER = Profiler(output, capture)
+    if at_exit:
+        atexit.register(PROFILER.dump)
+    return PROFILER
+
+
+def disable():
+    global PROFILER
+    PROFILER = None
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name):
+    """
+    Context manager timing the block it wraps as stage `name`.
+    """
+    if PROFILER is None:
+        return _NULL_STAGE
+    return PROFILER.stage(name)
+
+
+def count(name, n=1):
+    """
+    Adds `n` to the counter `name`.
+    """
+    if PROFILER is not None:
+        PROFILER.count(name, n)
+
+
+def profiled(name):
+    """
+    Decorator timing every call of the function as stage `name`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if PROFILER is None:
+                return func(*args, **kwargs)
+            with PROFILER.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+if os.environ.get('TUNATOR_PROFILE'):
+    _output = os.environ['TUNATOR_PROFILE']
+    if _output in ('1', 'true'):
+        _output = None
+    elif multiprocessing.parent_process() is not None:
+        # child processes inherit the variable, keep them from overwriting the report
+        _root, _ext = os.path.splitext(_output)
+        _output = f'{_root}-{os.getpid()}{_ext}'
+    enable(output=_output, capture=os.environ.get('TUNATOR_PROFILE_CAPTURE'))
@@ -0,0 +1,72 @@
+import os
+import sys
+
+import h5py
+import numpy as np
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datastore import (Datastore, as_datastore, read_steps, repack, shard, song_length, song_spacing,
+                       window_layout, write_song)
+
+NOTES = [[60, 64, 67], [], [62], [59, 62, 65, 69], [60]]
+
+
+@pytest.mark.parametrize('layout', [None, window_layout(2), window_layout(2, compression='gzip',
+                                                                          compression_opts=1)])
+def test_write_song_round_trip(tmp_path, layout):
+    path = str(tmp_path / 'songs.hdf5')
+    write_song(path, 'song', NOTES, .5, layout=layout)
+    with h5py.File(path, 'r') as f:
+        grp = f['songs/song']
+        assert grp['pitches'].dtype == np.int8
+        assert grp['indptr'].dtype == np.int32
+        assert song_length(grp) == len(NOTES)
+        assert song_spacing(grp) == .5
+        assert [list(step) for step in read_steps(grp)] == NOTES
+        assert [list(step) for step in read_steps(grp, 1, 4)] == NOTES[1:4]
+        assert read_steps(grp, len(NOTES)) == []
+
+
+def test_repack_converts_vlen_notes(tmp_path):
+    src_path, dst_path = str(tmp_path / 'vlen.hdf5'), str(tmp_path / 'csr.hdf5')
+    notes = np.empty((len(NOTES), 1), dtype=object)
+    for i, step in enumerate(NOTES):
+        notes[i, 0] = np.array(step, dtype='i1')
+    with h5py.File(src_path, 'w') as f:
+        grp = f.create_group('songs/song')
+        dset = grp.create_dataset('notes', data=notes, dtype=h5py.special_dtype(vlen=np.dtype('int8')))
+        dset.attrs['spacing'] = .25
+        grp.create_dataset('positions', data=np.arange(len(NOTES), dtype='i4'))
+        grp.attrs['source'] = 'midi'
+    with h5py.File(src_path, 'r') as f:
+        assert [list(step) for step in read_steps(f['songs/song'], 2, 4)] == NOTES[2:4]
+
+    repack(src_path, dst_path)
+    with h5py.File(dst_path, 'r') as f:
+        grp = f['songs/song']
+        assert 'notes' not in grp
+        assert grp.attrs['source'] == 'midi'
+        assert song_spacing(grp) == .25
+        assert len(grp['positions']) == len(NOTES)
+        assert [list(step) for step in read_steps(grp)] == NOTES
+
+
+def test_sharded_datastore_is_created_explicitly(tmp_path):
+    manifest_path = str(tmp_path / 'songs.json')
+    with pytest.raises(FileNotFoundError, match='--shards'):
+        Datastore(manifest_path)
+    assert as_datastore(manifest_path, n_shards=4).n_shards == 4
+    assert as_datastore(manifest_path, n_shards=4).n_shards == 4
+    with pytest.raises(ValueError):
+        as_datastore(manifest_path, n_shards=2)
+
+
+def test_shard_migrates_single_file(tmp_path):
+    src_path = str(tmp_path / 'songs.hdf5')
+    for i in range(8):
+        write_song(src_path, f'song_{i}', NOTES, .5)
+    datastore = shard(src_path, str(tmp_path / 'sharded.json'), 3)
+    assert sorted(datastore.songs()) == [f'song_{i}' for i in range(8)]
+    with pytest.raises(FileExistsError):
+        shard(src_path, str(tmp_path / 'sharded.json'), 3)
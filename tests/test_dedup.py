@@ -0,0 +1,37 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datastore import write_song
+from dedup import PRIME, cluster_signatures, minhash_signatures, near_duplicate_clusters, shingles
+
+
+def test_clusters_variants_near_threshold():
+    # 5 variants of 100 pieces, with a Jaccard similarity of about .65 between variants
+    rng = np.random.RandomState(0)
+    shingle_sets = list()
+    for _ in range(100):
+        base = rng.randint(0, PRIME, size=200)
+        for _ in range(5):
+            kept = base[rng.rand(len(base)) < .88]
+            shingle_sets.append(np.unique(np.concatenate([kept, rng.randint(0, PRIME, size=10)])))
+    labels = cluster_signatures(minhash_signatures(shingle_sets), threshold=.6)
+    assert len(set(labels)) == 100
+    assert all(len(set(labels[i:i + 5])) == 1 for i in range(0, len(labels), 5))
+
+
+def test_short_songs_are_not_clustered(tmp_path):
+    path = str(tmp_path / 'songs.hdf5')
+    melody = [[60 + i % 7] for i in range(50)]
+    write_song(path, 'a', melody, .5)
+    write_song(path, 'b', melody, .5)
+    write_song(path, 'empty_a', [[], []], .5)
+    write_song(path, 'empty_b', [], .5)
+    write_song(path, 'short_a', [[60], [62]], .5)
+    write_song(path, 'short_b', [[61], [63]], .5)
+    assert len(shingles([np.array([60]), np.array([62])])) == 0
+    clusters = near_duplicate_clusters(path, ['a', 'b', 'empty_a', 'empty_b', 'short_a', 'short_b'])
+    assert clusters == {'a': 'a', 'b': 'a', 'empty_a': 'empty_a', 'empty_b': 'empty_b',
+                        'short_a': 'short_a', 'short_b': 'short_b'}
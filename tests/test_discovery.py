@@ -0,0 +1,16 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from discovery import find_songs
+
+
+def test_find_songs_without_saving(tmp_path):
+    midi_dir = tmp_path / 'midi'
+    (midi_dir / 'a').mkdir(parents=True)
+    (midi_dir / 'a' / 'b.mid').write_bytes(b'')
+    manifest_path = str(tmp_path / 'manifest.json')
+    assert list(find_songs(str(midi_dir), manifest_path, save=False)) == ['a%2Fb']
+    assert not os.path.exists(manifest_path)
+    find_songs(str(midi_dir), manifest_path)
+    assert os.path.isfile(manifest_path)
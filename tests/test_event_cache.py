@@ -0,0 +1,75 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import event_cache
+from event_cache import EVENT_DTYPE, EventCache, select_part
+
+
+def fake_parser(monkeypatch):
+    """
+    Replaces music21 parsing with events made from the file's first byte, and
+    returns the list of parsed paths.
+    """
+    parsed = list()
+
+    def parse_midi(path):
+        parsed.append(path)
+        with open(path, 'rb') as f:
+            pitch = f.read()[0]
+        return np.array([(pitch, 0., 1., 0, 0, 0)], dtype=EVENT_DTYPE)
+
+    monkeypatch.setattr(event_cache, 'parse_midi', parse_midi)
+    return parsed
+
+
+def test_files_are_parsed_once_per_content(tmp_path, monkeypatch):
+    parsed = fake_parser(monkeypatch)
+    cache = EventCache(str(tmp_path / 'events'))
+    song = tmp_path / 'song.mid'
+    song.write_bytes(bytes([60]))
+    copy = tmp_path / 'copy.mid'
+    copy.write_bytes(bytes([60]))
+
+    assert str(song) not in cache
+    assert cache.get(str(song))['pitch'][0] == 60
+    assert str(song) in cache
+    assert cache.get(str(copy))['pitch'][0] == 60
+    assert parsed == [str(song)]
+    assert not [name for name in os.listdir(cache.root) if name.endswith('.tmp')]
+
+    # editing the file invalidates its entry
+    song.write_bytes(bytes([62]))
+    assert str(song) not in cache
+    assert cache.get(str(song))['pitch'][0] == 62
+    assert parsed == [str(song)] * 2
+
+
+def test_cache_version_invalidates_entries(tmp_path, monkeypatch):
+    parsed = fake_parser(monkeypatch)
+    cache = EventCache(str(tmp_path / 'events'))
+    song = tmp_path / 'song.mid'
+    song.write_bytes(bytes([60]))
+    key = cache.key(str(song))
+    cache.get(str(song))
+
+    monkeypatch.setattr(event_cache, 'CACHE_VERSION', event_cache.CACHE_VERSION + 1)
+    assert cache.key(str(song)) != key
+    assert str(song) not in cache
+    cache.get(str(song))
+    assert len(parsed) == 2
+
+
+def test_select_part_skips_drums_and_short_parts():
+    # part 0 is drums, part 1 has 2 onsets and part 2 has 3, one of them a chord
+    rows = [(36, onset, 1., 0, 9, 0) for onset in range(5)]
+    rows += [(60, onset, 1., 0, 0, 1) for onset in range(2)]
+    rows += [(pitch, onset, 1., 0, 1, 2) for onset in range(3) for pitch in (64, 67)]
+    events = np.array(rows, dtype=EVENT_DTYPE)
+    assert set(select_part(events, min_notes=3)['part']) == {2}
+    merged = select_part(events, min_notes=4)
+    assert set(merged['part']) == {0}
+    assert len(merged) == 8
+    assert list(merged['onset']) == sorted(merged['onset'])
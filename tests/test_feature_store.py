@@ -0,0 +1,66 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'preprocessing'))
+from feature_store import FeatureStore
+from vocal_extraction import spectral_features
+
+
+def test_get_or_compute_reuses_entry(tmp_path):
+    store = FeatureStore(str(tmp_path))
+    audio = np.arange(100, dtype=np.float32)
+    calls = list()
+
+    def compute():
+        calls.append(1)
+        return {'a': np.ones(3), 'b': np.zeros(2)}
+
+    first = store.get_or_compute(audio, {'stage': 'test'}, compute)
+    second = store.get_or_compute(audio, {'stage': 'test'}, compute)
+    assert len(calls) == 1
+    assert set(first) == set(second) == {'a', 'b'}
+    np.testing.assert_array_equal(second['a'], np.ones(3))
+
+
+def test_partial_entry_is_invisible(tmp_path):
+    store = FeatureStore(str(tmp_path))
+    audio = np.arange(100, dtype=np.float32)
+    key = store.key(audio, {'stage': 'test'})
+    # an entry being written by another process
+    tmp_dir = tmp_path / f'.{key}.1234.tmp'
+    tmp_dir.mkdir()
+    np.save(str(tmp_dir / 'a.npy'), np.ones(3))
+
+    features = store.get_or_compute(audio, {'stage': 'test'},
+                                    lambda: {'a': np.ones(3), 'b': np.zeros(2)})
+    assert set(features) == {'a', 'b'}
+    assert [name for name, _, _ in store._entries()] == [key]
+
+
+def test_put_keeps_existing_entry(tmp_path):
+    store = FeatureStore(str(tmp_path))
+    store.put('key', {}, {'a': np.ones(3)})
+    features = store.put('key', {}, {'a': np.zeros(3)})
+    np.testing.assert_array_equal(features['a'], np.ones(3))
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith('.tmp')]
+
+
+def test_separation_params_are_cached_separately(tmp_path):
+    store = FeatureStore(str(tmp_path))
+    y = np.random.RandomState(0).uniform(-.5, .5, size=8000 * 6).astype(np.float32)
+    _, _, foreground, _ = spectral_features(y, 8000, store=store)
+    _, _, other_foreground, _ = spectral_features(y, 8000, store=store, margin_v=2)
+    assert not np.allclose(foreground, other_foreground)
+
+
+def test_put_returns_features_evicted_by_another_store(tmp_path):
+    store = FeatureStore(str(tmp_path))
+    # another process evicting every entry, including the one just written
+    other = FeatureStore(str(tmp_path), max_bytes=0)
+    store.evict = lambda keep=None: other.evict()
+    features = store.put('key', {}, {'a': np.ones(3)})
+    np.testing.assert_array_equal(features['a'], np.ones(3))
+    assert store.get('key', ['a']) is None
@@ -0,0 +1,58 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'preprocessing'))
+from fundamental_freq import RING_BUFFER_SIZE, SpectralAnalyzer, sweep_thresholds
+
+WINDOW_SIZE = 1024
+
+
+def notes(sample_rate, freqs=(220, 330, 440, 294, 523), seconds=.4):
+    """
+    Tones separated by silences of the same length, with a little noise.
+    """
+    rng = np.random.RandomState(0)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    silence = np.zeros(len(t))
+    signal = np.concatenate([part for freq in freqs
+                             for part in (np.sin(2 * np.pi * freq * t), silence)])
+    return signal + 1e-3 * rng.randn(len(signal))
+
+
+@pytest.mark.parametrize('sample_rate', [22050, 44100])
+def test_sweep_matches_analyze(sample_rate):
+    signal = notes(sample_rate)
+    multipliers, window_sizes = [2, 5], [4, 7]
+    sweep = sweep_thresholds(signal, multipliers, window_sizes, window_size=WINDOW_SIZE,
+                             sample_rate=sample_rate)
+    assert np.count_nonzero(sweep['onsets']) > 0
+    for i, multiplier in enumerate(multipliers):
+        for j, threshold_window_size in enumerate(window_sizes):
+            analyzer = SpectralAnalyzer(WINDOW_SIZE, segments_buf=RING_BUFFER_SIZE,
+                                        threshold_multiplier=multiplier,
+                                        threshold_window_size=threshold_window_size,
+                                        sample_rate=sample_rate)
+            onsets, freqs = analyzer.analyze(signal)
+            np.testing.assert_allclose(sweep['onsets'][i, j], onsets)
+            np.testing.assert_allclose(sweep['freqs'][i, j], freqs)
+
+
+def test_sweep_finds_tone_frequencies_at_any_sample_rate():
+    medians = [sweep_thresholds(notes(sample_rate, freqs=(440,) * 4), [2], [4],
+                                window_size=WINDOW_SIZE, sample_rate=sample_rate)
+               ['stats'][0]['median_f0'] for sample_rate in (22050, 44100)]
+    np.testing.assert_allclose(medians, 440, rtol=.05)
+
+
+def test_split_analyze_matches_single_call():
+    signal = notes(22050)
+    onsets, freqs = SpectralAnalyzer(WINDOW_SIZE).analyze(signal)
+    analyzer = SpectralAnalyzer(WINDOW_SIZE)
+    split = 7 * WINDOW_SIZE
+    first, second = analyzer.analyze(signal[:split]), analyzer.analyze(signal[split:])
+    np.testing.assert_allclose(np.concatenate([first[0], second[0]]), onsets)
+    np.testing.assert_allclose(np.concatenate([first[1], second[1]]), freqs)
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from keys import (KEY_NAMES, detect_key, detect_keys, key_index, pitch_class_histograms,
+                  transpose_to_a)
+from piano_roll import midi_to_roll_index
+
+C_MAJOR_SCALE = np.array([60, 62, 64, 65, 67, 69, 71, 72])
+A_MINOR_TRIADS = np.array([57, 60, 64, 57, 60, 64, 62, 65, 69, 64, 68, 71, 57, 60, 64])
+
+
+def test_c_major_scale_is_transposed_to_a():
+    key = detect_key(midi_to_roll_index(C_MAJOR_SCALE))
+    assert KEY_NAMES[key] == 'C major'
+    assert key == key_index('C')
+    np.testing.assert_array_equal(transpose_to_a(C_MAJOR_SCALE, key), C_MAJOR_SCALE + 9)
+
+
+def test_detect_keys_batch_matches_single_songs():
+    songs = [midi_to_roll_index(C_MAJOR_SCALE), midi_to_roll_index(A_MINOR_TRIADS),
+             midi_to_roll_index(C_MAJOR_SCALE + 2), np.array([], dtype=int)]
+    keys, correlations = detect_keys(pitch_class_histograms(songs))
+    assert [KEY_NAMES[key] for key in keys] == ['C major', 'A minor', 'D major', 'C major']
+    assert correlations.shape == (4, 24)
+    assert list(keys[:3]) == [detect_key(song) for song in songs[:3]]
+    # a minor key is already on A
+    np.testing.assert_array_equal(transpose_to_a(A_MINOR_TRIADS, keys[1]), A_MINOR_TRIADS)
+
+
+def test_per_note_keys_transpose_each_note():
+    keys = np.array([key_index('C'), key_index('A', 'minor'), key_index('B-')])
+    np.testing.assert_array_equal(transpose_to_a([60, 60, 60], keys), [69, 60, 71])
@@ -0,0 +1,43 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from profiling import Profiler, percentile
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 21))
+    assert percentile(values, 50) == 10
+    assert percentile(values, 95) == 19
+    assert percentile(values, 100) == 20
+    assert percentile(values, 0) == 1
+    assert percentile([.5], 95) == .5
+
+
+def test_to_prometheus_summary_and_counters():
+    profiler = Profiler()
+    profiler.durations['read "seqs"'] = [.3, .1, .2]
+    profiler.count('songs')
+    profiler.count('songs', 2)
+    with profiler.stage('parse'):
+        pass
+    lines = profiler.to_prometheus(prefix='test').splitlines()
+    assert lines[0] == '# TYPE test_stage_seconds summary'
+    assert 'test_stage_seconds{stage="read \\"seqs\\"",quantile="0.50"} 0.2' in lines
+    assert 'test_stage_seconds{stage="read \\"seqs\\"",quantile="0.95"} 0.3' in lines
+    assert 'test_stage_seconds_count{stage="read \\"seqs\\""} 3' in lines
+    assert 'test_stage_seconds_count{stage="parse"} 1' in lines
+    assert any(line.startswith('test_stage_seconds_sum{stage="read \\"seqs\\""} 0.6')
+               for line in lines)
+    assert lines[-2:] == ['# TYPE test_events_total counter', 'test_events_total{name="songs"} 3']
+
+
+def test_dump_writes_prometheus_text_file(tmp_path, capsys):
+    profiler = Profiler(output=str(tmp_path / 'tunator.prom'))
+    with profiler.stage('parse'):
+        pass
+    profiler.dump()
+    assert 'parse' in capsys.readouterr().out
+    with open(str(tmp_path / 'tunator.prom')) as f:
+        assert f.read() == profiler.to_prometheus()
+    assert os.listdir(str(tmp_path)) == ['tunator.prom']
@@ -0,0 +1,68 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ingest import SongMap
+
+# (onset, pitch) of each note, out of order and with a duplicate
+ONSETS = [1., 0., 1., .5, 2.5, 1., 0.]
+PITCHES = [40, 36, 44, 38, 50, 40, 36]
+
+
+def test_from_events_builds_sorted_csr_without_duplicates():
+    song_map = SongMap.from_events(ONSETS, PITCHES)
+    np.testing.assert_array_equal(song_map.onsets, [0., .5, 1., 2.5])
+    np.testing.assert_array_equal(song_map.indptr, [0, 1, 2, 4, 5])
+    np.testing.assert_array_equal(song_map.pitches, [36, 38, 40, 44, 50])
+    assert song_map.pitches.dtype == np.int8
+    assert [list(step) for step in song_map.steps()] == [[36], [38], [40, 44], [50]]
+    assert [(onset, list(notes)) for onset, notes in song_map][2] == (1., [40, 44])
+
+
+def test_index_and_slice_by_onset():
+    song_map = SongMap.from_events(ONSETS, PITCHES)
+    assert list(song_map[1.]) == [40, 44]
+    assert 2.5 in song_map and .75 not in song_map and 3. not in song_map
+    with pytest.raises(KeyError):
+        song_map[.75]
+
+    view = song_map[.5:2.5]
+    np.testing.assert_array_equal(view.onsets, [.5, 1.])
+    np.testing.assert_array_equal(view.indptr, [0, 1, 3])
+    assert [list(step) for step in view.steps()] == [[38], [40, 44]]
+    # slice bounds fall between onsets and the view is sliceable again
+    assert [list(step) for step in song_map[.25:1.75][1:].steps()] == [[40, 44]]
+    assert len(song_map[:.5]) == 1 and len(song_map[1.:]) == 2
+    assert len(song_map[2.:1.]) == 0
+    with pytest.raises(ValueError):
+        song_map[0:2:1]
+
+
+def test_quantize_merges_notes_on_the_same_position():
+    # 1.1 and .9 land on position 1 of a .5 grid with a duplicate 40, and
+    # 2.6 on position 5
+    song_map = SongMap.from_events([0., .9, 1.1, 1.1, 2.6], [36, 40, 40, 43, 50])
+    quantized = song_map.quantize(.5)
+    assert quantized.spacing == .5
+    np.testing.assert_array_equal(quantized.onsets, [0., 1., 2.5])
+    np.testing.assert_array_equal(quantized.positions(), [0, 2, 5])
+    assert [list(step) for step in quantized.steps()] == [[36], [40, 43], [50]]
+
+    with_rests = song_map.quantize(.5, rests=True)
+    np.testing.assert_array_equal(with_rests.positions(), np.arange(6))
+    assert [list(step) for step in with_rests.steps()] == [[36], [], [40, 43], [], [], [50]]
+    assert len(SongMap.from_events([], []).quantize(.5, rests=True)) == 0
+
+
+def test_to_datastore_round_trip(tmp_path):
+    path = str(tmp_path / 'songs.hdf5')
+    quantized = SongMap.from_events(ONSETS, PITCHES).quantize(.5)
+    quantized.to_datastore(path, 'song')
+    read = SongMap.from_datastore(path, 'song')
+    np.testing.assert_array_equal(read.onsets, quantized.onsets)
+    np.testing.assert_array_equal(read.indptr, quantized.indptr)
+    np.testing.assert_array_equal(read.pitches, quantized.pitches)
+    assert read.spacing == .5
@@ -0,0 +1,41 @@
+import os
+import sys
+
+import h5py
+import numpy as np
+import soundfile as sf
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'preprocessing'))
+from transcription import SONG_PREFIX, transcribe_batch
+
+SAMPLE_RATE = 22050
+
+
+def melody(midis, gap):
+    t = np.arange(SAMPLE_RATE // 2) / SAMPLE_RATE
+    parts = list()
+    for midi in midis:
+        parts.append(.5 * np.sin(2 * np.pi * 440 * 2 ** ((midi - 69) / 12) * t) * np.exp(-3 * t))
+        parts.append(np.zeros(int(SAMPLE_RATE * gap)))
+    return np.concatenate(parts).astype(np.float32)
+
+
+def test_batch_names_songs_by_path_and_keeps_positions(tmp_path):
+    for name, gap in (('a', .5), ('b', 1.)):
+        (tmp_path / name).mkdir()
+        sf.write(str(tmp_path / name / 'x.wav'), melody([57, 61, 64, 69] * 3, gap), SAMPLE_RATE)
+    hdf5_path = str(tmp_path / 'songs.hdf5')
+    inputs = [str(tmp_path / 'a'), str(tmp_path / 'b')]
+
+    report = transcribe_batch(inputs, hdf5_path, n_workers=2)
+    assert not report['failed']
+    assert sorted(report['written']) == [SONG_PREFIX + 'a%2Fx', SONG_PREFIX + 'b%2Fx']
+    with h5py.File(hdf5_path, 'r') as f:
+        for song, info in report['written'].items():
+            positions = f['songs'][song]['positions'][:]
+            assert len(positions) == info['steps']
+            # the rests between notes are kept as gaps between positions
+            assert np.all(np.diff(positions) > 0)
+            assert positions[-1] - positions[0] >= 2 * (len(positions) - 1)
+    assert sorted(transcribe_batch(inputs, hdf5_path)['skipped']) == sorted(report['written'])
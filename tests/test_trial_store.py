@@ -0,0 +1,53 @@
+import math
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from trial_store import TrialStore
+
+
+class Dimension:
+    """
+    Named numerical search dimension with the attributes of the
+    `skopt.space` dimensions that `TrialStore` uses.
+    """
+    def __init__(self, name, low, high, prior='uniform'):
+        self.name = name
+        self.low = low
+        self.high = high
+        self.prior = prior
+
+    def __contains__(self, value):
+        return self.low <= value <= self.high
+
+
+DIMENSIONS = [Dimension('learning_rate', 1e-4, 1e-1, prior='log-uniform'),
+              Dimension('lstm_units', 64, 1024)]
+
+
+def test_history_and_find_skip_failed_trials(tmp_path):
+    store = TrialStore(str(tmp_path / 'trials.sqlite'))
+    store.record({'learning_rate': 1e-3, 'lstm_units': 128}, .5, metrics={'train_time': 10.})
+    store.record({'learning_rate': 1e-2, 'lstm_units': 256}, math.nan)
+    store.record({'learning_rate': 1e-2, 'lstm_units': 512}, math.inf)
+    store.record({'learning_rate': 1., 'lstm_units': 128}, .1)
+    x0, y0 = store.history(DIMENSIONS, with_time=True)
+    assert x0 == [[1e-3, 128]]
+    assert y0 == [(.5, 10.)]
+    assert store.find({'learning_rate': 1e-3 * (1 + 1e-6), 'lstm_units': 128}, DIMENSIONS)['loss'] == .5
+    assert store.find({'learning_rate': 1e-2, 'lstm_units': 256}, DIMENSIONS) is None
+    assert store.find({'learning_rate': 1e-2, 'lstm_units': 512}, DIMENSIONS) is None
+
+
+def test_resume_from_database(tmp_path):
+    db_path = str(tmp_path / 'trials.sqlite')
+    store = TrialStore(db_path, study='a')
+    assert store.setting('split_seed', 7) == 7
+    store.record({'learning_rate': 1e-3, 'lstm_units': 128}, .5)
+    store.close()
+
+    resumed = TrialStore(db_path, study='a')
+    assert resumed.setting('split_seed', 8) == 7
+    assert len(resumed) == 1
+    assert resumed.history(DIMENSIONS) == ([[1e-3, 128]], [.5])
+    assert len(TrialStore(db_path, study='b')) == 0
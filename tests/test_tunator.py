@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+
+import h5py
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+import tunator
+from event_cache import EVENT_DTYPE, EventCache
+
+
+def test_ingest_runs_without_keras(tmp_path):
+    midi_dir = tmp_path / 'midi'
+    midi_dir.mkdir()
+    code = ('import sys, tunator; '
+            f"status = tunator.main(['ingest', '--midi-dir', {str(midi_dir)!r}, "
+            f"'--hdf5-path', {str(tmp_path / 'songs.hdf5')!r}]); "
+            "assert not {'keras', 'tensorflow'} & set(sys.modules), sys.modules.keys(); "
+            'sys.exit(status)')
+    process = subprocess.run([sys.executable, '-c', code], cwd=ROOT, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, universal_newlines=True)
+    assert process.returncode == 0, process.stdout
+    assert '0 songs added' in process.stdout
+
+
+def test_ingest_writes_songs_with_the_chosen_layout(tmp_path):
+    midi_dir = tmp_path / 'midi'
+    midi_dir.mkdir()
+    (midi_dir / 'song.mid').write_bytes(b'not parsed')
+    # seed the event cache, so the file is never parsed with music21
+    events = np.array([(57 + i % 12, i / 2, .5, 0, 0, 0) for i in range(100)], dtype=EVENT_DTYPE)
+    cache = EventCache(str(tmp_path / 'events'))
+    np.save(os.path.join(cache.root, cache.key(str(midi_dir / 'song.mid')) + '.npy'), events)
+
+    hdf5_path = str(tmp_path / 'songs.hdf5')
+    args = ['ingest', '--midi-dir', str(midi_dir), '--hdf5-path', hdf5_path]
+    assert tunator.main(args + ['--layout', 'unknown']) == 1
+    assert tunator.main(args + ['--layout', 'gzip-1', '--layout-timesteps', '15']) == 0
+    with h5py.File(hdf5_path, 'r') as f:
+        indptr = f['songs/song/indptr']
+        assert indptr.chunks == (16,)
+        assert indptr.compression == 'gzip'
+        assert len(indptr) == 101
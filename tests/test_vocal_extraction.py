@@ -0,0 +1,57 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'preprocessing'))
+from vocal_extraction import extract_vocals_chunked, output_names, subtract_sides
+
+SR = 8000
+
+
+def write_noise(path, n_samples, channels=2, seed=0):
+    y = np.random.RandomState(seed).uniform(-.5, .5, size=(n_samples, channels))
+    sf.write(path, y, SR, subtype='PCM_16')
+
+
+@pytest.mark.parametrize('n_samples', [8000, 16100, 48000, 48100, 64000, 88000, 120000])
+def test_extract_vocals_chunked_lengths(tmp_path, n_samples):
+    in_path = str(tmp_path / 'in.wav')
+    out_path = str(tmp_path / 'out.wav')
+    write_noise(in_path, n_samples)
+    extract_vocals_chunked(in_path, out_path, block_seconds=6, overlap_seconds=2)
+    vocals, sr = sf.read(out_path)
+    assert sr == SR
+    assert len(vocals) == n_samples
+    assert np.isfinite(vocals).all()
+
+
+def test_output_names_are_unique():
+    paths = ['a/x.wav', 'b/x.wav', 'b/x.flac', 'b/y.wav']
+    names = output_names(paths)
+    assert names == {'a/x.wav': 'a%2Fx', 'b/x.wav': 'b%2Fx.wav', 'b/x.flac': 'b%2Fx.flac',
+                     'b/y.wav': 'b%2Fy'}
+    assert output_names(['d/x.wav', 'd/y.wav']) == {'d/x.wav': 'x', 'd/y.wav': 'y'}
+
+
+@pytest.mark.parametrize('mmap', [False, True])
+def test_subtract_sides_mono(tmp_path, mmap):
+    path = str(tmp_path / 'mono.wav')
+    write_noise(path, SR, channels=1)
+    y, sr = subtract_sides(path, sr=None, mmap=mmap)
+    expected, _ = sf.read(path, dtype='float32')
+    assert sr == SR
+    assert y.shape == (SR,)
+    np.testing.assert_allclose(y, expected, atol=1e-4)
+
+
+@pytest.mark.parametrize('mmap', [False, True])
+def test_subtract_sides_stereo(tmp_path, mmap):
+    path = str(tmp_path / 'stereo.wav')
+    write_noise(path, SR)
+    y, _ = subtract_sides(path, sr=None, mmap=mmap)
+    stereo, _ = sf.read(path, dtype='float32')
+    np.testing.assert_allclose(y, stereo.mean(axis=1), atol=1e-4)
@@ -0,0 +1,209 @@
+import json
+import math
+import os
+import sqlite3
+import time
+
+
+class TrialStore:
+    """
+    Persistent log of hyperparameter trials backed by a local SQLite database.
+
+    Every evaluated trial is stored with its hyperparameters, loss, any extra
+    metrics, the wall time it took and the path of the checkpoint it produced.
+    The history can be turned back into `x0`/`y0` lists for warm-starting
+    `gp_minimize`, and `find` looks up previously evaluated points so that an
+    optimizer can skip re-running them.
+
+    Args:
+        db_path (str): path to the SQLite database. It is created along with
+            any missing parent directories.
+        study (str): name of the study that trials are stored under, so that
+            trials from unrelated search spaces can share one database.
+    """
+    def __init__(self, db_path='data/trials.sqlite', study='default'):
+        self.db_path = db_path
+        self.study = study
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._conn = sqlite3.connect(db_path)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS trials ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'study TEXT NOT NULL, '
+                'params TEXT NOT NULL, '
+                'loss REAL, '
+                'metrics TEXT, '
+                'wall_time REAL, '
+                'checkpoint_path TEXT, '
+                'created REAL NOT NULL)')
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS trials_study ON trials (study)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS settings ('
+                'study TEXT NOT NULL, '
+                'name TEXT NOT NULL, '
+                'value TEXT NOT NULL, '
+                'PRIMARY KEY (study, name))')
+
+    def __len__(self):
+        row = self._conn.execute(
+            'SELECT COUNT(*) FROM trials WHERE study = ?', (self.study,)
+        ).fetchone()
+        return row[0]
+
+    def record(self, params, loss, metrics=None, wall_time=None,
+               checkpoint_path=None):
+        """
+        Stores a finished trial. The row is committed immediately so that it
+        survives a crash later in the run.
+        Args:
+            params (dict): hyperparameter names and values of the trial
+            loss (float): objective value that was minimized
+            metrics (dict): any additional metrics to keep with the trial
+            wall_time (float): seconds the trial took
+            checkpoint_path (str): path to the weights produced by the trial
+
+        Returns:
+            trial_id (int): row id of the stored trial
+        """
+        with self._conn:
+            cursor = self._conn.execute(
+                'INSERT INTO trials (study, params, loss, metrics, wall_time, '
+                'checkpoint_path, created) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (self.study,
+                 json.dumps(_to_builtin(params), sort_keys=True),
+                 _to_builtin(loss),
+                 json.dumps(_to_builtin(metrics or {}), sort_keys=True),
+                 wall_time,
+                 checkpoint_path,
+                 time.time()))
+        return cursor.lastrowid
+
+    def setting(self, name, default):
+        """
+        Looks up a setting that has to stay fixed across the runs of a study,
+        such as the seed of the train/validation split. The first call stores
+        `default`, and later calls, also from later runs, return the stored
+        value.
+        Args:
+            name (str): name of the setting
+            default: JSON-serializable value to store if there is none yet
+
+        Returns:
+            value: the stored value
+        """
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR IGNORE INTO settings (study, name, value) VALUES (?, ?, ?)',
+                (self.study, name, json.dumps(_to_builtin(default))))
+        row = self._conn.execute(
+            'SELECT value FROM settings WHERE study = ? AND name = ?', (self.study, name)
+        ).fetchone()
+        return json.loads(row[0])
+
+    def trials(self):
+        """
+        Returns:
+            trials (list[dict]): all trials of the study in insertion order,
+                with `params` and `metrics` decoded to dicts.
+        """
+        rows = self._conn.execute(
+            'SELECT * FROM trials WHERE study = ? ORDER BY id', (self.study,))
+        trials = list()
+        for row in rows:
+            trial = dict(row)
+            trial['params'] = json.loads(trial['params'])
+            trial['metrics'] = json.loads(trial['metrics'])
+            trials.append(trial)
+        return trials
+
+    def history(self, dimensions, with_time=False):
+        """
+        Converts the stored trials to points in the order of `dimensions` for
+        warm-starting an optimizer. Trials that lack one of the dimensions, fall
+        outside of the search space or have no finite loss are left out.
+        Args:
+            dimensions (list[skopt.space.Dimension]): named search dimensions
+            with_time (bool): pair each loss with the trial's training time, as
+                expected by per-second acquisition functions such as 'EIps'.
+                The `train_time` metric is used if the trial reported one,
+                otherwise its wall time.
+
+        Returns:
+            x0 (list[list]): evaluated points
+            y0 (list): loss, or (loss, time) tuple, for each point in `x0`
+        """
+        x0 = list()
+        y0 = list()
+        for trial in self.trials():
+            params = trial['params']
+            loss = trial['loss']
+            if loss is None or not math.isfinite(loss):
+                continue
+            if not all(dim.name in params for dim in dimensions):
+                continue
+            point = [params[dim.name] for dim in dimensions]
+            if not all(value in dim for value, dim in zip(point, dimensions)):
+                continue
+            x0.append(point)
+            if with_time:
+                y0.append((loss, trial['metrics'].get('train_time', trial['wall_time'])))
+            else:
+                y0.append(loss)
+        return x0, y0
+
+    def find(self, params, dimensions, tol=1e-3):
+        """
+        Looks for a stored trial that matches `params` on every dimension.
+        Categorical values have to be equal. Numerical values match when they
+        differ by no more than `tol` as a fraction of the dimension's range,
+        measured in log space for log-uniform dimensions.
+        Args:
+            params (dict): hyperparameter names and values to look up
+            dimensions (list[skopt.space.Dimension]): named search dimensions
+            tol (float): relative tolerance for numerical dimensions
+
+        Returns:
+            trial (dict or None): the most recent matching trial with a finite
+                loss, if any
+        """
+        for trial in reversed(self.trials()):
+            stored = trial['params']
+            if trial['loss'] is None or not math.isfinite(trial['loss']):
+                continue
+            if all(dim.name in stored and _is_close(
+                    dim, params[dim.name], stored[dim.name], tol)
+                   for dim in dimensions):
+                return trial
+        return None
+
+    def close(self):
+        self._conn.close()
+
+
+def _is_close(dim, a, b, tol):
+    if not hasattr(dim, 'low'):  # categorical
+        return a == b
+    low, high = dim.low, dim.high
+    if getattr(dim, 'prior', None) == 'log-uniform':
+        a, b = math.log(a), math.log(b)
+        low, high = math.log(low), math.log(high)
+    return abs(a - b) <= tol * (high - low)
+
+
+def _to_builtin(obj):
+    """
+    Converts numpy scalars in (nested) dicts and lists to builtin Python types
+    so that they can be serialized to JSON.
+    """
+    if isinstance(obj, dict):
+        return {k: _to_builtin(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_to_builtin(v) for v in obj]
+    if hasattr(obj, 'item'):
+        return obj.item()
+    return obj
@@ -0,0 +1,292 @@
+"""
+Command line entry point for the tunator pipeline.
+
+    python tunator.py ingest --status
+    python tunator.py ingest --midi-dir music/midi/final_fantasy/
+    python tunator.py ingest --hdf5-path data/songs.json --shards 16
+    python tunator.py ingest --layout gzip-1 --layout-timesteps 64
+    python tunator.py train --hparams '{"epochs": 8, "timesteps": 64}'
+    python tunator.py compose checkpoints/<run>/<weights>.hdf5 --timesteps 128
+    python tunator.py tune --method pbt
+    python tunator.py pitch working_dir/vocals.wav
+
+Heavy dependencies (Keras and TensorFlow, music21, librosa, skopt) are only
+imported by the subcommands that use them, so quick commands like
+`ingest --status` and `--help` start without them, and `ingest` runs without
+Keras and TensorFlow. No subcommand waits for interactive input.
+
+With TUNATOR_STARTUP_ONLY set, every subcommand exits as soon as it has
+imported its dependencies, which `utils/startup_time.py` uses to time them.
+"""
+import argparse
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+    if args.profile is not None or args.profile_capture:
+        import profiling
+
+        profiling.enable(output=args.profile or None, capture=args.profile_capture)
+    return args.run(args)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='PATH',
+                        help='time the pipeline stages and print a report at exit, also '
+                             'written to PATH as JSON, or in the Prometheus text-file '
+                             'format if PATH ends in .prom')
+    parser.add_argument('--profile-capture', default=None, metavar='STAGE[:MODE]',
+                        help='run cProfile, or tracemalloc with MODE tracemalloc, around '
+                             'every call of one stage, see profiling.py')
+    subparsers = parser.add_subparsers(dest='command')
+
+    def add_command(name, run, help):
+        subparser = subparsers.add_parser(name, help=help, description=help)
+        subparser.set_defaults(run=run)
+        return subparser
+
+    def add_datastore_args(subparser):
+        subparser.add_argument('--midi-dir', default='music/midi/final_fantasy/')
+        subparser.add_argument('--hdf5-path', default='data/songs.hdf5',
+                               help='datastore, or the .json manifest of a sharded datastore')
+
+    def add_hparams_arg(subparser):
+        subparser.add_argument('--hparams', type=parse_hparams, default=None,
+                               help='JSON object of hyperparameters, or a path to a JSON file')
+
+    ingest = add_command('ingest', run_ingest, 'add new MIDI files to the datastore')
+    add_datastore_args(ingest)
+    ingest.add_argument('--status', action='store_true',
+                        help='only report how many songs are stored and missing')
+    ingest.add_argument('--grid', default='1/8', help="onset grid, e.g. '1/16' or '1/8t'")
+    ingest.add_argument('--rests', action='store_true', help='store empty timesteps')
+    ingest.add_argument('--layout', default=None,
+                        help="storage layout of new songs, e.g. 'contiguous', 'chunked' or "
+                             "'gzip-1', see datastore.named_layouts (default: "
+                             "datastore.DEFAULT_LAYOUT)")
+    ingest.add_argument('--layout-timesteps', type=int, default=256,
+                        help='training window the chunks of --layout are aligned to')
+    ingest.add_argument('--worker', type=parse_worker, default=None,
+                        help='INDEX/COUNT, only ingest the songs of this worker\'s shards')
+    ingest.add_argument('--shards', type=int, default=None,
+                        help='create the .json manifest of a sharded datastore with this many '
+                             'shards at --hdf5-path if it does not exist')
+    ingest.add_argument('--migrate-from', default=None, metavar='PATH',
+                        help='split this single-file datastore into the new sharded datastore, '
+                             'see --shards')
+
+    train = add_command('train', run_train, 'train a model on the datastore')
+    add_datastore_args(train)
+    add_hparams_arg(train)
+    train.add_argument('--weights', default=None, help='weights to resume training from')
+    train.add_argument('--epochs', type=int, default=None)
+    train.add_argument('--time-budget', type=float, default=None,
+                       help='seconds after which training is stopped')
+    train.add_argument('--worker', type=parse_worker, default=None,
+                       help="INDEX/COUNT, only train on this worker's shards")
+    train.add_argument('--dedup-threshold', type=float, default=None,
+                       help='keep near-duplicate songs of this similarity on one side of the '
+                            'train/validation split, see dedup.py')
+    train.add_argument('--representatives', action='store_true',
+                       help='only use the longest song of each near-duplicate cluster, '
+                            'requires --dedup-threshold')
+
+    compose = add_command('compose', run_compose, 'write a MIDI file sampled from a trained model')
+    add_datastore_args(compose)
+    add_hparams_arg(compose)
+    compose.add_argument('weights', help='weights of the trained model')
+    compose.add_argument('--timesteps', type=int, default=128)
+    compose.add_argument('--output', default=None, help='MIDI file to write')
+
+    tune = add_command('tune', run_tune, 'search for hyperparameters')
+    add_datastore_args(tune)
+    add_hparams_arg(tune)
+    tune.add_argument('--method', choices=('bayes', 'pbt'), default='bayes',
+                      help='Bayesian optimization or population based training')
+    tune.add_argument('--calls', type=int, default=100, help='trials of the Bayesian search')
+    tune.add_argument('--deadline', type=float, default=None,
+                      help='seconds after which no new trial is started')
+    tune.add_argument('--population', type=int, default=4, help='population based training members')
+    tune.add_argument('--rounds', type=int, default=10, help='population based training rounds')
+
+    pitch = add_command('pitch', run_pitch, 'track the pitch of an audio file as it streams')
+    pitch.add_argument('path', help='audio file')
+    return parser
+
+
+def parse_hparams(value):
+    if os.path.isfile(value):
+        with open(value) as f:
+            return json.load(f)
+    try:
+        return json.loads(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'not a JSON object or file: {value}')
+
+
+def parse_worker(value):
+    try:
+        worker, n_workers = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected INDEX/COUNT, got {value}')
+    if not 0 <= worker < n_workers:
+        raise argparse.ArgumentTypeError(f'worker index {worker} is not below {n_workers}')
+    return worker, n_workers
+
+
+def startup_done():
+    """
+    Marks the point where a subcommand has imported its dependencies, see
+    `utils/startup_time.py`.
+    """
+    if os.environ.get('TUNATOR_STARTUP_ONLY'):
+        sys.exit(0)
+
+
+def run_ingest(args):
+    try:
+        datastore = open_datastore(args.hdf5_path, args.shards, args.migrate_from)
+    except (OSError, ValueError) as e:
+        print(f'error: {e}', file=sys.stderr)
+        return 1
+    if args.status:
+        return ingest_status(args.midi_dir, args.hdf5_path, args.worker)
+    from datastore import DEFAULT_LAYOUT, named_layouts
+    from ingest import discover_songs, grid_spacing, update_datastore
+
+    startup_done()
+    layout = DEFAULT_LAYOUT
+    if args.layout is not None:
+        layouts = named_layouts(args.layout_timesteps)
+        if args.layout not in layouts:
+            print(f"error: unknown layout {args.layout}, expected one of {', '.join(layouts)}",
+                  file=sys.stderr)
+            return 1
+        layout = layouts[args.layout]
+    if args.worker is not None:
+        datastore = datastore.subset(*args.worker)
+    song_file_dict = discover_songs(args.midi_dir, args.hdf5_path)
+    added = update_datastore(datastore, song_file_dict, grid=grid_spacing(args.grid), rests=args.rests,
+                             layout=layout)
+    print(f'{len(added)} songs added, {len(datastore.songs())} songs in the datastore')
+    return 0
+
+
+def open_datastore(hdf5_path, n_shards=None, migrate_from=None):
+    """
+    Opens the datastore at `hdf5_path`. With `n_shards`, a missing `.json`
+    manifest is created for a new sharded datastore, or written by splitting
+    the single-file datastore at `migrate_from` into it.
+
+    Returns:
+        datastore (Datastore): the datastore
+    """
+    from datastore import as_datastore, shard
+
+    if migrate_from is not None:
+        if n_shards is None:
+            raise ValueError('--migrate-from needs the number of --shards')
+        datastore = shard(migrate_from, hdf5_path, n_shards)
+        print(f'split {migrate_from} into {n_shards} shards listed in {hdf5_path}')
+        return datastore
+    return as_datastore(hdf5_path, n_shards)
+
+
+def ingest_status(midi_dir, hdf5_path, worker=None):
+    """
+    Reports the MIDI files found in `midi_dir` and how many of them are stored,
+    with only the discovery manifest and the datastore's HDF5 indexes read.
+    Nothing is written, not even the updated discovery manifest.
+    """
+    from datastore import as_datastore
+    from discovery import find_songs, manifest_path_for
+
+    datastore = as_datastore(hdf5_path)
+    if worker is not None:
+        datastore = datastore.subset(*worker)
+    song_file_dict = find_songs(midi_dir, manifest_path_for(midi_dir, os.path.dirname(hdf5_path)),
+                                save=False)
+    songs = [song for song in song_file_dict if datastore.owns(song)]
+    stored, missing = datastore.query(songs)
+    transcribed = sum(attrs.get('source') == 'audio' for attrs in datastore.songs().values())
+    print(f'{len(song_file_dict)} MIDI files in {midi_dir}, {len(songs)} in '
+          f'{len(datastore.shards)} of {datastore.n_shards} shards')
+    print(f'{len(stored)} stored, {len(missing)} missing, {transcribed} transcribed from audio')
+    return 0
+
+
+def run_train(args):
+    if args.representatives and args.dedup_threshold is None:
+        print('error: --representatives requires --dedup-threshold', file=sys.stderr)
+        return 1
+    from lstm import TunatorLSTM
+
+    startup_done()
+    tunator = TunatorLSTM(midi_dir=args.midi_dir, hdf5_path=args.hdf5_path, hparams=args.hparams,
+                          worker=args.worker, dedup_threshold=args.dedup_threshold,
+                          dedup_representatives=args.representatives)
+    if args.weights:
+        tunator.load_model(args.weights)
+    else:
+        tunator.build_model()
+    tunator.train(time_budget=args.time_budget, epochs=args.epochs)
+    print(f'validation loss {tunator.val_loss:.4f}, best weights {tunator.checkpoint_path}')
+    return 0
+
+
+def run_compose(args):
+    from lstm import TunatorLSTM
+
+    startup_done()
+    # compose from the songs already stored, without scanning the corpus
+    tunator = TunatorLSTM(midi_dir=args.midi_dir, hdf5_path=args.hdf5_path, hparams=args.hparams,
+                          scan_midi=False)
+    tunator.load_model(args.weights)
+    tunator.compose(args.timesteps, output_path=args.output)
+    return 0
+
+
+def run_tune(args):
+    if args.method == 'bayes':
+        from hparam_optimizer import HyperparameterOptimizer
+
+        startup_done()
+        optimizer = HyperparameterOptimizer(midi_dir=args.midi_dir, hdf5_path=args.hdf5_path,
+                                            fixed_hparams=args.hparams)
+        best_hparams = optimizer.optimize(n_calls=args.calls, deadline=args.deadline)
+        print(f'Best hyperparameters:\n{best_hparams}')
+    else:
+        from lstm import shared_dataset
+        from pbt import PopulationBasedTrainer
+
+        startup_done()
+        hparams = args.hparams or dict()
+        dataset = shared_dataset(args.midi_dir, args.hdf5_path)
+        trainer = PopulationBasedTrainer(hparams, dataset, population_size=args.population,
+                                         rounds=args.rounds)
+        print(f'Best member:\n{trainer.run()}')
+    return 0
+
+
+def run_pitch(args):
+    # the audio modules import each other as top-level modules
+    sys.path.append(os.path.join(ROOT, 'preprocessing'))
+    from fundamental_freq import track_pitch
+
+    startup_done()
+    track_pitch(args.path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
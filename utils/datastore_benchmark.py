@@ -0,0 +1,140 @@
+"""
+Benchmarks HDF5 datastore layouts for the random window reads of training:
+every layout is written with `datastore.repack`, then random windows of
+`timesteps + 1` timesteps are read from random songs.
+
+    python utils/datastore_benchmark.py data/songs.hdf5 --timesteps 256
+    python utils/datastore_benchmark.py --synthetic 200 --timesteps 64 --cold
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datastore import named_layouts, read_steps, repack, song_length, write_song
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('hdf5_path', nargs='?', default=None,
+                        help='datastore to benchmark, see --synthetic otherwise')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='number of random songs to generate instead of reading a datastore')
+    parser.add_argument('--timesteps', type=int, default=256)
+    parser.add_argument('--reads', type=int, default=2000, help='random windows read per layout')
+    parser.add_argument('--cold', action='store_true',
+                        help='drop each file from the page cache before every window read')
+    parser.add_argument('--json', default=None, help='also write the results to this path')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src_path = args.hdf5_path
+        if args.synthetic:
+            src_path = os.path.join(tmp_dir, 'synthetic.hdf5')
+            write_synthetic(src_path, args.synthetic)
+        elif src_path is None:
+            parser.error('either hdf5_path or --synthetic is required')
+        results = benchmark(src_path, tmp_dir, args.timesteps, args.reads, cold=args.cold)
+
+    print(f"{'layout':<24}{'MB':>10}{'windows/s':>12}{'MB/s':>10}")
+    for name, result in results.items():
+        print(f"{name:<24}{result['file_bytes'] / 1e6:>10.2f}"
+              f"{result['windows_per_second']:>12.0f}{result['read_mb_per_second']:>10.2f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def benchmark(src_path, work_dir, timesteps, n_reads, cold=False, seed=0):
+    """
+    Repacks the datastore at `src_path` with every layout in
+    `datastore.named_layouts` and times `n_reads` random window reads from
+    each, see `time_random_windows`.
+
+    Returns:
+        results (dict): `file_bytes`, `windows_per_second` and
+            `read_mb_per_second` of the notes read, by layout name
+    """
+    results = dict()
+    for name, layout in named_layouts(timesteps).items():
+        path = os.path.join(work_dir, f"{name.replace(' ', '_')}.hdf5")
+        repack(src_path, path, layout)
+        seconds, n_bytes = time_random_windows(path, timesteps, n_reads, seed, cold=cold)
+        results[name] = {
+            'layout': layout,
+            'file_bytes': os.path.getsize(path),
+            'windows_per_second': n_reads / seconds,
+            'read_mb_per_second': n_bytes / seconds / 1e6,
+        }
+        os.remove(path)
+    return results
+
+
+def time_random_windows(path, timesteps, n_reads, seed=0, cold=False):
+    """
+    Reads `n_reads` windows of `timesteps + 1` timesteps at random offsets of
+    random songs that are long enough, like the training generators do. With
+    `cold`, the file is dropped from the page cache before every read, untimed,
+    so each window comes from disk as if the corpus didn't fit in memory.
+
+    Returns:
+        seconds (float): time spent reading
+        n_bytes (int): bytes of notes read
+    """
+    rng = np.random.RandomState(seed)
+    with h5py.File(path, 'r') as f:
+        songs = [(name, song_length(grp)) for name, grp in f['songs'].items()
+                 if song_length(grp) > timesteps]
+        if not songs:
+            raise ValueError(f'no song in {path} is longer than {timesteps} timesteps')
+        picks = rng.randint(len(songs), size=n_reads)
+        n_bytes = 0
+        seconds = 0.
+        for i in picks:
+            name, length = songs[i]
+            offset = rng.randint(length - timesteps)
+            if cold:
+                drop_page_cache(path)
+            start = time.perf_counter()
+            window = read_steps(f[f'songs/{name}'], offset, offset + timesteps + 1)
+            seconds += time.perf_counter() - start
+            n_bytes += sum(notes.nbytes for notes in window)
+        return seconds, n_bytes
+
+
+def drop_page_cache(path):
+    """
+    Asks the kernel to drop the cached pages of the file at `path`, so it is
+    read from disk as if the corpus didn't fit in memory. Only available on
+    platforms with `posix_fadvise`.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def write_synthetic(path, n_songs, seed=0):
+    """
+    Writes `n_songs` random songs of 1 to 4 notes per timestep, with lengths
+    and pitch ranges similar to the MIDI corpus.
+    """
+    rng = np.random.RandomState(seed)
+    for i in range(n_songs):
+        length = rng.randint(500, 5000)
+        center = rng.randint(30, 90)
+        polyphony = rng.randint(1, 5, size=length)
+        notes = [np.sort(center + rng.randint(-12, 12, size=n)) for n in polyphony]
+        write_song(path, f'song_{i}', notes, .5, layout=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Reports how often the vectorized key detector in `keys.py` agrees with
+music21's `analyze('key.krumhanslkessler')`, which uses the same profiles, on
+a corpus of MIDI files, and how long each takes. `--method key` compares with
+music21's default Aarden-Essen weighting instead.
+
+    python utils/key_agreement.py music/midi/final_fantasy/ [--method key] [--json report.json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import music21 as m21
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from keys import KEY_NAMES, KEY_MODES, KEY_TONICS, detect_keys, music21_key_index, \
+    pitch_class_histograms
+from piano_roll import midi_to_roll_index
+
+MIDI_EXTS = ('.mid', '.midi')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('inputs', nargs='+', help='MIDI files or directories of MIDI files')
+    parser.add_argument('--method', default='key.krumhanslkessler',
+                        help="music21 key analysis method, e.g. 'key' for Aarden-Essen")
+    parser.add_argument('--json', default=None, help='also write the report to this path')
+    args = parser.parse_args()
+
+    report = key_agreement(list_midi_files(args.inputs), method=args.method)
+    summary = {k: v for k, v in report.items() if k != 'songs'}
+    print(json.dumps(summary, indent=2))
+    for song in report['songs']:
+        if song['music21'] != song['detected']:
+            print(f"{song['file']}: music21 {song['music21']}, detected {song['detected']}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def list_midi_files(inputs):
+    paths = list()
+    for item in inputs:
+        if os.path.isdir(item):
+            paths += sorted(
+                os.path.join(item, fname) for fname in os.listdir(item)
+                if os.path.splitext(fname)[1].lower() in MIDI_EXTS)
+        else:
+            paths.append(item)
+    return paths
+
+
+def key_agreement(paths, method='key.krumhanslkessler'):
+    """
+    Detects the key of every file with music21's `analyze(method)` and with
+    `keys.detect_keys`, run once over the whole batch of songs.
+
+    Returns:
+        report (dict): number of `songs` compared, fraction in `agreement`,
+            fractions where only the `same_tonic` or the `relative_key` was
+            found, total seconds spent by each detector and the per-song keys
+    """
+    files = list()
+    songs = list()
+    durations = list()
+    music21_keys = list()
+    music21_seconds = 0.
+    for path in paths:
+        try:
+            score = m21.converter.parse(path)
+        except Exception as e:
+            print(f'skipping {path}: {e}')
+            continue
+        pitches = [(pitch.midi, elem.duration.quarterLength)
+                   for elem in score.flat.notes for pitch in elem.pitches]
+        if not pitches:
+            continue
+        midi, song_durations = np.array(pitches, dtype=float).reshape(-1, 2).T
+        start = time.time()
+        music21_keys.append(music21_key_index(score.analyze(method)))
+        music21_seconds += time.time() - start
+        files.append(path)
+        songs.append(midi_to_roll_index(midi.astype(int)))
+        durations.append(song_durations)
+
+    start = time.time()
+    detected, _ = detect_keys(pitch_class_histograms(songs, durations))
+    detected_seconds = time.time() - start
+
+    music21_keys = np.array(music21_keys, dtype=int)
+    n = max(len(files), 1)
+    same_key = detected == music21_keys
+    same_tonic = ~same_key & (KEY_TONICS[detected] == KEY_TONICS[music21_keys])
+    # relative keys share their scale, e.g. C major and A minor
+    relative = ((KEY_MODES[detected] != KEY_MODES[music21_keys])
+                & ((KEY_TONICS[detected] + 3 * KEY_MODES[detected]) % 12
+                   == (KEY_TONICS[music21_keys] + 3 * KEY_MODES[music21_keys]) % 12))
+    return {
+        'songs': [{'file': f, 'music21': KEY_NAMES[m], 'detected': KEY_NAMES[d]}
+                  for f, m, d in zip(files, music21_keys, detected)],
+        'n_songs': len(files),
+        'agreement': float(same_key.sum() / n),
+        'same_tonic': float(same_tonic.sum() / n),
+        'relative_key': float(relative.sum() / n),
+        'music21_seconds': music21_seconds,
+        'detected_seconds': detected_seconds,
+    }
+
+
+if __name__ == '__main__':
+    main()
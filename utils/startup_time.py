@@ -0,0 +1,96 @@
+"""
+Measures the cold-start time of every `tunator.py` subcommand: the wall time
+of a fresh interpreter running the CLI up to the point where the subcommand
+has imported its dependencies, with `TUNATOR_STARTUP_ONLY` set, best and
+median of several runs. `--help` and `ingest --status` run to completion.
+
+    python utils/startup_time.py --runs 5 [--json startup.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# arguments of every subcommand timed up to its imports, and whether it takes
+# the datastore arguments
+SUBCOMMANDS = {
+    'ingest': (['ingest'], True),
+    'train': (['train'], True),
+    'compose': (['compose', 'weights.hdf5'], True),
+    'tune --method bayes': (['tune', '--method', 'bayes'], True),
+    'tune --method pbt': (['tune', '--method', 'pbt'], True),
+    'pitch': (['pitch', 'audio.wav'], False),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--json', default=None, help='also write the results to this path')
+    args = parser.parse_args()
+
+    results = startup_times(args.runs)
+    print(f"{'command':<24}{'best s':>10}{'median s':>10}  status")
+    for name, result in results.items():
+        status = 'ok' if result['ok'] else result['error'].strip().splitlines()[-1]
+        print(f"{name:<24}{result['best']:>10.3f}{result['median']:>10.3f}  {status}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def startup_times(n_runs=5):
+    """
+    Times `tunator.py --help`, `ingest --status` on an empty corpus and
+    datastore, and every subcommand in `SUBCOMMANDS` up to its imports, each
+    in a new interpreter so no module is cached.
+
+    Returns:
+        results (dict): `best` and `median` seconds, whether all runs were
+            `ok` and the last `error` output, by command
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        midi_dir = os.path.join(tmp_dir, 'midi')
+        os.makedirs(midi_dir)
+        tunator = [sys.executable, os.path.join(ROOT, 'tunator.py')]
+        datastore_args = ['--midi-dir', midi_dir, '--hdf5-path', os.path.join(tmp_dir, 'songs.hdf5')]
+        commands = {
+            '--help': tunator + ['--help'],
+            'ingest --status': tunator + ['ingest', '--status'] + datastore_args,
+        }
+        results = {name: time_command(command, n_runs) for name, command in commands.items()}
+        for name, (args, uses_datastore) in SUBCOMMANDS.items():
+            command = tunator + args + (datastore_args if uses_datastore else [])
+            results[name] = time_command(command, n_runs, startup_only=True)
+        return results
+
+
+def time_command(command, n_runs, startup_only=False):
+    env = dict(os.environ)
+    if startup_only:
+        env['TUNATOR_STARTUP_ONLY'] = '1'
+    seconds = list()
+    error = ''
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                 stdin=subprocess.DEVNULL, universal_newlines=True, env=env)
+        seconds.append(time.perf_counter() - start)
+        if process.returncode != 0:
+            error = process.stderr
+    return {
+        'best': min(seconds),
+        'median': statistics.median(seconds),
+        'ok': not error,
+        'error': error,
+    }
+
+
+if __name__ == '__main__':
+    main()